@@ -1,10 +1,14 @@
 #!/usr/bin/env python
-'''extract.py [options] file
+'''extract.py [options] file [file ...]
 
 Extract test suite data and output it in a format which can be used by
-testcode2.'''
+testcode2. If several files are given, they are processed concurrently and
+the data for each file is preceded by its name.'''
 
+import mmap
+import multiprocessing
 import optparse
+import re
 import sys
 
 # Test data to be searched for.
@@ -48,6 +52,46 @@ simulation_labels = [
     ['2-RDM ESTIMATES FOR TRANSITION', -4, -2, -1]
 ]
 
+# All of the strings searched for, combined into a single regular expression.
+# This is used to find the (few) lines of the output which contain any of them.
+matcher = re.compile('|'.join(re.escape(pattern) for pattern in
+                              [sim_string[0] for sim_string in simulation_labels] +
+                              [data[1] for data in test_data]).encode('ascii'))
+
+def matching_lines(filename):
+    '''Return the lines in the file which contain any of the strings
+       searched for.'''
+
+    lines = []
+
+    f = open(filename, 'rb')
+    try:
+        buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except ValueError:
+        # The file is empty.
+        f.close()
+        return lines
+
+    pos = 0
+    while True:
+        match = matcher.search(buf, pos)
+        if not match:
+            break
+        start = buf.rfind(b'\n', 0, match.start()) + 1
+        end = buf.find(b'\n', match.end())
+        if end < 0:
+            end = len(buf)
+        line = buf[start:end]
+        if not isinstance(line, str):
+            line = line.decode('latin-1')
+        lines.append(line)
+        pos = end
+
+    buf.close()
+    f.close()
+
+    return lines
+
 def extract_data(filename):
     '''Extract test data from the input file.'''
 
@@ -55,9 +99,7 @@ def extract_data(filename):
     values = []
     sim_label_string = ''
 
-    f = open(filename)
-
-    for line in f:
+    for line in matching_lines(filename):
         # Search for a string specifying which simulation/state the data will be for.
         for sim_string in simulation_labels:
             if sim_string[0] in line:
@@ -82,8 +124,6 @@ def extract_data(filename):
                     names.append(data[0])
                 values.append(words[data[2]])
 
-    f.close()
-
     return names, values
 
 def write_data(names, values, padding):
@@ -107,16 +147,29 @@ def parse_options(args):
     '''Read and return filename and any options present.'''
 
     parser = optparse.OptionParser(usage = __doc__)
-    (options, filename) = parser.parse_args(args)
+    parser.add_option('-j', '--jobs', dest='jobs', type='int', default=None,
+                      help='The number of files to process concurrently '
+                      '(default: the number of CPUs).')
+    (options, filenames) = parser.parse_args(args)
 
-    if len(filename) != 1:
+    if len(filenames) == 0:
         parser.print_help()
         sys.exit(1)
 
-    return filename[0]
+    return options, filenames
 
 if __name__ == '__main__':
-    filename = parse_options(sys.argv[1:])
-
-    names, values = extract_data(filename)
-    write_data(names, values, padding=2)
+    options, filenames = parse_options(sys.argv[1:])
+
+    if len(filenames) == 1:
+        names, values = extract_data(filenames[0])
+        write_data(names, values, padding=2)
+    else:
+        nproc = min(options.jobs or multiprocessing.cpu_count(), len(filenames))
+        pool = multiprocessing.Pool(nproc)
+        results = pool.map(extract_data, filenames)
+        pool.close()
+        pool.join()
+        for (filename, (names, values)) in zip(filenames, results):
+            sys.stdout.write('==> %s <==\n' % filename)
+            write_data(names, values, padding=2)
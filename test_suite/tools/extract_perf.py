@@ -0,0 +1,317 @@
+#!/usr/bin/env python
+'''extract_perf.py [options] file
+extract_perf.py --report [options] [directory ...]
+
+Extract the timing and memory usage data printed by NECI, in the same format
+as extract.py.
+
+With --report, compare the most recent test output (test.out.*) in each test
+directory against its benchmark (benchmark.out.*, using the benchmark IDs in
+userconfig), and report any tests which have become slower or use more
+memory. The directories searched default to neci, dneci, kneci and mneci.
+With --self-check, each benchmark is instead compared against itself, for
+which nothing should be reported.'''
+
+import optparse
+import os
+import re
+import sys
+
+try:
+    import ConfigParser as configparser
+except ImportError:
+    import configparser
+
+from extract import write_data
+
+# Single values to be searched for. Each element gives the name, the string
+# searched for and the position of the value in the line.
+perf_data = [
+    ['loop_time', 'Total loop-time:', -1],
+    ['cpu_time', 'Global CPU time', -1],
+    ['system_time', 'Global system time', -1],
+    ['total_time', 'Global total time', -1],
+    ['max_memory', 'Maximum memory used is', -1],
+]
+
+# The iteration data printed to the output has a header either of the form
+# 'Step ... IterTime' or '# 1. Iter. ... 12. Iter. time'.
+re_label_split = re.compile(r'#?\s*\d+\.\s+')
+
+# Units for the sizes of large memory allocations (in MB).
+size_units = [('KB', 1.0/1024), ('MB', 1.0), ('GB', 1024.0), ('B', 1.0/1024**2)]
+
+# The default tolerances for each class of quantity: a change is only
+# reported if it exceeds both the relative and absolute tolerance.
+default_tolerances = {
+    'time': (0.25, 0.05),       # seconds
+    'iter_time': (0.25, 1e-3),  # seconds
+    'memory': (0.1, 1.0),       # MB
+}
+
+test_dirs = ['neci', 'dneci', 'kneci', 'mneci']
+
+def size_in_mb(size):
+    '''Convert a size printed as e.g. 117.2KB to MB.'''
+
+    for (unit, scale) in size_units:
+        if size.endswith(unit):
+            return float(size[:-len(unit)]) * scale
+    return float(size)
+
+def quantity_class(name):
+    '''The class of a quantity, from its name.'''
+
+    if name == 'iter_time':
+        return 'iter_time'
+    elif name.startswith('alloc_') or name == 'max_memory':
+        return 'memory'
+    else:
+        return 'time'
+
+def extract_perf(filename):
+    '''Extract timing and memory data from the output file.'''
+
+    names = []
+    values = []
+
+    iter_col = None
+    ncols = 0
+    iter_times = []
+    section = None
+
+    f = open(filename)
+
+    for line in f:
+        words = line.split()
+
+        # The header of the iteration data.
+        labels = None
+        if words and words[0] == 'Step' and 'IterTime' in words:
+            labels = words
+            label = 'IterTime'
+        elif line.startswith('#') and 'Iter. time' in line:
+            labels = [l.strip() for l in re_label_split.split(line)
+                      if l.strip()]
+            label = 'Iter. time'
+        if labels and label in labels:
+            iter_col = labels.index(label)
+            ncols = len(labels)
+            iter_times = []
+
+        # The iteration data itself (some rows may be commented out).
+        if iter_col is not None:
+            row = line.lstrip('#').split()
+            if len(row) == ncols and row[0].isdigit():
+                try:
+                    iter_times.append(float(row[iter_col]))
+                except ValueError:
+                    pass
+
+        for data in perf_data:
+            if data[1] in line:
+                names.append(data[0])
+                values.append(words[data[2]])
+
+        # The large memory allocations and timing reports are tables.
+        if 'Large memory allocations' in line:
+            section = 'alloc'
+        elif words[:1] == ['Procedure'] and 'Calls' in words:
+            section = 'timing'
+        elif line.startswith(' ==='):
+            section = None
+        elif not words or line.startswith(' - ') or words[0] == 'Name':
+            pass
+        elif section == 'alloc':
+            names.append('alloc_' + line[1:19].strip())
+            values.append('%.6g' % size_in_mb(words[-1]))
+        elif section == 'timing':
+            if words[0] == 'Total':
+                section = None
+            elif len(words) >= 5:
+                names.append('proc_' + '_'.join(words[:-4]))
+                values.append(words[-1])
+
+    f.close()
+
+    if iter_times:
+        names.insert(0, 'iter_time')
+        values.insert(0, '%.6g' % (sum(iter_times)/len(iter_times)))
+
+    return unique_names(names), values
+
+def unique_names(names):
+    '''Make repeated names (e.g. of arrays allocated more than once) unique,
+       by appending the number of the occurrence to each after the first,
+       e.g. alloc_arr, alloc_arr#2, alloc_arr#3. Quantities in two files are
+       then paired by their order of appearance.'''
+
+    counts = dict()
+    unique = []
+    for name in names:
+        counts[name] = counts.get(name, 0) + 1
+        if counts[name] > 1:
+            name = '%s#%i' % (name, counts[name])
+        unique.append(name)
+    return unique
+
+def benchmark_ids(userconfig):
+    '''The benchmark IDs from the userconfig file, newest first.'''
+
+    config = configparser.RawConfigParser()
+    config.read(userconfig)
+    try:
+        return config.get('user', 'benchmark').split()
+    except (configparser.NoSectionError, configparser.NoOptionError):
+        return []
+
+def output_pairs(test_dir, ids, self_check=False):
+    '''Find pairs of (benchmark, test output) files in a test directory, for
+       each of the inputs of the test. With self_check, each benchmark is
+       paired with itself.'''
+
+    benchmarks = dict()
+    outputs = dict()
+    for fn in os.listdir(test_dir):
+        if fn.startswith('benchmark.out.'):
+            bench_id, sep, inp = fn[len('benchmark.out.'):].partition('.inp=')
+            benchmarks.setdefault(inp, dict())[bench_id] = fn
+        elif fn.startswith('test.out.'):
+            test_id, sep, inp = fn[len('test.out.'):].partition('.inp=')
+            outputs.setdefault(inp, []).append(fn)
+
+    pairs = []
+    for inp in sorted(benchmarks if self_check else outputs):
+        # As testcode, use the first benchmark ID for which there is a file.
+        bench = [benchmarks.get(inp, {})[i] for i in ids
+                 if i in benchmarks.get(inp, {})]
+        if not bench:
+            continue
+        if self_check:
+            pairs.append((os.path.join(test_dir, bench[0]),) * 2)
+            continue
+        test = max(outputs[inp],
+                   key=lambda fn: os.path.getmtime(os.path.join(test_dir, fn)))
+        pairs.append((os.path.join(test_dir, bench[0]),
+                      os.path.join(test_dir, test)))
+
+    return pairs
+
+def compare(bench_file, test_file, tolerances):
+    '''Compare the performance data in the two files. Returns a list of
+       (name, benchmark value, test value, slower) for each quantity
+       present in both.'''
+
+    bench = dict(zip(*extract_perf(bench_file)))
+    names, values = extract_perf(test_file)
+
+    results = []
+    for (name, value) in zip(names, values):
+        if name not in bench:
+            continue
+        try:
+            old = float(bench[name])
+            new = float(value)
+        except ValueError:
+            continue
+        (rel, absolute) = tolerances[quantity_class(name)]
+        slower = new > old*(1+rel) and new - old > absolute
+        results.append((name, old, new, slower))
+
+    return results
+
+def report(dirs, tolerances, verbose, self_check=False):
+    '''Compare the test outputs against the benchmarks for all of the tests
+       in dirs, and print the quantities which have got worse. Returns the
+       number of tests which have got worse. With self_check, each benchmark
+       is compared against itself, for which nothing should be reported.'''
+
+    suite_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+    ids = benchmark_ids(os.path.join(suite_dir, 'userconfig'))
+
+    if not dirs:
+        dirs = [os.path.join(suite_dir, d) for d in test_dirs]
+
+    fmt = '%-50s %-28s %12s %12s %8s %s'
+    sys.stdout.write(fmt % ('Test', 'Quantity', 'Benchmark', 'Test',
+                            'Change', '') + '\n')
+
+    ntests = 0
+    nslower = 0
+    for top in dirs:
+        for (test_dir, subdirs, files) in sorted(os.walk(top)):
+            subdirs.sort()
+            for (bench_file, test_file) in output_pairs(test_dir, ids,
+                                                        self_check):
+                ntests += 1
+                results = compare(bench_file, test_file, tolerances)
+                if any(slower for (name, old, new, slower) in results):
+                    nslower += 1
+                name = os.path.relpath(os.path.dirname(test_file), suite_dir)
+                for (quantity, old, new, slower) in results:
+                    if slower or verbose:
+                        change = '%+.1f%%' % (100*(new-old)/old) if old \
+                                     else '-'
+                        sys.stdout.write(fmt % (name[-50:], quantity[:28],
+                                                '%.4g' % old, '%.4g' % new,
+                                                change,
+                                                'SLOWER' if slower else '')
+                                         + '\n')
+
+    sys.stdout.write('%i tests compared, %i slower or using more memory.\n'
+                     % (ntests, nslower))
+
+    return nslower
+
+def parse_tolerance(option, opt_str, value, parser):
+    '''Set the tolerances for a class of quantities, given as
+       class=relative[,absolute].'''
+
+    (name, sep, tols) = value.partition('=')
+    if name not in parser.values.tolerances:
+        raise optparse.OptionValueError('unknown class of quantity: %s' % name)
+    tols = [float(t) for t in tols.split(',')]
+    if len(tols) == 1:
+        tols.append(parser.values.tolerances[name][1])
+    parser.values.tolerances[name] = tuple(tols[:2])
+
+def parse_options(args):
+    '''Read and return the filenames and any options present.'''
+
+    parser = optparse.OptionParser(usage = __doc__)
+    parser.add_option('-r', '--report', action='store_true', default=False,
+                      help='Compare test outputs against the benchmarks.')
+    parser.add_option('-t', '--tolerance', type='string', action='callback',
+                      callback=parse_tolerance, metavar='CLASS=REL[,ABS]',
+                      help='The relative and absolute tolerances for a class '
+                      'of quantities (time, iter_time or memory) in seconds '
+                      'or MB. The defaults are time=%s,%s, iter_time=%s,%s '
+                      'and memory=%s,%s.' %
+                      (default_tolerances['time'] +
+                       default_tolerances['iter_time'] +
+                       default_tolerances['memory']))
+    parser.add_option('-v', '--verbose', action='store_true', default=False,
+                      help='Print all of the quantities compared.')
+    parser.add_option('--self-check', action='store_true', default=False,
+                      help='With --report, compare each benchmark against '
+                      'itself. Any quantity reported indicates a fault in '
+                      'the comparison.')
+    parser.set_defaults(tolerances=dict(default_tolerances))
+    (options, filenames) = parser.parse_args(args)
+
+    if not options.report and len(filenames) != 1:
+        parser.print_help()
+        sys.exit(1)
+
+    return options, filenames
+
+if __name__ == '__main__':
+    options, filenames = parse_options(sys.argv[1:])
+
+    if options.report:
+        nslower = report(filenames, options.tolerances, options.verbose,
+                         options.self_check)
+        sys.exit(1 if nslower else 0)
+    else:
+        names, values = extract_perf(filenames[0])
+        write_data(names, values, padding=2)
@@ -0,0 +1,569 @@
+#!/usr/bin/env python
+'''schedule.py [options] [category ...]
+
+Run the tests in the test suite concurrently on the cores of this machine.
+
+The tests, and the number of (MPI) processes each uses, are read from
+jobconfig and userconfig in the same way as testcode. The tests in each
+directory are run one at a time, in the same order as by testcode, as later
+tests may use files (e.g. POPSFILEs) written by earlier ones. The directories
+are started longest first (using the total durations of their tests in
+previous runs, or the timings in the benchmark outputs), and packed onto the
+available cores as others finish. Results are printed as each test finishes.
+
+The outputs are named as by testcode (test.out.ID.inp=INPUT), so they can
+then be checked against the benchmarks with
+
+    testcode.py compare -t ID
+
+Categories are given as paths relative to the test suite directory, e.g.
+neci/serial or mneci/cfqmc/HeHe_5_states. By default, the tests in the
+categories listed in jobconfig (_default_) are run.
+
+The outputs of successful runs are cached (in .test_cache), under a hash of
+the executable, the command used to run the test and the input files in the
+test directory (those tracked by git, including the files in bases/ that they
+link to). A test is only run again if one of these has changed; otherwise the
+cached output is used. As the tests in a directory may use files written by
+earlier ones (e.g. POPSFILEs), which are not cached, the cached outputs are
+only used if all of the tests in the directory are cached; otherwise all of
+them are run.'''
+
+import ast
+import glob
+import gzip
+import hashlib
+import json
+import multiprocessing
+import optparse
+import os
+import subprocess
+import shutil
+import sys
+import tempfile
+import time
+
+try:
+    import ConfigParser as configparser
+except ImportError:
+    import configparser
+
+suite_dir = os.path.normpath(os.path.join(
+                os.path.dirname(os.path.abspath(__file__)), '..'))
+
+# The durations of previous runs of each test.
+durations_file = os.path.join(suite_dir, '.test_durations.json')
+
+output_prefixes = ('benchmark.out.', 'test.out.', 'test.err.')
+
+cache_dir = os.path.join(suite_dir, '.test_cache')
+
+class test_job:
+    '''A single test: the running of one input file in a test directory.'''
+
+    def __init__(self, path, input_file, args, program, nprocs):
+        self.path = path
+        self.input_file = input_file
+        self.args = args
+        self.program = program
+        self.nprocs = nprocs
+        self.cores = max(nprocs, 1)
+        self.estimate = 0.0
+
+    def name(self):
+        '''The name used to identify the test.'''
+
+        return self.path + ':' + self.input_file
+
+    def outputs(self, test_id):
+        '''The names of the output and error files of the test.'''
+
+        suffix = '.inp=' + self.input_file
+        if self.args:
+            suffix += '.args=' + self.args
+        return ('test.out.' + test_id + suffix, 'test.err.' + test_id + suffix)
+
+    def command(self, exe, launch_parallel, test_id):
+        '''The shell command to run the test.'''
+
+        cmd = '%s %s %s > %s 2> %s' % ((exe, self.args, self.input_file) +
+                                       self.outputs(test_id))
+        if self.nprocs > 0:
+            cmd = launch_parallel.replace('tc.nprocs', str(self.nprocs)) + \
+                      ' ' + cmd
+        return cmd
+
+def read_config(filename):
+    '''Read a testcode configuration file.'''
+
+    config = configparser.RawConfigParser()
+    config.optionxform = str
+    config.read(filename)
+    return config
+
+def config_get(config, section, option, default=None):
+    '''Get an option from a configuration file, if present.'''
+
+    if config.has_option(section, option):
+        return config.get(section, option)
+    return default
+
+def find_tests(jobconfig, userconfig, categories):
+    '''Find all of the tests, and their settings, in the given categories.'''
+
+    # The settings for each test directory are obtained from all of the
+    # (glob) sections which match it, with later sections taking precedence.
+    settings = dict()
+    default_categories = []
+    for section in jobconfig.sections():
+        options = dict(jobconfig.items(section))
+        if '_default_' in options:
+            default_categories = options.pop('_default_').split()
+        for path in glob.glob(os.path.join(suite_dir, section)):
+            if os.path.isdir(path):
+                path = os.path.relpath(path, suite_dir)
+                settings.setdefault(path, dict()).update(options)
+
+    if not categories:
+        categories = default_categories
+    categories = [os.path.normpath(c) for c in categories]
+
+    jobs = []
+    for path in sorted(settings):
+        if not any(path == c or path.startswith(c + os.sep)
+                   for c in categories):
+            continue
+
+        options = settings[path]
+        program = options.get('program',
+                              config_get(userconfig, 'user', 'default_program'))
+        nprocs = int(options.get('nprocs', 0))
+        if 'max_nprocs' in options:
+            nprocs = min(nprocs, int(options['max_nprocs']))
+        if 'min_nprocs' in options:
+            nprocs = max(nprocs, int(options['min_nprocs']))
+
+        # inputs_args is a (list of) tuples of input file globs and arguments
+        inputs_args = config_get(userconfig, program, 'inputs_args',
+                                 "('*.inp', '')")
+        inputs_args = ast.literal_eval('[' + inputs_args + ']')
+        if inputs_args and not isinstance(inputs_args[0], tuple):
+            inputs_args = [tuple(inputs_args)]
+        for (input_glob, args) in inputs_args:
+            for input_file in sorted(glob.glob(os.path.join(suite_dir, path,
+                                                            input_glob))):
+                # The glob may also match the outputs of previous runs.
+                input_file = os.path.basename(input_file)
+                if input_file.startswith(output_prefixes):
+                    continue
+                jobs.append(test_job(path, input_file, args, program, nprocs))
+
+    return jobs
+
+def benchmark_time(job):
+    '''The total time taken by the test in (any of) its benchmark outputs.'''
+
+    pattern = os.path.join(suite_dir, job.path,
+                           'benchmark.out.*.inp=' + job.input_file + '*')
+    for benchmark in sorted(glob.glob(pattern)):
+        f = open(benchmark, 'rb')
+        for line in f:
+            if b'Global total time' in line:
+                f.close()
+                return float(line.split()[-1])
+        f.close()
+    return 0.0
+
+def estimate_durations(jobs):
+    '''Set the estimated duration of each test, from previous runs if
+       possible, otherwise from the benchmark outputs.'''
+
+    try:
+        f = open(durations_file)
+        durations = json.load(f)
+        f.close()
+    except (IOError, OSError, ValueError):
+        durations = dict()
+
+    for job in jobs:
+        if job.name() in durations:
+            job.estimate = durations[job.name()]
+        else:
+            job.estimate = benchmark_time(job)
+
+    return durations
+
+def save_durations(durations):
+    '''Store the durations of the tests. Failure to do so is not an error.'''
+
+    try:
+        f = open(durations_file, 'w')
+        json.dump(durations, f, indent=0, sort_keys=True)
+        f.close()
+    except (IOError, OSError):
+        pass
+
+def file_hash(filename, sha=None):
+    '''Add the contents of a file to a SHA-1 hash (a new one by default).'''
+
+    if sha is None:
+        sha = hashlib.sha1()
+    f = open(filename, 'rb')
+    for chunk in iter(lambda: f.read(1 << 20), b''):
+        sha.update(chunk)
+    f.close()
+    return sha
+
+def input_files(jobs):
+    '''The input files in each test directory: those tracked by git, or if
+       git is not available, all files other than outputs.'''
+
+    inputs = dict((job.path, []) for job in jobs)
+    try:
+        proc = subprocess.Popen(['git', 'ls-files', '-z'] + sorted(inputs),
+                                cwd=suite_dir, stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE)
+        files = proc.communicate()[0]
+        if proc.returncode != 0:
+            raise OSError('git ls-files failed')
+        for fn in files.decode().split('\0'):
+            # Files may be in subdirectories of the test directory.
+            (path, name) = (fn, '')
+            while path:
+                (path, sep, base) = path.rpartition('/')
+                name = base + sep + name if name else base
+                if os.path.normpath(path) in inputs:
+                    inputs[os.path.normpath(path)].append(name)
+                    break
+    except OSError:
+        for path in inputs:
+            inputs[path] = [fn for fn in os.listdir(os.path.join(suite_dir, path))
+                            if not fn.startswith(output_prefixes)]
+
+    for path in inputs:
+        inputs[path] = sorted(fn for fn in inputs[path]
+                              if not fn.startswith(output_prefixes))
+    return inputs
+
+def test_keys(jobs, userconfig, launch_parallel):
+    '''The hash of everything which affects the output of each test: the
+       executable, the command run and the input files (following any links
+       to files elsewhere, e.g. bases/INTDUMP.*).'''
+
+    exe_hashes = dict()
+    dir_hashes = dict()
+    inputs = input_files(jobs)
+    keys = dict()
+
+    for job in jobs:
+        exe = job_exe(userconfig, job.program)
+        if exe not in exe_hashes:
+            try:
+                exe_hashes[exe] = file_hash(exe).hexdigest()
+            except (IOError, OSError):
+                # No executable: the test will fail, and is not cached.
+                exe_hashes[exe] = None
+        if exe_hashes[exe] is None:
+            keys[job.name()] = None
+            continue
+
+        if job.path not in dir_hashes:
+            sha = hashlib.sha1()
+            for fn in inputs[job.path]:
+                sha.update(fn.encode() + b'\0')
+                filename = os.path.join(suite_dir, job.path, fn)
+                if os.path.isfile(filename):
+                    file_hash(filename, sha)
+            dir_hashes[job.path] = sha.hexdigest()
+
+        sha = hashlib.sha1()
+        for part in [exe_hashes[exe], dir_hashes[job.path],
+                     job.command(exe, launch_parallel, 'ID')]:
+            sha.update(part.encode() + b'\0')
+        keys[job.name()] = sha.hexdigest()
+
+    return keys
+
+class result_cache:
+    '''The outputs of previous (successful) runs of the tests, stored in
+       compressed form under the hash of everything which affects them.'''
+
+    def __init__(self, directory):
+        self.directory = directory
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def filenames(self, key):
+        '''The cached output and error files for a key.'''
+
+        return [os.path.join(self.directory, key + ext)
+                for ext in ('.out.gz', '.err.gz')]
+
+    def has(self, key):
+        '''Whether the outputs for a key are cached.'''
+
+        return key is not None and all(os.path.isfile(fn)
+                                       for fn in self.filenames(key))
+
+    def restore(self, key, job, test_id):
+        '''Copy the cached outputs into the test directory, if present.
+           Returns whether they were.'''
+
+        if not self.has(key):
+            return False
+        for (cached, output) in zip(self.filenames(key),
+                                    job.outputs(test_id)):
+            src = gzip.open(cached, 'rb')
+            dest = open(os.path.join(suite_dir, job.path, output), 'wb')
+            shutil.copyfileobj(src, dest)
+            dest.close()
+            src.close()
+            # The age of an entry is the time since it was last used.
+            os.utime(cached, None)
+        return True
+
+    def add(self, key, job, test_id):
+        '''Store the outputs of a test. Failure to do so is not an error.'''
+
+        if key is None:
+            return
+        try:
+            # The output file is written last, so an entry is only complete
+            # once both are present.
+            for (cached, output) in reversed(list(zip(self.filenames(key),
+                                                      job.outputs(test_id)))):
+                fd, tmp = tempfile.mkstemp(dir=self.directory)
+                os.close(fd)
+                src = open(os.path.join(suite_dir, job.path, output), 'rb')
+                dest = gzip.open(tmp, 'wb')
+                shutil.copyfileobj(src, dest)
+                dest.close()
+                src.close()
+                os.rename(tmp, cached)
+        except (IOError, OSError):
+            pass
+
+    def evict(self, max_age, max_size):
+        '''Remove entries not used for more than max_age days, then the least
+           recently used entries until the cache is at most max_size MB.'''
+
+        entries = dict()
+        for fn in os.listdir(self.directory):
+            st = os.stat(os.path.join(self.directory, fn))
+            (atime, size) = entries.get(fn.split('.')[0], (0, 0))
+            entries[fn.split('.')[0]] = (max(atime, st.st_mtime),
+                                         size + st.st_size)
+
+        now = time.time()
+        total = sum(size for (atime, size) in entries.values())
+        for key in sorted(entries, key=lambda k: entries[k][0]):
+            (atime, size) = entries[key]
+            if now - atime > max_age*86400 or total > max_size*1024**2:
+                for fn in glob.glob(os.path.join(self.directory, key + '.*')):
+                    os.remove(fn)
+                total -= size
+
+def directory_queues(jobs):
+    '''Group the tests by directory, keeping their order (that of testcode)
+       within each directory. The directories are sorted longest first, by
+       the total estimated duration of their tests.'''
+
+    queues = dict()
+    for job in jobs:
+        queues.setdefault(job.path, []).append(job)
+    return sorted(queues.values(),
+                  key=lambda q: (-sum(job.estimate for job in q),
+                                 -max(job.cores for job in q), q[0].path))
+
+def select_jobs(queues, free, busy_dirs, ncores):
+    '''Choose which tests to start on the free cores: the next test in each
+       directory (taken longest first) in which no test is running. Tests in
+       the same directory are not run at once, as they would overwrite each
+       other's files, and may depend on files written by earlier tests.'''
+
+    selected = []
+    for queue in queues:
+        if not queue:
+            continue
+        job = queue[0]
+        cores = min(job.cores, ncores)
+        if cores <= free and job.path not in busy_dirs:
+            selected.append(job)
+            free -= cores
+            busy_dirs = busy_dirs | set([job.path])
+    return selected
+
+def plan(jobs, ncores):
+    '''Simulate running the tests using their estimated durations. Returns
+       the start time of each test and the total time.'''
+
+    queues = directory_queues(jobs)
+    running = []
+    starts = []
+    now = 0.0
+    free = ncores
+    while any(queues) or running:
+        busy_dirs = set(job.path for (end, job) in running)
+        for job in select_jobs(queues, free, busy_dirs, ncores):
+            queues_remove(queues, job)
+            running.append((now + job.estimate, job))
+            starts.append((now, job))
+            free -= min(job.cores, ncores)
+        running.sort(key=lambda r: r[0])
+        (now, job) = running.pop(0)
+        free += min(job.cores, ncores)
+    return starts, now
+
+def queues_remove(queues, job):
+    '''Remove a test from the directory queues.'''
+
+    for queue in queues:
+        if job in queue:
+            queue.remove(job)
+            return
+
+def job_exe(userconfig, program):
+    '''The executable for a program, relative to the test suite directory.'''
+
+    exe = config_get(userconfig, program, 'exe')
+    return os.path.normpath(os.path.join(suite_dir, exe))
+
+def write_result(job, ndone, njobs, cores, duration, status):
+    '''Print the result of a test.'''
+
+    sys.stdout.write('[%*i/%i] %-60s %2i procs %9.1fs  %s\n' %
+                     (len(str(njobs)), ndone, njobs, job.name(), cores,
+                      duration, status))
+    sys.stdout.flush()
+
+def run(jobs, ncores, test_id, userconfig, durations, cache):
+    '''Run the tests, printing the results as each finishes. Returns the
+       number of tests which failed.'''
+
+    launch_parallel = config_get(userconfig, 'user', 'launch_parallel',
+                                 'mpirun -np tc.nprocs')
+
+    queues = directory_queues(jobs)
+    running = []
+    free = ncores
+    nfailed = 0
+    ndone = 0
+    ncached = 0
+    start_time = time.time()
+    core_time = 0.0
+
+    keys = dict()
+    if cache is not None:
+        keys = test_keys(jobs, userconfig, launch_parallel)
+        # A directory is either restored or run as a whole, so that tests
+        # reading files written by earlier tests find them.
+        for queue in queues:
+            if not all(cache.has(keys[job.name()]) for job in queue):
+                continue
+            for job in list(queue):
+                if cache.restore(keys[job.name()], job, test_id):
+                    queue.remove(job)
+                    ndone += 1
+                    ncached += 1
+                    write_result(job, ndone, len(jobs), job.cores, 0,
+                                 'cached')
+
+    while any(queues) or running:
+        busy_dirs = set(job.path for (job, proc, start) in running)
+        for job in select_jobs(queues, free, busy_dirs, ncores):
+            exe = job_exe(userconfig, job.program)
+            cmd = job.command(exe, launch_parallel, test_id)
+            proc = subprocess.Popen(cmd, shell=True,
+                                    cwd=os.path.join(suite_dir, job.path))
+            queues_remove(queues, job)
+            running.append((job, proc, time.time()))
+            free -= min(job.cores, ncores)
+
+        time.sleep(0.05)
+
+        for (job, proc, start) in list(running):
+            if proc.poll() is None:
+                continue
+            running.remove((job, proc, start))
+            free += min(job.cores, ncores)
+            ndone += 1
+
+            duration = time.time() - start
+            core_time += duration * job.cores
+            if proc.returncode == 0:
+                durations[job.name()] = duration
+                status = 'done'
+                if cache is not None:
+                    cache.add(keys[job.name()], job, test_id)
+            else:
+                nfailed += 1
+                status = 'FAILED (exit status %i)' % proc.returncode
+            write_result(job, ndone, len(jobs), job.cores, duration, status)
+
+    elapsed = time.time() - start_time
+    sys.stdout.write('%i tests run in %.1fs on %i cores (%.1f core-seconds), '
+                     '%i cached, %i failed.\n' % (len(jobs) - ncached, elapsed,
+                                                  ncores, core_time, ncached,
+                                                  nfailed))
+    sys.stdout.write('Compare against the benchmarks with: '
+                     'testcode.py compare -t %s\n' % test_id)
+
+    return nfailed
+
+def parse_options(args):
+    '''Read and return the categories and any options present.'''
+
+    parser = optparse.OptionParser(usage = __doc__)
+    parser.add_option('-j', '--cores', type='int', default=None,
+                      help='The number of cores to use (default: all).')
+    parser.add_option('-t', '--test-id', default=None,
+                      help='The ID used to label the test outputs (default: '
+                      'the date and time).')
+    parser.add_option('-c', '--jobconfig', default='jobconfig',
+                      help='The job configuration file (default: jobconfig).')
+    parser.add_option('-u', '--userconfig', default='userconfig',
+                      help='The user configuration file (default: userconfig).')
+    parser.add_option('--no-cache', action='store_false', dest='cache',
+                      default=True, help='Run all of the tests, without '
+                      'using or storing cached outputs.')
+    parser.add_option('--cache-max-age', type='float', default=30,
+                      help='Remove cached outputs not used for this many '
+                      'days (default: %default).')
+    parser.add_option('--cache-max-size', type='float', default=500,
+                      help='The maximum size of the cache in MB, beyond which '
+                      'the least recently used outputs are removed '
+                      '(default: %default).')
+    parser.add_option('-n', '--dry-run', action='store_true', default=False,
+                      help='Print the order in which the tests would be run, '
+                      'and their estimated start times, without running them.')
+    (options, categories) = parser.parse_args(args)
+
+    return (options, categories)
+
+if __name__ == '__main__':
+    (options, categories) = parse_options(sys.argv[1:])
+
+    jobconfig = read_config(os.path.join(suite_dir, options.jobconfig))
+    userconfig = read_config(os.path.join(suite_dir, options.userconfig))
+    ncores = options.cores or multiprocessing.cpu_count()
+    test_id = options.test_id or time.strftime('%d%m%Y-%H%M%S')
+
+    jobs = find_tests(jobconfig, userconfig, categories)
+    durations = estimate_durations(jobs)
+
+    if options.dry_run:
+        starts, total = plan(jobs, ncores)
+        for (start, job) in starts:
+            sys.stdout.write('%9.1fs  %-60s %2i procs %9.1fs\n' %
+                             (start, job.name(), job.cores, job.estimate))
+        serial = sum(job.estimate for job in jobs)
+        sys.stdout.write('%i tests, estimated %.1fs on %i cores (%.1fs if run '
+                         'one at a time).\n' % (len(jobs), total, ncores,
+                                                serial))
+    else:
+        cache = result_cache(cache_dir) if options.cache else None
+        nfailed = run(jobs, ncores, test_id, userconfig, durations, cache)
+        save_durations(durations)
+        if cache is not None:
+            cache.evict(options.cache_max_age, options.cache_max_size)
+        sys.exit(1 if nfailed else 0)
@@ -1,55 +1,39 @@
 #!/usr/bin/env python
-'''extract_eigv.py -l nlowdin file.*
+'''extract_eigv.py [options] -l nlowdin file.*
 
 Extract the Hamiltonian eigenvalues from file.* files and move them to a
 file with the same form as EIGV_DATA files output by NECI. The 'file.*' files
 should be called file.I, where I is an iteration label which will be used in
 the EIGV_DATA file, and should have the format of lowdin.* files output by
-NECI when running KP-FCIQMC calculations.'''
+NECI when running KP-FCIQMC calculations.
+
+The same table may also be saved as a numpy array (.npy), with the iteration
+in the first column and NaN where there is no eigenvalue.'''
 
 import optparse
 import os
 import sys
+import numpy
+import lowdin
 
-def extract_data(data_file, target_nlowdin):
+def extract_data(data_file, target_nlowdin, data=None):
     '''Extract the eigenvalues from data_file, using a Lowdin cutoff of
        nlowdin_target. If this Lowdin cutoff does not exist then use the
-       largest cutoff that does.'''
-
-    overlap_start_str = 'Overlap matrix eigenvalues'
-    start_str = 'Eigenvalues and overlaps when keeping ' + str(target_nlowdin)
-
-    nlowdin = 0
-    have_overlap = False
-    have_data = False
-    energies = []
-
-    f = open(data_file)
+       largest cutoff that does. The contents of the file (from lowdin.py)
+       may be passed in data, if they have already been read.'''
 
-    for line in f:
-        if not line.strip(): # If an empty line.
-            # If we've just finished looking at overlap eigenvalues.
-            if have_overlap:
-                start_str = 'Eigenvalues and overlaps when keeping ' + str(min(nlowdin, target_nlowdin))
+    if data is None:
+        data = lowdin.read_lowdin_files([data_file], 1)[0]
 
-            have_overlap = False
-            have_data = False
+    # The number of positive overlap eigenvalues.
+    nlowdin = data.npositive()
 
-        if have_overlap:
-            # Count the number of positive overlap eigenvalues.
-            values = line.split()
-            overlap_eval = float(values[0])
-            if overlap_eval > 0.0:
-                nlowdin += 1
+    cutoff = target_nlowdin
+    if len(data.overlap_eigv):
+        cutoff = min(nlowdin, target_nlowdin)
 
-        if have_data:
-            values = line.split()
-            energies.append(float(values[0]))
-
-        if overlap_start_str in line:
-            have_overlap = True
-        if start_str in line:
-            have_data = True
+    block = data.block(cutoff)
+    energies = [] if block is None else list(block[:,0])
 
     return nlowdin, energies
 
@@ -60,6 +44,15 @@ def parse_options(args):
     parser.add_option('-l', '--lowdin-cutoff', dest='cutoff', type='int', default=5,
                       help='The number of eigenvectors to keep in the Lowdin '
                       'orthogonalisation procedure.')
+    parser.add_option('-o', '--output', dest='output', default=None,
+                      help='Write the EIGV_DATA table to this file, rather '
+                      'than to standard output.')
+    parser.add_option('-b', '--binary', dest='binary', default=None,
+                      help='Also save the table as a numpy array in this '
+                      'file (.npy).')
+    parser.add_option('-j', '--jobs', dest='jobs', type='int', default=None,
+                      help='The number of files to read concurrently '
+                      '(default: the number of CPUs).')
     (options, filenames) = parser.parse_args(args)
     
     if len(filenames) == 0:
@@ -81,23 +74,39 @@ if __name__ == '__main__':
         iterations.append(int(os.path.splitext(data_file)[1][1:]))
     iterations.sort()
 
-    # Print the header.
-    sys.stdout.write('# 1. Iteration')
-    icolumn = 1
-    for ivec in range(1,options.cutoff+1):
-        icolumn += 1 
-        header = str(icolumn) + '. Energy ' + str(ivec)
-        sys.stdout.write('%22s' % header)
-    sys.stdout.write('\n')
-
-    # Extract and print information for each iteration.
-    for iteration in iterations:
-        filename = stem + '.' + str(iteration)
-        nlowdin, energies = extract_data(filename, options.cutoff)
-        sys.stdout.write('     %9d' % iteration)
-        for energy in energies:
-            sys.stdout.write('   %19.12e' % energy)
+    # Read all of the files (or obtain them from the cache), using a pool
+    # of processes. The results are in the same order as the files.
+    filenames = [stem + '.' + str(iteration) for iteration in iterations]
+    all_data = lowdin.read_lowdin_files(filenames, options.jobs)
+
+    # Extract the eigenvalues for each iteration.
+    table = numpy.empty((len(iterations), options.cutoff+1))
+    table.fill(numpy.nan)
+    table[:,0] = iterations
+    lines = []
+    for (irow, (iteration, filename, data)) in \
+            enumerate(zip(iterations, filenames, all_data)):
+        nlowdin, energies = extract_data(filename, options.cutoff, data)
+        table[irow,1:len(energies)+1] = energies
+        line = ['     %9d' % iteration]
+        line.extend('   %19.12e' % energy for energy in energies)
         if nlowdin < options.cutoff:
-            for i in range(nlowdin+1, options.cutoff+1):
-                sys.stdout.write('            NaN       ')
-        sys.stdout.write('\n')
+            line.append('            NaN       ' * (options.cutoff - nlowdin))
+        lines.append(''.join(line))
+
+    # The header.
+    header = ['# 1. Iteration']
+    for ivec in range(1,options.cutoff+1):
+        header.append('%22s' % (str(ivec+1) + '. Energy ' + str(ivec)))
+
+    if options.output:
+        out = open(options.output, 'w')
+    else:
+        out = sys.stdout
+    out.write(''.join(header) + '\n')
+    out.write(''.join(line + '\n' for line in lines))
+    if options.output:
+        out.close()
+
+    if options.binary:
+        numpy.save(options.binary, table)
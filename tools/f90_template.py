@@ -6,6 +6,11 @@ effects of using templates/generic functions in a language such as c++
 Usage:
     f90_template.py [infile] [outfile]
 
+The first line of the output file records a hash of the template and of this
+script. If the output file is already up to date (i.e. neither has changed
+since it was written), it is left untouched, so that its modification time
+does not trigger the recompilation of everything which depends on it.
+
 The template files are split into two sections. The first is a config section.
 Each desired configuration is demarcated with a section header of the type:
 
@@ -78,7 +83,9 @@ templated, then it can be included here. See allocate_shared.F90.template.
 import os
 import sys
 import ConfigParser
+import hashlib
 import re
+import tempfile
 
 
 class file_like_list(list):
@@ -204,6 +211,46 @@ def super_module(template, config, silent):
     return template, super_mod
 
 
+# We split the template into sections for each function or subroutine
+re_tsplitter = re.compile("\n[^!\n]*(subroutine|function)", flags=re.IGNORECASE)
+
+# Locate any local interfaces.
+re_interfaces = re.compile("(\n[^!\n]*interface)((.|\n)+?)(\n[^!\n]*end\s+interface)")
+
+re_dim = re.compile('([\s,]*)dimension(\(.*\))')
+
+# The splitting points of the templates already processed.
+split_cache = dict()
+
+
+def split_locations(template):
+    """
+    Find the splitting points for the subroutines and functions in the
+    template, excluding those within interface statements. The interfaces
+    and procedures are each found in a single pass, and the (sorted) lists
+    are then merged. The result depends only on the template, so is reused
+    for each configuration.
+    """
+
+    if template in split_cache:
+        return split_cache[template]
+
+    spans = [(i.start(), i.end()) for i in re_interfaces.finditer(template)]
+
+    split_locs = []
+    j = 0
+    for s in re_tsplitter.finditer(template):
+        # Interfaces ending before this match cannot contain it (or any
+        # later match).
+        while j < len(spans) and spans[j][1] <= s.end():
+            j += 1
+        if not (j < len(spans) and s.start() > spans[j][0]):
+            split_locs.append(s.end()-2)
+
+    split_cache[template] = split_locs
+    return split_locs
+
+
 def adj_arrays(template, config):
     """
     Find all of the types we are specifying, and adjust references to their
@@ -215,7 +262,6 @@ def adj_arrays(template, config):
     # All possible types we are looking for. Only interested if the
     # dimensionality > 1 (i.e. we have to adjust the dimensions)
     types = dict()
-    re_dim = re.compile('([\s,]*)dimension(\(.*\))')
     for i in config:
         if i[0:4] == "type":
             if config[i][0] != "!":
@@ -237,23 +283,18 @@ def adj_arrays(template, config):
     # Vars contains tuples of (typename, dimensionality, dimstring) for each variable of
     # operable types beginning with 'type'.  dimstring is the string that was used for declaring the variable's dimensions
 
-    # We split the template into sections for each function or subroutine
-    tsplitter = re.compile("\n[^!\n]*(subroutine|function)", flags=re.IGNORECASE)
-
-    # Locate any local interfaces.
-    re_interfaces = re.compile("(\n[^!\n]*interface)((.|\n)+?)(\n[^!\n]*end\s+interface)")
-
     # Find splitting points for subroutines excluding those within
     # interface statements.
-    split_locs = []
-    for s in tsplitter.finditer(template):
-        interfaced = False
-        for i in re_interfaces.finditer(template):
-            if s.start() > i.start() and s.end() < i.end():
-                interfaced = True
-                break
-        if not interfaced:
-            split_locs.append(s.end()-2)
+    split_locs = split_locations(template)
+
+    # The patterns used for each type are the same for every section.
+    re_vars = dict()
+    re_fixes = dict()
+    for type in types:
+        re_vars[type] = re.compile ('\n\s*%%\(%s\)s.*::\s*([^()]*)([\s^\n]*\(([:,]*)\))*.*\n' % type)
+        re_fixes[type] = re.compile ('(\n\s*%%\(%s\)s.*::[\s^\n]*([^\(\)\n]*))'
+                                     '([\s^\n]*\(([^\(\)\n]|\(([^\(\)\n]|'
+                                     '\([^\(\)\n]*\))*\))*\))*' % type)
 
     newtemplate = template[:split_locs[0]]
     for i in range(len(split_locs)):
@@ -271,16 +312,16 @@ def adj_arrays(template, config):
         # (e.g. type1 = integer, dimension(:)) and the values being the
         # number of dimensions
         for type in types:
-                #re_var = re.compile ('\n\s*%%\(%s\)s.*::\s*([^()]*)([\s^\n]*\(([:,]*)\))*\n' % type)
-                re_var = re.compile ('\n\s*%%\(%s\)s.*::\s*([^()]*)([\s^\n]*\(([:,]*)\))*.*\n' % type)
+                re_var = re_vars[type]
 
                 # Search for lines of the form
                 # TYPE :: VARIABLE
                 # TYPE :: VARIABLE(:)
                 # TYPE :: VARIABLE(:,:) etc.
 
+                # Searches continue from the previous match, rather than
+                # rescanning (copies of) the remainder of the section.
                 v = re_var.search(templpart)
-                offset = 0
                 while v:
                     if v.group(2) == None:
                         vars[v.group(1)] = (type, types[type],"")
@@ -290,13 +331,11 @@ def adj_arrays(template, config):
                     # If we are sizing an array based on the size of another, remove
                     # this condition if the type is actually a scalar in this case.
                     if types[type] == 0 and v.group(2) == None:
-                        re_fix = re.compile ('(\n\s*%%\(%s\)s.*::[\s^\n]*([^\(\)\n]*))'
-                                             '([\s^\n]*\(([^\(\)\n]|\(([^\(\)\n]|'
-                                             '\([^\(\)\n]*\))*\))*\))*' % type)
-                        templpart = (templpart[0:v.start()+offset] +
-                        re_fix.sub("\\1", templpart[v.start()+offset:], 1))
-                    offset = offset + v.start() + 1
-                    v = re_var.search(templpart[offset:])
+                        m = re_fixes[type].search(templpart, v.start())
+                        if m:
+                            templpart = (templpart[0:m.start()] + m.group(1) +
+                                         templpart[m.end():])
+                    v = re_var.search(templpart, v.start() + 1)
 
         # vars is a dict with keys being the name of the variable and values
         # being (TYPE,TOTALDIMS,DIMSTRING)
@@ -342,6 +381,9 @@ def adj_arrays(template, config):
     split_ints = []
     last_end = 0
     new_template2 = ""
+    re_assumeds = dict()
+    for type in types:
+        re_assumeds[type] = re.compile ('(\n\s*%%\(%s\)s.*::\s*[^()]*)([\s^\n]*\(\*\))(.*\n)' % type)
     for s in re_interfaces.finditer (newtemplate):
 
         # Where does this interface start/end
@@ -358,18 +400,16 @@ def adj_arrays(template, config):
             # of it
             if types[type] == 0:
 
-                re_assumed = re.compile ('(\n\s*%%\(%s\)s.*::\s*[^()]*)([\s^\n]*\(\*\))(.*\n)' % type)
+                re_assumed = re_assumeds[type]
 
                 v = re_assumed.search(templpart)
-                offset = 0
                 while v:
 
                     # Fix this section by removing assumed-type parts
-                    templpart = (templpart[0:v.start()+offset] +
-                        re_assumed.sub("\\1\\3", templpart[v.start()+offset:], 1))
+                    templpart = (templpart[0:v.start()] + v.group(1) +
+                                 v.group(3) + templpart[v.end():])
 
-                    offset = offset + v.start() + 1
-                    v = re_assumed.search(templpart[offset:])
+                    v = re_assumed.search(templpart, v.start() + 1)
 
         # We want to start after this region.
         new_template2 += templpart
@@ -487,21 +527,73 @@ def process_file(fin, fout, silent=False, multifile=False):
     return filelist
 
 
+def template_hash(infile):
+    """
+    The line identifying the template and the version of this script used to
+    produce an output file.
+    """
+
+    sha = hashlib.sha1()
+    for fn in [os.path.abspath(__file__).replace('.pyc', '.py'), infile]:
+        with open(fn, 'rb') as f:
+            sha.update(f.read())
+    return '! Generated by f90_template.py: %s\n' % sha.hexdigest()
+
+
+def up_to_date(outfile, hash_line):
+    """
+    Was the output file produced from the same template and script?
+    """
+
+    try:
+        with open(outfile, 'r') as f:
+            return f.readline() == hash_line
+    except IOError:
+        return False
+
+
+def process_template(infile, outfile, silent=False):
+    """
+    Produce the output file from the template, unless it is already up to
+    date. The output is written to a temporary file, which then replaces the
+    output file, so that an incomplete file is never left (with a valid hash).
+    """
+
+    hash_line = template_hash(infile)
+    if up_to_date(outfile, hash_line):
+        if not silent:
+            print 'Output file is up to date'
+        return False
+
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(outfile)))
+    try:
+        fout = os.fdopen(fd, 'w')
+        fout.write(hash_line)
+        process_file(open(infile, 'r'), fout, silent)
+        umask = os.umask(0)
+        os.umask(umask)
+        os.chmod(tmp, 0666 & ~umask)
+        os.rename(tmp, outfile)
+    except:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+    return True
+
+
 # Runtime entry point
 if __name__ == '__main__':
     if len(sys.argv) < 2 or len(sys.argv) > 3:
         usage()
     else:
-        fin = open(sys.argv[1], 'r')
+        print 'Input file: %s' % (sys.argv[1])
         if len(sys.argv) == 2:
-            fout = sys.stdout
+            print 'Output file: %s' % (sys.stdout.name)
+            process_file(open(sys.argv[1], 'r'), sys.stdout, silent=False)
         else:
-            fout = open(sys.argv[2], 'w')
-
-        print 'Input file: %s' % (fin.name)
-        print 'Output file: %s' % (fout.name)
-
-        process_file(fin, fout, silent=False)
+            print 'Output file: %s' % (sys.argv[2])
+            process_template(sys.argv[1], sys.argv[2], silent=False)
 
 
 
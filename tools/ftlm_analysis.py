@@ -8,52 +8,86 @@ NECI from a KP-FCIQMC calculation.'''
 import sys
 import optparse
 import math
+import multiprocessing
+import numpy
+import lowdin
 
-def extract_data(data_files, cutoff):
+def extract_data(data_file, cutoff, data=None):
     '''Extract the eigenvalues and initial overlaps from the data file
-       provided.'''
-
-    start_str = 'Eigenvalues and overlaps when keeping '+str(cutoff)
-
-    f = open(data_file)
-    have_data = False
-    pairs = []
-    for line in f:
-        if not line.strip(): # If an empty line.
-            have_data = False
-        if have_data:
-            values = line.split()
-            pairs.append( [float(values[0]), float(values[1])] )
-        if start_str in line:
-            have_data = True
-
-    f.close()
-                
-    return pairs
+       provided. The contents of the file (from lowdin.py) may be passed in
+       data, if they have already been read.'''
+
+    if data is None:
+        data = lowdin.read_lowdin_files([data_file], 1)[0]
+
+    block = data.block(cutoff)
+    if block is None:
+        return []
+    return block[:,:2]
 
 def calc_energy_contrib(pairs, minval, maxval, delta_beta):
     '''Calculate the contribution to the estimates of Tr(\rho*H) and Tr(\rho)
        from the eigenvalues and initial overlaps input in pairs, for the beta
-       values calculated from minval, maxval and delta_beta.'''
-
-    nbeta = int(math.ceil((maxval-minval)/delta_beta))+1
+       values calculated from minval, maxval and delta_beta.
 
-    beta_list = []
-    energy_num_list = []
-    trace_list = []
+       To avoid overflow (or underflow) at large beta, the contributions
+       are calculated relative to the lowest eigenvalue, E_min, i.e. both
+       estimates are multiplied by exp(beta*E_min). E_min is also returned.'''
 
-    for i in range(nbeta):
-        beta = minval + i*delta_beta
-        energy_num = 0.0
-        trace = 0.0
-        for [eigv, init_overlap] in pairs:
-            energy_num += (init_overlap**2)*math.exp(-beta*eigv)*eigv
-            trace += (init_overlap**2)*math.exp(-beta*eigv)
-        beta_list.append(beta)
-        energy_num_list.append(energy_num)
-        trace_list.append(trace)
-
-    return beta_list, energy_num_list, trace_list
+    nbeta = int(math.ceil((maxval-minval)/delta_beta))+1
+    beta = minval + delta_beta*numpy.arange(nbeta)
+
+    data = numpy.asarray(pairs, dtype=float).reshape(-1, 2)
+    eigv = data[:,0]
+    weights = data[:,1]**2
+    shift = eigv.min()
+
+    boltzmann = numpy.exp(-numpy.outer(beta, eigv - shift))
+    energy_num = numpy.dot(boltzmann, weights*eigv)
+    trace = numpy.dot(boltzmann, weights)
+
+    return beta, energy_num, trace, shift
+
+def file_contrib(job):
+    '''Extract the data from a file and calculate its contributions (in a
+       worker process). Returns None if the file contains no data.'''
+
+    (data_file, data, options) = job
+    pairs = extract_data(data_file, options.cutoff, data)
+    if not len(pairs):
+        return None
+    return calc_energy_contrib(pairs, options.minval, options.maxval,
+                               options.delta)
+
+def combine_contribs(beta, numerators, traces, shifts):
+    '''Sum the contributions from several initial configurations, each
+       calculated relative to its own lowest eigenvalue (the corresponding
+       entry in shifts), and return the energy estimate for each beta.'''
+
+    # Rescale all contributions relative to the overall lowest eigenvalue.
+    # The factors are all <= 1, so can only underflow for contributions
+    # which are negligible.
+    scale = numpy.exp(-numpy.outer(shifts - shifts.min(), beta))
+    return (scale*numerators).sum(axis=0) / (scale*traces).sum(axis=0)
+
+def jackknife_error(beta, numerators, traces, shifts):
+    '''Estimate the error in the energy from the variation between the
+       initial configurations, using the jackknife (i.e. leaving out each
+       of the configurations in turn).'''
+
+    nconfigs = len(shifts)
+    if nconfigs < 2:
+        return numpy.zeros(len(beta))
+
+    energies = numpy.zeros((nconfigs, len(beta)))
+    keep = numpy.ones(nconfigs, dtype=bool)
+    for i in range(nconfigs):
+        keep[i] = False
+        energies[i] = combine_contribs(beta, numerators[keep], traces[keep],
+                                       shifts[keep])
+        keep[i] = True
+
+    return numpy.sqrt((nconfigs-1) * energies.var(axis=0))
 
 def parse_options(args):
 
@@ -67,6 +101,9 @@ def parse_options(args):
     parser.add_option('-l', '--lowdin-cutoff', dest='cutoff', type='int', default=5,
                       help='The number of eigenvectors to keep in the Lowdin '
                       'orthogonalisation procedure.')
+    parser.add_option('-j', '--jobs', dest='jobs', type='int', default=None,
+                      help='The number of files to process concurrently '
+                      '(default: the number of CPUs).')
     (options, filenames) = parser.parse_args(args)
     
     if len(filenames) == 0:
@@ -79,21 +116,41 @@ if __name__ == '__main__':
 
     (options, data_files) = parse_options(sys.argv[1:])
 
-    # Loop over each data file (each of which contains data from one initial
-    # configuration) and add in the contributions from each of those files.
-    for data_file in data_files:
-        # Extract the eigenvalues and overlaps with the intial Krylov vector.
-        pairs = extract_data(data_file, options.cutoff)
-        beta, numerator, trace = calc_energy_contrib(pairs, options.minval, options.maxval, options.delta)
-
-        try:
-            final_numerator = [ a + b for (a,b) in zip(final_numerator, numerator) ]
-            final_trace = [ a + b for (a,b) in zip(final_trace, trace) ]
-        except NameError:
-            # This is entered the first time.
-            final_numerator = numerator
-            final_trace = trace
-
-    print 'Beta    Energy'
-    for (beta, num, tr) in zip(beta, final_numerator, final_trace):
-        print beta, num/tr
+    # Each data file contains data from one initial configuration. Read them
+    # all (or obtain them from the cache), then calculate the contributions
+    # from each of those files concurrently.
+    all_data = lowdin.read_lowdin_files(data_files, options.jobs)
+    jobs = [(data_file, data, options)
+            for (data_file, data) in zip(data_files, all_data)]
+    if len(jobs) > 1:
+        nproc = min(options.jobs or multiprocessing.cpu_count(), len(jobs))
+        pool = multiprocessing.Pool(nproc)
+        results = pool.map(file_contrib, jobs)
+        pool.close()
+        pool.join()
+    else:
+        results = map(file_contrib, jobs)
+
+    for (data_file, res) in zip(data_files, results):
+        if res is None:
+            sys.stderr.write('No data found in %s, ignoring.\n' % data_file)
+    results = [res for res in results if res is not None]
+    if not results:
+        sys.exit(1)
+
+    beta = results[0][0]
+    numerators = numpy.array([res[1] for res in results])
+    traces = numpy.array([res[2] for res in results])
+    shifts = numpy.array([res[3] for res in results])
+
+    energy = combine_contribs(beta, numerators, traces, shifts)
+
+    if len(results) > 1:
+        error = jackknife_error(beta, numerators, traces, shifts)
+        print 'Beta    Energy    Error'
+        for (b, e, err) in zip(beta, energy, error):
+            print b, e, err
+    else:
+        print 'Beta    Energy'
+        for (b, e) in zip(beta, energy):
+            print b, e
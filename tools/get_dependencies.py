@@ -5,6 +5,9 @@ Analyse Fortran source code and output (in the dot language) the dependencies on
 Usage:
 
 get_dependencies.py [files containing source code]
+get_dependencies.py --critical-path [options] [files containing source code]
+get_dependencies.py --users MODULE [options] [files containing source code]
+get_dependencies.py --rebuild NAME [--rebuild NAME ...] [options] [files containing source code]
 
 Output in the dot language:
 * modules depending on other modules.
@@ -15,9 +18,30 @@ The resultant *.dot files are in the output_dir directory, as specified in the
 configuration section.  Graphs can be produced using a suitable parser.
 
 For more information on the dot langauge, see http://www.graphviz.org.
+
+With --critical-path, the dependencies between files (a file depends on the
+files defining the modules it uses, which must be compiled first) are used to
+find the longest chain of compilations, which limits how fast a parallel build
+(make -j, ninja) can be, the maximum speed-up achievable and the modules whose
+splitting would shorten this chain the most. The compile time of each file is
+estimated from its length, unless measured times are given with --times,
+either as a file of 'filename seconds' lines or a .ninja_log file. By default,
+all of the source files in src/ and src/lib/ are analysed.
+
+With --users, the files which use a module directly are listed.  With
+--rebuild, the files which must be recompiled if any of the given modules,
+source files or included files (e.g. macros.h) change are listed, i.e. the
+files containing them and everything which depends on those.  These are quick
+enough to be run from a pre-commit hook, for example
+    get_dependencies.py --rebuild src/FciMCPar.F90 --rebuild src/macros.h
+
+The scan of each file (the modules it defines and uses, its length and the
+files it includes) is cached in .dependencies_cache.json in the top-level
+directory, and only files which have changed (or whose included files have
+changed) since they were last scanned are read again, in parallel.
 '''
 
-import re,sys
+import glob,json,multiprocessing,optparse,os,re,sys,tempfile
 
 __author__='James Spencer'
 
@@ -38,6 +62,25 @@ data_modules='CalcData CPMDData IntegralsData SymData SystemData'.split()
 # Output directory for *.dot files containing dependencies. (Must exist.)
 output_dir='dependencies'
 
+# Source files analysed by --critical-path if none are given.
+src_dir=os.path.join(os.path.dirname(os.path.abspath(__file__)),'..','src')
+default_sources=['*.F90','*.F','*.F90.template','lib/*.F90','lib/*.F','lib/*.F90.template']
+
+# Directories searched for files included with #include, after the directory
+# of the including file.
+include_dirs=[os.path.normpath(src_dir),os.path.normpath(os.path.join(src_dir,'lib'))]
+
+# File in which the scans of the source files are cached.
+cache_file=os.path.normpath(os.path.join(src_dir,'..','.dependencies_cache.json'))
+
+# Files are only scanned in parallel if there are at least this many for each
+# process, as otherwise starting the processes takes longer than the scan.
+min_files_per_process=32
+
+# Rough compilation rate (lines of code per second) used to estimate the
+# compile time of files for which no time has been measured.
+lines_per_second=500.0
+
 #----------------------------------------------------------------------
 
 # Regular expressions for module types.
@@ -46,12 +89,16 @@ output_dir='dependencies'
 is_utility_object=re.compile('\\b%s\\b' % ('\\b|\\b'.join(utilities_modules)),re.I)
 is_data_object=re.compile('\\b%s\\b' % ('\\b|\\b'.join(data_modules)),re.I)
 
-# Regular expressions for the start, end and usage of modules.
-# Note that end of module detection relies on using 'end module' rather
-# than just 'end'.
-module_regex=re.compile('(^ *module )(\\b[a-z_]+\\b)',re.I)
+# Regular expressions for the start, end and usage of modules, the
+# configuration sections of templates and included files.  Module names may
+# contain digits, and module procedure statements are not the start of
+# modules.  Note that end of module detection relies on using 'end module'
+# rather than just 'end'.
+file_module_regex=re.compile('^\\s*module\\s+(?!procedure\\b)([a-z_]\\w*)\\s*(!.*)?$',re.I)
 end_module_regex=re.compile('end * module',re.I)
-use_regex=re.compile('(^ *use )(\\b[a-z_]+\\b)',re.I)
+file_use_regex=re.compile('^\\s*use(?:\\s*,\\s*non_intrinsic\\s*::|\\s*::|\\s+)\\s*([a-z_]\\w*)',re.I)
+template_section_regex=re.compile('^\\[(.*)\\]$')
+include_regex=re.compile('^\\s*#\\s*include\\s*["<]([^">]+)[">]')
 
 class use_sets(object):
     '''Store the dependency entries for dependencies on data, utility and all other modules in one handy object.'''
@@ -82,31 +129,21 @@ def output_dependencies(dep_name,dependencies):
     f.write('}')
     f.close()
 
-def main(file_list):
+def main(file_list,scans=None):
     '''Generate and output dependencies of the Fortran source code files in the file list.'''
     modules_dependencies=use_sets()
     files_dependencies=use_sets()
 
+    if scans is None:
+        scans=scan_files(file_list)
     for file in file_list:
-        is_module=False
-        source_code=open(file,'r').readlines()
-        for line in source_code:
-            line_search=re.findall(module_regex,line)
-            if line_search:
-                # We convert all module names to Title_Case to avoid 
-                # any issues with different cases being used.
-                module_name=line_search[0][1].title()
-                is_module=True
-            elif re.search(end_module_regex,line):
-                is_module=False
+        for (module_name,used_object) in scans[file]['uses']:
+            # We convert all module names to Title_Case to avoid 
+            # any issues with different cases being used.
+            if module_name:
+                update_use_list(module_name.title(),used_object.title(),modules_dependencies)
             else:
-                line_search=re.findall(use_regex,line)
-                if line_search:
-                    used_object=line_search[0][1].title()
-                    if is_module:
-                        update_use_list(module_name,used_object,modules_dependencies)
-                    else:
-                        update_use_list(file,used_object,files_dependencies)
+                update_use_list(file,used_object.title(),files_dependencies)
 
     output_dependencies('modules_use_data',modules_dependencies.data)
     output_dependencies('modules_use_main',modules_dependencies.main)
@@ -115,10 +152,369 @@ def main(file_list):
     output_dependencies('files_use_main',files_dependencies.main)
     output_dependencies('files_use_utilities',files_dependencies.utilities)
 
+def resolve_include(name,file):
+    '''Return the path of an included file, searched for in the directory of the including file and then include_dirs, or None if it is not found (e.g. a system header).'''
+    for dir in [os.path.dirname(os.path.abspath(file))]+include_dirs:
+        path=os.path.normpath(os.path.join(dir,name))
+        if os.path.isfile(path):
+            return path
+    return None
+
+def scan_file(file):
+    '''Scan a file, returning a dictionary of:
+
+modules: the modules defined (in lower case).
+uses: the (module, used module) pairs for each module used, where module is the module containing the use statement, or '' if it is outside any module.
+lines: the length of the file in lines.  For templates (*.F90.template), this is the length of the generated code, i.e. of the module section repeated for each configuration.
+includes: the files included with #include (directly or by included files) which could be found.
+
+Included files are scanned as if their contents replaced the #include line.'''
+    scan={'modules':[],'uses':[],'lines':0,'includes':[]}
+    uses=set()
+    nconfigs=0
+    in_config=file.endswith('.template')
+    module=''
+    pending=[(file,open(file,'r'))]
+    while pending:
+        (name,f)=pending[-1]
+        line=f.readline()
+        if not line:
+            f.close()
+            pending.pop()
+            continue
+        if in_config:
+            if line.startswith('='):
+                in_config=False
+            elif template_section_regex.match(line):
+                nconfigs+=1
+            continue
+        if len(pending)==1:
+            scan['lines']+=1
+        m=include_regex.match(line)
+        if m:
+            path=resolve_include(m.group(1),name)
+            if path and path not in scan['includes']:
+                scan['includes'].append(path)
+                pending.append((path,open(path,'r')))
+            continue
+        m=file_module_regex.match(line)
+        if m:
+            module=m.group(1).lower()
+            scan['modules'].append(module)
+            continue
+        if end_module_regex.search(line):
+            module=''
+            continue
+        m=file_use_regex.match(line)
+        if m and (module,m.group(1).lower()) not in uses:
+            uses.add((module,m.group(1).lower()))
+            scan['uses'].append((module,m.group(1).lower()))
+    scan['lines']*=max(nconfigs,1)
+    return scan
+
+class scan_cache(object):
+    '''The scans of source files, cached in a file (in JSON) and reused for as long as the modification time and size of each file, and of the files it includes, are unchanged.'''
+    cache_version=1
+    def __init__(self,cache_file):
+        self.cache_file=cache_file
+        self.entries={}
+        self.dirty=False
+        try:
+            cache=json.load(open(self.cache_file,'r'))
+            if cache['version']==self.cache_version:
+                self.entries=cache['files']
+        except (IOError,OSError,ValueError,KeyError,TypeError):
+            # A missing, old or corrupt cache is simply rebuilt.
+            self.entries={}
+    def save(self):
+        '''Write the cache file, if anything has changed.  Failure to do so is not an error.'''
+        if not self.dirty or not self.cache_file:
+            return
+        try:
+            (fd,tmp)=tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(self.cache_file)),suffix='.json')
+            f=os.fdopen(fd,'w')
+            json.dump({'version':self.cache_version,'files':self.entries},f)
+            f.close()
+            umask=os.umask(0)
+            os.umask(umask)
+            os.chmod(tmp,0666 & ~umask)
+            os.rename(tmp,self.cache_file)
+            self.dirty=False
+        except (IOError,OSError):
+            pass
+    def stamp(self,file):
+        '''The modification time and size of a file, or None if it does not exist.'''
+        try:
+            st=os.stat(file)
+        except OSError:
+            return None
+        return [st.st_mtime,st.st_size]
+    def get(self,file):
+        '''The cached scan of a file, or None if it is not (or no longer) valid.'''
+        entry=self.entries.get(os.path.abspath(file))
+        if entry is None or entry['stamp']!=self.stamp(file):
+            return None
+        for (include,stamp) in entry['include_stamps']:
+            if stamp!=self.stamp(include):
+                return None
+        return entry['scan']
+    def add(self,file,scan):
+        '''Store the scan of a file.'''
+        self.entries[os.path.abspath(file)]={'stamp':self.stamp(file),'include_stamps':[(include,self.stamp(include)) for include in scan['includes']],'scan':scan}
+        self.dirty=True
+
+def scan_files(file_list,cache_file=None,nproc=None):
+    '''Return the scans (see scan_file) of the files, keyed by file.  Files which are not already in the cache (if used) are scanned by a pool of nproc processes (default: the number of CPUs), if there are enough of them for this to be worthwhile.'''
+    cache=scan_cache(cache_file)
+    scans={}
+    stale=[]
+    for file in file_list:
+        scans[file]=cache.get(file)
+        if scans[file] is None:
+            stale.append(file)
+    if stale:
+        nproc=min(nproc or multiprocessing.cpu_count(),len(stale)//min_files_per_process)
+        if nproc>1:
+            pool=multiprocessing.Pool(nproc)
+            results=pool.map(scan_file,stale,max(len(stale)//(4*nproc),1))
+            pool.close()
+            pool.join()
+        else:
+            results=map(scan_file,stale)
+        for (file,scan) in zip(stale,results):
+            scans[file]=scan
+            cache.add(file,scan)
+        cache.save()
+    return scans
+
+def file_graph(file_list,scans=None):
+    '''Return the files each file depends on (those defining modules it uses), the file defining each module and the length of each file.'''
+    if scans is None:
+        scans=scan_files(file_list)
+    defined_in={}
+    for file in file_list:
+        for module in scans[file]['modules']:
+            defined_in[module]=file
+    deps={}
+    for file in file_list:
+        deps[file]=set(defined_in[m] for (user,m) in scans[file]['uses'] if m in defined_in)
+        deps[file].discard(file)
+    lengths=dict((file,scans[file]['lines']) for file in file_list)
+    return (deps,defined_in,lengths)
+
+class dependency_graph(object):
+    '''The dependencies between a set of source files, for answering queries about which files use a module and which must be recompiled if a file or module changes.'''
+    def __init__(self,file_list,scans=None):
+        if scans is None:
+            scans=scan_files(file_list)
+        self.scans=scans
+        (self.deps,self.defined_in,self.lengths)=file_graph(file_list,scans)
+        self.dependents=dict((file,set()) for file in file_list)
+        for file in file_list:
+            for dep in self.deps[file]:
+                self.dependents[dep].add(file)
+        self.includers={}
+        for file in file_list:
+            for include in scans[file]['includes']:
+                self.includers.setdefault(include,set()).add(file)
+    def modules(self,file):
+        '''The modules defined in a file.'''
+        return self.scans[file]['modules']
+    def find(self,name):
+        '''The source files corresponding to a name, which is either a module, a source file or a file included by the source files.'''
+        if name.lower() in self.defined_in:
+            return set([self.defined_in[name.lower()]])
+        path=os.path.abspath(name)
+        files=set(file for file in self.deps if os.path.abspath(file)==path)
+        return files | self.includers.get(path,set())
+    def users(self,name):
+        '''The files which use the module directly (or the modules defined in the file, if name is a file).  The module need not be defined in the source tree (e.g. mpi).'''
+        files=self.find(name)
+        if name.lower() in self.defined_in or not files:
+            modules=set([name.lower()])
+        else:
+            modules=set(m for file in files for m in self.modules(file))
+        return set(file for file in self.deps if any(m in modules for (user,m) in self.scans[file]['uses'])) - files
+    def rebuild(self,names):
+        '''The files which must be recompiled if any of the named modules or files change: the files containing them (or including them) and all of the files which depend on those, directly or indirectly.'''
+        stack=[file for name in names for file in self.find(name)]
+        found=set(stack)
+        while stack:
+            for file in self.dependents[stack.pop()]:
+                if file not in found:
+                    found.add(file)
+                    stack.append(file)
+        return found
+
+def read_times(times_file):
+    '''Read measured compile times, either from a file of 'filename seconds' lines or from a .ninja_log file, keyed by the base name of the source file.'''
+    times={}
+    lines=open(times_file,'r').readlines()
+    ninja=lines and lines[0].startswith('# ninja log')
+    for line in lines:
+        fields=line.split()
+        if not fields or fields[0].startswith('#'):
+            continue
+        if ninja:
+            # start (ms), end (ms), mtime, output, command hash
+            if not fields[3].endswith('.o'):
+                continue
+            name=os.path.basename(fields[3])[:-2]
+            times[name]=(int(fields[1])-int(fields[0]))/1000.0
+        else:
+            times[os.path.basename(fields[0])]=float(fields[1])
+    return times
+
+def compile_times(file_list,lengths,measured):
+    '''The (measured or estimated) compile time of each file, and the number of files whose times were measured.'''
+    times={}
+    nmeasured=0
+    for file in file_list:
+        name=os.path.basename(file)
+        for key in (name,name.replace('.template','')):
+            if key in measured:
+                times[file]=measured[key]
+                nmeasured+=1
+                break
+        else:
+            times[file]=lengths[file]/lines_per_second
+    return (times,nmeasured)
+
+def topological_order(deps):
+    '''Order the files so that each comes after all of the files it depends on.  Dependency cycles (which cannot be compiled, so indicate misdetected modules) are broken, with a warning.'''
+    order=[]
+    state={}
+    for start in sorted(deps):
+        stack=[(start,iter(sorted(deps[start])))]
+        if start in state:
+            continue
+        state[start]='visiting'
+        while stack:
+            (file,children)=stack[-1]
+            for child in children:
+                if child not in state:
+                    state[child]='visiting'
+                    stack.append((child,iter(sorted(deps[child]))))
+                    break
+                elif state[child]=='visiting':
+                    sys.stderr.write('Warning: dependency cycle between %s and %s ignored.\n' % (file,child))
+            else:
+                stack.pop()
+                state[file]='done'
+                order.append(file)
+    return order
+
+def schedule(deps,times,order,split=None,split_fraction=0.5):
+    '''Return the earliest start and finish of each file with unlimited parallelism, and the file on which the start of each waits.
+
+If split is given, the files which depend on it only wait for split_fraction of its compile time, as if it had been split into smaller modules.'''
+    start={}
+    finish={}
+    waits_on={}
+    for file in order:
+        start[file]=0.0
+        waits_on[file]=None
+        for dep in deps[file]:
+            if dep not in finish:
+                continue # cycle
+            ready=finish[dep]
+            if dep==split:
+                ready=start[dep]+split_fraction*times[dep]
+            if ready>start[file]:
+                start[file]=ready
+                waits_on[file]=dep
+        finish[file]=start[file]+times[file]
+    return (start,finish,waits_on)
+
+def peak_parallelism(start,finish):
+    '''The largest number of files compiling at once, with unlimited parallelism.'''
+    events=sorted([(t,1) for t in start.values()]+[(t,-1) for t in finish.values()],key=lambda e:(e[0],e[1]))
+    (n,peak)=(0,0)
+    for (t,change) in events:
+        n+=change
+        peak=max(peak,n)
+    return peak
+
+def critical_path(file_list,times_file=None,ntop=10,split_fraction=0.5,scans=None):
+    '''Print the critical path through the compilation of the files, the achievable parallelism and the modules whose splitting would shorten the path most.'''
+    (deps,defined_in,lengths)=file_graph(file_list,scans)
+    measured=read_times(times_file) if times_file else {}
+    (times,nmeasured)=compile_times(file_list,lengths,measured)
+    order=topological_order(deps)
+    (start,finish,waits_on)=schedule(deps,times,order)
+
+    last=max(finish,key=lambda f:finish[f])
+    length=finish[last]
+    path=[last]
+    while waits_on[path[-1]] is not None:
+        path.append(waits_on[path[-1]])
+    path.reverse()
+    work=sum(times.values())
+
+    print 'Files: %i, modules: %i, dependencies: %i' % (len(file_list),len(defined_in),sum(len(d) for d in deps.values()))
+    print 'Compile times: %i measured, %i estimated from the length of the source' % (nmeasured,len(file_list)-nmeasured)
+    print 'Total compile time: %.1fs' % work
+    print 'Critical path: %.1fs (%i files)' % (length,len(path))
+    print 'Maximum speed-up from parallel compilation: %.2f' % (work/length if length else 1)
+    print 'Peak number of files compiling at once: %i' % peak_parallelism(start,finish)
+    print
+    print 'Critical path:'
+    print '%9s %9s  %s' % ('Start','Time','File')
+    for file in path:
+        print '%9.1f %9.1f  %s' % (start[file],times[file],file)
+
+    # Splitting a module allows the files which use it to start earlier.
+    # Only the files on the critical path can shorten it.
+    dependents=set(d for f in file_list for d in deps[f])
+    savings=[]
+    for file in path:
+        if file in dependents:
+            finish_split=schedule(deps,times,order,file,split_fraction)[1]
+            savings.append((length-max(finish_split.values()),file))
+    savings.sort(reverse=True)
+    print
+    print 'Modules whose splitting would most shorten the critical path (assuming the files using them need only %i%% of each):' % (100*split_fraction)
+    print '%9s  %s' % ('Saving','File (modules)')
+    for (saving,file) in savings[:ntop]:
+        if saving>0:
+            print '%9.1f  %s (%s)' % (saving,file,', '.join(m for m in defined_in if defined_in[m]==file))
+
+def query(file_list,users=None,rebuild=None,scans=None):
+    '''Print the files which use the module users directly, or which must be recompiled if any of the modules or files in rebuild change.'''
+    graph=dependency_graph(file_list,scans)
+    if users:
+        found=graph.users(users)
+    else:
+        found=graph.rebuild(rebuild)
+    for file in sorted(found):
+        print file
+
+def parse_options(args):
+    '''Parse the command line options.'''
+    parser=optparse.OptionParser(usage=__doc__)
+    parser.add_option('-c','--critical-path',action='store_true',default=False,help='Analyse the critical path of the compilation, rather than writing dot files.')
+    parser.add_option('-t','--times',default=None,help='File containing measured compile times (filename seconds), or a .ninja_log file.')
+    parser.add_option('-n','--top',type='int',default=10,help='Number of modules to list whose splitting would shorten the critical path.  Default: %default.')
+    parser.add_option('-s','--split-fraction',type='float',default=0.5,help='Fraction of the compile time of a split module which the files using it must still wait for.  Default: %default.')
+    parser.add_option('-u','--users',default=None,metavar='MODULE',help='List the files which use MODULE directly.  MODULE may be a module from outside the source tree (e.g. mpi).')
+    parser.add_option('-r','--rebuild',action='append',default=[],metavar='NAME',help='List the files which must be recompiled if NAME (a module, source file or included file) changes.  May be given more than once.')
+    parser.add_option('-j','--jobs',type='int',default=None,help='Number of processes used to scan files.  Default: the number of CPUs.')
+    parser.add_option('--no-cache',action='store_true',default=False,help='Scan all of the files, rather than using (and updating) the cache of previous scans.')
+    (options,file_list)=parser.parse_args(args)
+    if not file_list:
+        if not (options.critical_path or options.users or options.rebuild):
+            parser.print_help()
+            sys.exit()
+        file_list=sorted(f for pattern in default_sources for f in glob.glob(os.path.join(src_dir,pattern)))
+        file_list=[os.path.relpath(f) for f in file_list]
+    return (options,file_list)
+
 if __name__=='__main__':
-    if len(sys.argv)==1 or sys.argv[1]=='-h' or sys.argv[1]=='--h' or sys.argv[1]=='-help' or sys.argv[1]=='--help':
-        print __doc__ # Wow.  Magic...
-        sys.exit()
+    (options,file_list)=parse_options(sys.argv[1:])
+    scans=scan_files(file_list,None if options.no_cache else cache_file,options.jobs)
+    if options.critical_path:
+        critical_path(file_list,options.times,options.top,options.split_fraction,scans)
+    elif options.users or options.rebuild:
+        query(file_list,options.users,options.rebuild,scans)
     else:
-        file_list=sys.argv[1:]
-        main(file_list)
+        main(file_list,scans)
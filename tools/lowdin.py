@@ -0,0 +1,282 @@
+'''Read the lowdin.* (and gram_schmidt.*) files output by NECI in KP-FCIQMC
+calculations, for use by the analysis scripts (spectral_analysis.py,
+ftlm_analysis.py, extract_eigv.py).
+
+Each file is read once, and all of its contents are extracted: the norm of
+the unperturbed initial wave function, the overlap matrix eigenvalues and the
+eigenvalues and overlaps for every Lowdin cutoff. Any cutoff can then be
+selected without reading the file again.
+
+The extracted data for all of the files in a directory is cached in a single
+file in that directory (.lowdin_cache.npz), and is reused for as long as the
+modification time and size of each file are unchanged.
+'''
+
+import multiprocessing
+import os
+import re
+import tempfile
+import numpy
+
+norm_str = 'Norm of unperturbed initial wave function'
+overlap_str = 'Overlap matrix eigenvalues'
+re_block = re.compile('Eigenvalues and overlaps when keeping\s*(\d+)')
+
+
+class lowdin_data:
+    '''
+    The contents of a Lowdin file. The blocks are (nkeep x ncols) arrays
+    containing the eigenvalues, the overlaps with the initial vector and
+    (if present) the overlaps with the perturbed ground state, for each
+    number of eigenvectors kept.
+    '''
+
+    def __init__ (self, norm, overlap_eigv, blocks):
+        self.norm = norm
+        self.overlap_eigv = overlap_eigv
+        self.blocks = blocks
+
+    def cutoffs (self):
+        '''The Lowdin cutoffs for which there is data'''
+
+        return sorted(self.blocks)
+
+    def block (self, cutoff):
+        '''The data for a given cutoff, or None if it is not present'''
+
+        return self.blocks.get(cutoff, None)
+
+    def npositive (self):
+        '''The number of positive overlap matrix eigenvalues (i.e. the
+           largest possible cutoff)'''
+
+        return int((self.overlap_eigv > 0).sum())
+
+
+def parse_lowdin (filename):
+    '''Read all of the data from a Lowdin file, in a single pass'''
+
+    norm = None
+    overlap = []
+    blocks = dict()
+
+    section = None
+    with open(filename) as f:
+        for line in f:
+            if not line.strip():
+                section = None
+            elif line.startswith('----'):
+                # The start of a new section
+                section = 'unknown'
+                m = re_block.search(line)
+                if m:
+                    section = blocks.setdefault(int(m.group(1)), [])
+                elif norm_str in line:
+                    section = 'norm'
+                elif overlap_str in line:
+                    section = 'overlap'
+            elif line.startswith('#'):
+                pass
+            elif section == 'norm':
+                norm = float(line.split()[0])
+            elif section == 'overlap':
+                overlap.append(line.split()[0])
+            elif isinstance(section, list):
+                section.append(line)
+
+    # Each block has a row for each of the eigenvectors kept. A block which
+    # is empty or incomplete (e.g. at the end of a file which is still being
+    # written) is dropped.
+    for cutoff, rows in list(blocks.items()):
+        block = _parse_block(rows)
+        if block is None or len(block) != cutoff:
+            del blocks[cutoff]
+        else:
+            blocks[cutoff] = block
+
+    return lowdin_data(norm, numpy.array(overlap, dtype=float), blocks)
+
+
+def _parse_block (rows):
+    '''Convert the lines of a block into an (nrows x ncols) array, with the
+       number of columns given by the first line. Returns None if there are
+       no lines, or if any of them are not complete.'''
+
+    if not rows:
+        return None
+    ncols = len(rows[0].split())
+    vals = numpy.fromstring(' '.join(rows), sep=' ')
+    if ncols == 0 or len(vals) != len(rows) * ncols or \
+            any(len(r.split()) != ncols for r in rows):
+        return None
+    return vals.reshape(len(rows), ncols)
+
+
+class lowdin_cache:
+    '''
+    The cached contents of the Lowdin files in a directory. The data for all
+    files is stored in a single set of flat arrays, with offsets for each
+    file and block.
+    '''
+
+    cache_name = '.lowdin_cache.npz'
+    cache_version = 1
+
+    def __init__ (self, dirname):
+        self.dirname = dirname
+        self.cache_file = os.path.join(dirname, self.cache_name)
+        self.entries = dict()
+        self.dirty = False
+
+        try:
+            self.load()
+        except Exception:
+            # A missing, old or corrupt cache is simply rebuilt.
+            self.entries = dict()
+
+    def load (self):
+        '''Read the cache file, if there is one'''
+
+        if not os.path.isfile(self.cache_file):
+            return
+
+        cache = numpy.load(self.cache_file)
+        if int(cache['version']) != self.cache_version:
+            return
+
+        files = cache['files']
+        stamps = cache['stamps']
+        norms = cache['norms']
+        overlap_data = cache['overlap_data']
+        overlap_offsets = cache['overlap_offsets']
+        block_file = cache['block_file']
+        block_cutoff = cache['block_cutoff']
+        block_shape = cache['block_shape']
+        block_offsets = cache['block_offsets']
+        block_data = cache['block_data']
+
+        blocks = [dict() for fn in files]
+        for i in range(len(block_file)):
+            blocks[block_file[i]][int(block_cutoff[i])] = \
+                    block_data[block_offsets[i]:block_offsets[i+1]].reshape(
+                            block_shape[i])
+
+        for i, fn in enumerate(files):
+            norm = None if numpy.isnan(norms[i]) else float(norms[i])
+            overlap = overlap_data[overlap_offsets[i]:overlap_offsets[i+1]]
+            self.entries[str(fn)] = (tuple(stamps[i]),
+                                     lowdin_data(norm, overlap, blocks[i]))
+
+    def save (self):
+        '''Write the cache file, if anything has changed. Failure to do so is
+           not an error.'''
+
+        if not self.dirty:
+            return
+
+        files = sorted(fn for fn in self.entries
+                       if os.path.isfile(os.path.join(self.dirname, fn)))
+        stamps = []
+        norms = []
+        overlaps = []
+        block_file = []
+        block_cutoff = []
+        block_shape = []
+        block_data = []
+        for i, fn in enumerate(files):
+            stamp, data = self.entries[fn]
+            stamps.append(stamp)
+            norms.append(numpy.nan if data.norm is None else data.norm)
+            overlaps.append(data.overlap_eigv)
+            for cutoff in data.cutoffs():
+                block = data.block(cutoff)
+                block_file.append(i)
+                block_cutoff.append(cutoff)
+                block_shape.append(block.shape)
+                block_data.append(block.ravel())
+
+        offsets = lambda arrs: numpy.cumsum([0] + [len(a) for a in arrs])
+        concat = lambda arrs: numpy.concatenate(arrs) if arrs else \
+                                  numpy.zeros(0)
+
+        try:
+            fd, tmp = tempfile.mkstemp(dir=self.dirname, suffix='.npz')
+            with os.fdopen(fd, 'wb') as f:
+                numpy.savez(f, version=self.cache_version,
+                            files=numpy.array(files, dtype=str),
+                            stamps=numpy.array(stamps, dtype=float).reshape(-1, 2),
+                            norms=numpy.array(norms, dtype=float),
+                            overlap_data=concat(overlaps),
+                            overlap_offsets=offsets(overlaps),
+                            block_file=numpy.array(block_file, dtype=int),
+                            block_cutoff=numpy.array(block_cutoff, dtype=int),
+                            block_shape=numpy.array(block_shape, dtype=int).reshape(-1, 2),
+                            block_offsets=offsets(block_data),
+                            block_data=concat(block_data))
+            umask = os.umask(0)
+            os.umask(umask)
+            os.chmod(tmp, 0666 & ~umask)
+            os.rename(tmp, self.cache_file)
+            self.dirty = False
+        except (IOError, OSError):
+            pass
+
+    def stamp (self, filename):
+        '''The modification time and size of a file'''
+
+        st = os.stat(filename)
+        return (float(st.st_mtime), float(st.st_size))
+
+    def get (self, filename):
+        '''The cached data for a file, or None if it is not (or no longer)
+           valid.'''
+
+        entry = self.entries.get(os.path.basename(filename), None)
+        if entry is not None and entry[0] == self.stamp(filename):
+            return entry[1]
+        return None
+
+    def add (self, filename, data):
+        '''Store the data for a file'''
+
+        self.entries[os.path.basename(filename)] = (self.stamp(filename), data)
+        self.dirty = True
+
+
+def read_lowdin_files (filenames, nproc=None):
+    '''Return the data (lowdin_data objects) for each of the files, in the
+       same order. Files which are not already cached are read using a pool
+       of nproc processes (default: the number of CPUs).'''
+
+    caches = dict()
+    results = [None] * len(filenames)
+    stale = []
+    for i, fn in enumerate(filenames):
+        dirname = os.path.dirname(os.path.abspath(fn))
+        if dirname not in caches:
+            caches[dirname] = lowdin_cache(dirname)
+        results[i] = caches[dirname].get(fn)
+        if results[i] is None:
+            stale.append(i)
+
+    if stale:
+        names = [filenames[i] for i in stale]
+        nproc = min(nproc or multiprocessing.cpu_count(), len(names))
+        if nproc > 1:
+            pool = multiprocessing.Pool(nproc)
+            parsed = pool.map(parse_lowdin, names,
+                              max(len(names) // (4*nproc), 1))
+            pool.close()
+            pool.join()
+        else:
+            parsed = map(parse_lowdin, names)
+
+        for i, data in zip(stale, parsed):
+            results[i] = data
+            fn = filenames[i]
+            caches[os.path.dirname(os.path.abspath(fn))].add(fn, data)
+
+    for cache in caches.values():
+        cache.save()
+
+    return results
@@ -4,30 +4,44 @@ Produce a directory of output files suitable for incorporation into molcas
 from the NECI source code
 
 Usage:
-    molcas_prep.py [NECI directory] [tgt_directory]
+    molcas_prep.py [options] [NECI directory] [tgt_directory]
 
 Note - this script creates the target directory, which must not exist prior to
-running it. This protects against accidental overwriting of files.
+running it. This protects against accidental overwriting of files. The only
+exception is a target directory produced by an earlier run of this script,
+which is updated in place.
 
 --> Runs the templating engine to produce .F90 files from the .F90.template files
 --> Renames all .F* files to .f* for the molcas build system
 --> Ensures that each file contains only one module. This requires splitting files
     up.
+
+The files are processed in parallel. A manifest of the hash of each source file
+and the files produced from it is kept in the target directory, so that
+updating an existing target directory only processes the source files which
+have changed, and removes the files produced from sources which no longer
+exist. Target files whose contents are unchanged are not rewritten.
 """
 
+import hashlib
+import json
+import multiprocessing
+import optparse
 import os
 import sys
 import shutil
 import re
+import tempfile
 import f90_template
 import subprocess
 
 
-def usage():
-    """
-    Prints the usage description for the program
-    """
-    print __doc__
+# The manifest of source hashes and the files produced from them
+manifest_name = '.molcas_prep_manifest.json'
+manifest_version = 1
+
+# The start of a module (but not of a module procedure statement)
+re_module = re.compile(r'\s*module\s+(?!procedure\b)[a-z_]\w*', re.IGNORECASE)
 
 
 def file_error():
@@ -38,6 +52,29 @@ def file_error():
     sys.exit(-1)
 
 
+def write_if_changed(tgt_file, contents):
+    """
+    Write the contents to the target file, unless it already contains exactly
+    this. Leaving unchanged files untouched avoids molcas rebuilding them.
+    """
+    try:
+        with open(tgt_file, 'r') as fin:
+            if fin.read() == contents:
+                return
+    except IOError:
+        pass
+
+    with open(tgt_file, 'w') as fout:
+        fout.write(contents)
+
+
+def count_modules(lines):
+    """
+    Count the modules in a file, a line at a time
+    """
+    return sum(1 for line in lines if re_module.match(line))
+
+
 def process_f(dir, fn, tgt_dir, tmp_dir):
     """
     Process a .F file for molcas-suitability
@@ -50,9 +87,9 @@ def process_f(dir, fn, tgt_dir, tmp_dir):
     # Ensure the molcas wrapping header is inserted at the top of all files
     with open(src_file, 'r') as fin:
         contents = fin.read()
-        with open(tgt_file, 'w') as fout:
-            fout.write('#include "molcas_wrapper.h"\n')
-            fout.write(contents)
+    write_if_changed(tgt_file, '#include "molcas_wrapper.h"\n' + contents)
+
+    return [os.path.basename(tgt_file)]
 
 
 def process_f90(dir, fn, tgt_dir, tmp_dir):
@@ -68,23 +105,22 @@ def process_f90(dir, fn, tgt_dir, tmp_dir):
     assert src_file != tgt_file
 
     # We wish to test how many modules are in the specified file.
-    re_mod = re.compile('(\s*module(.|\n)*?\n\s*end module)', re.IGNORECASE)
     with open(src_file, 'r') as fin:
-        contents = fin.read()
-        found_mods = re_mod.findall(contents)
-
-        # If there is only one module (or fewer) in the file, then we can just copy this
-        # file directly.
-        if len(found_mods) in (0, 1):
-            # Ensure the molcas wrapping header is inserted at the top of all files
-            with open(tgt_file, 'w') as fout:
-                fout.write('#include "molcas_wrapper.h"\n')
-                fout.write(contents)
-        else:
-            # We wish to move all modules other than the _last_ module into other
-            # files.
-            print "Rejecting F90 file {0} with {1} modules".format(src_file, len(found_mods))
-            return
+        nmods = count_modules(fin)
+
+    # If there is only one module (or fewer) in the file, then we can just copy this
+    # file directly.
+    if nmods in (0, 1):
+        # Ensure the molcas wrapping header is inserted at the top of all files
+        with open(src_file, 'r') as fin:
+            contents = fin.read()
+        write_if_changed(tgt_file, '#include "molcas_wrapper.h"\n' + contents)
+        return [os.path.basename(tgt_file)]
+    else:
+        # We wish to move all modules other than the _last_ module into other
+        # files.
+        print "Rejecting F90 file {0} with {1} modules".format(src_file, nmods)
+        return []
 
 
 def process_f90_template(dir, fn, tgt_dir, tmp_dir):
@@ -103,9 +139,11 @@ def process_f90_template(dir, fn, tgt_dir, tmp_dir):
             filelist = f90_template.process_file(fin, fout, silent=True, multifile=True)
 
     # Now we process this as though it were a normal F90 file
+    outputs = []
     for written_fn in filelist:
         name = os.path.basename(written_fn)
-        process_f90(tmp_dir, name, tgt_dir, tmp_dir)
+        outputs += process_f90(tmp_dir, name, tgt_dir, tmp_dir)
+    return outputs
 
 
 def process_cpp(dir, fn, tgt_dir, tmp_dir):
@@ -117,45 +155,116 @@ def process_cpp(dir, fn, tgt_dir, tmp_dir):
     """
     root, ext = os.path.splitext(fn)
     if root in ['parallel_helper', 'allocate_shared_worker']:
-        return;
+        return [];
 
     src_file = os.path.join(dir, fn)
     tgt_file = os.path.join(tgt_dir, "{0}.c".format(root.lower()))
-    shutil.copyfile(src_file, tgt_file)
+    with open(src_file, 'r') as fin:
+        write_if_changed(tgt_file, fin.read())
+
+    return [os.path.basename(tgt_file)]
 
-def append_git_version(tgt_file):
+def git_version():
     """
-    Add VCS_VERSION to the molcas_wrapper.h file
+    The hash of the current git commit
     """
     p = subprocess.Popen('git log --max-count=1 --pretty=format:%H', shell=True, stdout=subprocess.PIPE)
     p.wait()
-    shaid = p.stdout.read()
-
-    with open(tgt_file, 'a') as fout:
-       fout.write('\n#ifdef _MOLCAS_\n#define _VCS_VER %r \n#endif\n' % shaid)
+    return p.stdout.read()
 
 def file_direct_copy(dir, fn, tgt_dir, tmp_dir):
     """
-    Directly copy the specified file into the target directory
+    Directly copy the specified file into the target directory. The
+    molcas_wrapper.h file also has VCS_VERSION added to it.
     """
     src_file = os.path.join(dir, fn)
     tgt_file = os.path.join(tgt_dir, fn.lower())
-    shutil.copyfile(src_file, tgt_file)
-    
+    with open(src_file, 'r') as fin:
+        contents = fin.read()
+
     if fn == 'molcas_wrapper.h':
-        append_git_version(tgt_file)
+        contents += '\n#ifdef _MOLCAS_\n#define _VCS_VER %r \n#endif\n' % git_version()
+
+    write_if_changed(tgt_file, contents)
+    return [os.path.basename(tgt_file)]
 
 
 def drop_file(dir, fn, tgt_dir, tmp_dir):
     """
     The specified file should not be used!
     """
-    pass
+    return []
+
+
+def process_one(task):
+    """
+    Process a single file, given (handler, dir, fn, tgt_dir, tmp_dir), in a
+    worker process. Returns the names of the files produced.
+    """
+    handler, dir, fn, tgt_dir, tmp_dir = task
+    return handler(dir, fn, tgt_dir, tmp_dir)
+
+
+def source_hash(dir, fn, tools_hash):
+    """
+    The hash of a source file, combined with the hash of the tools used to
+    process it (and the git version, for molcas_wrapper.h)
+    """
+    h = hashlib.sha1(tools_hash)
+    with open(os.path.join(dir, fn), 'rb') as fin:
+        h.update(fin.read())
+    if fn == 'molcas_wrapper.h':
+        h.update(git_version())
+    return h.hexdigest()
+
+
+def get_tools_hash():
+    """
+    The hash of this script and the templating engine, so that any change to
+    how the files are processed causes them all to be processed again
+    """
+    h = hashlib.sha1()
+    for module in (sys.modules[__name__], f90_template):
+        fn = os.path.splitext(module.__file__)[0] + '.py'
+        with open(fn, 'rb') as fin:
+            h.update(fin.read())
+    return h.hexdigest()
+
+
+def read_manifest(tgt_dir):
+    """
+    Read the manifest from an earlier run in the target directory. An old or
+    unreadable manifest is treated as empty, so that everything is processed
+    again.
+    """
+    try:
+        with open(os.path.join(tgt_dir, manifest_name), 'r') as fin:
+            manifest = json.load(fin)
+        if manifest['version'] == manifest_version:
+            return manifest['files']
+    except (IOError, ValueError, KeyError, TypeError):
+        pass
+    return {}
+
+
+def write_manifest(tgt_dir, files):
+    """
+    Write the manifest to the target directory
+    """
+    fd, tmp = tempfile.mkstemp(dir=tgt_dir, suffix='.json')
+    with os.fdopen(fd, 'w') as fout:
+        json.dump({'version': manifest_version, 'files': files}, fout,
+                  indent=0, sort_keys=True)
+    umask = os.umask(0)
+    os.umask(umask)
+    os.chmod(tmp, 0666 & ~umask)
+    os.rename(tmp, os.path.join(tgt_dir, manifest_name))
 
 
-def process_files(src_dir, tgt_dir, tmp_dir):
+def process_files(src_dir, tgt_dir, tmp_dir, nproc=None):
     """
-    Do the actual file processing
+    Do the actual file processing, using a pool of nproc processes (default:
+    the number of CPUs)
     """
 
     # This is the mapping for how the files ought to be treated
@@ -167,40 +276,93 @@ def process_files(src_dir, tgt_dir, tmp_dir):
         'h': file_direct_copy
     }
 
-    # Ensure that the target and tmp directories exist
-    os.mkdir(tgt_dir)
+    # Ensure that the target and tmp directories exist. An existing target
+    # directory may only be updated if it was produced by this script.
+    if os.path.exists(tgt_dir):
+        if not os.path.isfile(os.path.join(tgt_dir, manifest_name)):
+            print "Target directory {0} exists, and was not produced by this script".format(tgt_dir)
+            sys.exit(-1)
+    else:
+        os.mkdir(tgt_dir)
+    if os.path.exists(tmp_dir):
+        shutil.rmtree(tmp_dir)
     os.mkdir(tmp_dir)
 
-    # Ensure that the target directory is clean
+    old_manifest = read_manifest(tgt_dir)
+    manifest = {}
+    tools_hash = get_tools_hash()
 
-    # List the files present in the directory (be recursive)
+    # List the files present in the directory (be recursive), and find those
+    # which have changed since the last run.
+    tasks = []
     for root, dirs, files in os.walk(src_dir, onerror=file_error):
         for fn in files:
             try:
                 # Determine what to do by the files extension. If unknown, then
                 # discard the file.
                 ext = fn.split('.', 1)[1]
-                file_map.get(ext, drop_file)(root, fn, tgt_dir, tmp_dir)
+                handler = file_map.get(ext, drop_file)
             except IndexError:
                 # Files with no index should be dropped
-                drop_file(root, fn, tgt_dir, tmp_dir)
+                handler = drop_file
+            if handler is drop_file:
+                continue
+
+            src_file = os.path.relpath(os.path.join(root, fn), src_dir)
+            file_hash = source_hash(root, fn, tools_hash)
+            entry = old_manifest.get(src_file)
+            if entry and entry['hash'] == file_hash and \
+                    all(os.path.isfile(os.path.join(tgt_dir, out)) for out in entry['outputs']):
+                manifest[src_file] = entry
+            else:
+                manifest[src_file] = {'hash': file_hash, 'outputs': []}
+                tasks.append((src_file, (handler, root, fn, tgt_dir, tmp_dir)))
+
+    # Process the changed files
+    nproc = min(nproc or multiprocessing.cpu_count(), len(tasks))
+    if nproc > 1:
+        pool = multiprocessing.Pool(nproc)
+        outputs = pool.map(process_one, [task for (src_file, task) in tasks], 1)
+        pool.close()
+        pool.join()
+    else:
+        outputs = [process_one(task) for (src_file, task) in tasks]
+    for (src_file, task), written in zip(tasks, outputs):
+        manifest[src_file]['outputs'] = written
+
+    # Remove the files produced from sources which no longer exist (or which
+    # no longer produce them)
+    current = set(out for entry in manifest.values() for out in entry['outputs'])
+    removed = set(out for entry in old_manifest.values() for out in entry['outputs']) - current
+    for out in removed:
+        if os.path.isfile(os.path.join(tgt_dir, out)):
+            os.remove(os.path.join(tgt_dir, out))
+
+    write_manifest(tgt_dir, manifest)
+    print "Processed {0} files ({1} unchanged), removed {2} files".format(
+            len(tasks), len(manifest) - len(tasks), len(removed))
 
     # Remove the temporary files directory
     shutil.rmtree(tmp_dir)
 
 
 if __name__ == '__main__':
-    if len(sys.argv) != 3:
-        usage()
+    parser = optparse.OptionParser(usage=__doc__)
+    parser.add_option('-j', '--jobs', type='int', default=None,
+                      help='Number of processes used to process the files '
+                      '(default: the number of CPUs).')
+    (options, args) = parser.parse_args()
+    if len(args) != 2:
+        parser.print_help()
         sys.exit(-1)
 
-    src_dir = os.path.join(sys.argv[1], 'src')
-    tgt_dir = sys.argv[2]
+    src_dir = os.path.join(args[0], 'src')
+    tgt_dir = args[1]
     tmp_dir = os.path.join(tgt_dir, 'tmpfiles')
     print "Source directory: ", src_dir
     print "Target directory: ", tgt_dir
     print "Temporary directory: ", tmp_dir
 
     # And kick off the calculation
-    process_files(src_dir, tgt_dir, tmp_dir)
+    process_files(src_dir, tgt_dir, tmp_dir, options.jobs)
 
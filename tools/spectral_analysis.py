@@ -10,43 +10,31 @@ in NECI.'''
 import sys
 import optparse
 import math
+import multiprocessing
+import numpy
+import lowdin
 
-def extract_data_lowdin(data_file, cutoff):
+def extract_data_lowdin(data_file, cutoff, data=None):
     '''Extract the eigenvalues and transition amplitudes from the data file
        provided, which should have been produced from a Lowdin
-       orthogonalisation.'''
+       orthogonalisation. The contents of the file (from lowdin.py) may be
+       passed in data, if they have already been read.'''
 
-    norm_str = 'Norm of unperturbed initial wave function'
-    start_str = 'Eigenvalues and overlaps when keeping ' + str(cutoff)
+    if data is None:
+        data = lowdin.read_lowdin_files([data_file], 1)[0]
 
-    have_data = False
-    have_norm = False
-    triples = []
-
-    f = open(data_file)
+    block = data.block(cutoff)
+    if block is None:
+        block = numpy.zeros((0, 2))
+    if data.norm is None:
+        raise ValueError('No norm of the unperturbed wave function found in '
+                         + data_file)
 
-    for line in f:
-        if not line.strip(): # If an empty line.
-            have_data = False
-            have_norm = False
-        if have_data:
-            values = line.split()
-            if len(values) == 2:
-                triples.append( [float(values[0]), float(values[1]),
-                                 float(values[1])] )
-            if len(values) == 3:
-                triples.append( [float(values[0]), float(values[1]),
-                                 float(values[2])] )
-        if have_norm:
-            unperturbed_norm = float(line.strip())
-        if start_str in line:
-            have_data = True
-        if norm_str in line:
-            have_norm = True
+    # If there is no overlap with the perturbed ground state, the same
+    # overlap is used on both sides.
+    triples = block[:,[0, 1, 1]] if block.shape[1] == 2 else block[:,:3]
 
-    f.close()
-                
-    return triples, unperturbed_norm
+    return triples, data.norm
 
 def extract_data_std(data_file):
     '''Extract the eigenvalues and transition amplitudes from the data file
@@ -71,33 +59,223 @@ def extract_data_std(data_file):
 
     return triples, unperturbed_norm
 
+def spectral_weights(triples, norm, inc_ground):
+    '''Return the eigenvalues and the (normalised) spectral weights as
+       arrays, optionally excluding the ground state.'''
+
+    # Do we include the ground state eigenvector?
+    if inc_ground:
+        min_eigv = 0
+    else:
+        min_eigv = 1
+
+    data = numpy.asarray(triples, dtype=float).reshape(-1, 3)[min_eigv:]
+    return data[:,0], (data[:,1]/norm) * (data[:,2]/norm)
+
+def broadening_kernel(x, broadening, kernel='lorentzian'):
+    '''The normalised broadening function, either a Lorentzian with
+       half-width broadening or a Gaussian with standard deviation
+       broadening.'''
+
+    if kernel == 'gaussian':
+        return numpy.exp(-0.5*(x/broadening)**2) / \
+                   (broadening*math.sqrt(2*math.pi))
+    else:
+        return broadening/(math.pi*(broadening**2 + x**2))
+
+def sum_kernels(omega, poles, weights, broadening, kernel='lorentzian',
+                chunk_size=1<<22):
+    '''Sum the broadened peaks with the given positions and weights at each
+       of the frequencies omega. If a list of broadenings is given, a
+       spectrum is returned for each of them.
+
+       This is done for a block of frequencies at a time, with blocks of
+       around chunk_size (frequency, peak) pairs so that the memory used
+       remains bounded.'''
+
+    broadenings = numpy.atleast_1d(broadening)
+    spectrum = numpy.zeros((len(broadenings), len(omega)))
+    block = max(chunk_size // max(len(poles), 1), 1)
+    for i in range(0, len(omega), block):
+        diff = omega[i:i+block,numpy.newaxis] - poles
+        for j, b in enumerate(broadenings):
+            spectrum[j,i:i+block] = numpy.dot(
+                    broadening_kernel(diff, b, kernel), weights)
+
+    if numpy.ndim(broadening) == 0:
+        spectrum = spectrum[0]
+    return spectrum
+
 def calculate_spectral_function(triples, norm, minval, maxval, delta,
-                                broadening, ref_energy, inc_ground):
+                                broadening, ref_energy, inc_ground,
+                                kernel='lorentzian'):
     '''Calculate and return the spectral function for the eigenvalues and
        spectral weights input, for the frequency values calculated from
-       minval, maxval and delta.'''
+       minval, maxval and delta.
+
+       If lists of broadenings and/or reference energies are given, the
+       spectra for all of them are calculated together, and returned in an
+       array of shape (nbroadening, nref, nomega).'''
 
     nomega = int(math.ceil((maxval-minval)/delta))+1
+    omega = minval + delta*numpy.arange(nomega)
 
-    # Do we include the ground state eigenvector?
-    if inc_ground:
-        min_eigv = 0
+    # A change in the reference energy just shifts the frequencies.
+    refs = numpy.atleast_1d(ref_energy)
+    omega_ref = (omega + refs[:,numpy.newaxis]).ravel()
+
+    eigv, weights = spectral_weights(triples, norm, inc_ground)
+    spectrum = sum_kernels(omega_ref, eigv, weights,
+                           numpy.atleast_1d(broadening), kernel)
+    spectrum = spectrum.reshape(-1, len(refs), nomega)
+
+    if numpy.ndim(ref_energy) == 0:
+        spectrum = spectrum[:,0]
+    if numpy.ndim(broadening) == 0:
+        spectrum = spectrum[0]
+    return omega, spectrum
+
+def calculate_spectral_function_binned(triples, norm, minval, maxval, delta,
+                                       broadening, ref_energy, inc_ground,
+                                       kernel='lorentzian', tolerance=1e-4,
+                                       max_grid=1<<20, nsample=16):
+    '''As calculate_spectral_function, but the spectral weights are first
+       binned onto a fine uniform grid of frequencies (by linear
+       interpolation between the two closest grid points), and the binned
+       weights are then convolved with the broadening function using FFTs.
+       The cost is then independent of the number of eigenvalues.
+
+       The grid spacing is chosen so that the interpolation error is below
+       tolerance relative to the height of a single peak (for the Lorentzian
+       this bound is h^2/(4 broadening^2), and for the Gaussian it is
+       h^2/(8 broadening^2)). The grid extends beyond the requested frequency
+       range to cover the eigenvalues, up to max_grid points. Any peaks which
+       remain outside of the grid are summed exactly.
+
+       Returns the frequencies and spectrum, together with the relative error
+       bound and the largest relative error found by comparing against the
+       exact sum at (up to) nsample of the frequencies.'''
+
+    nomega = int(math.ceil((maxval-minval)/delta))+1
+    omega = minval + delta*numpy.arange(nomega)
+
+    eigv, weights = spectral_weights(triples, norm, inc_ground)
+    poles = eigv - ref_energy
+
+    # The fine grid must include each of the output frequencies.
+    curv = 4.0 if kernel != 'gaussian' else 8.0
+    oversample = int(math.ceil(delta / (broadening*math.sqrt(curv*tolerance))))
+    oversample = max(oversample, 1)
+    h = delta / oversample
+    err_bound = h**2 / (curv*broadening**2)
+
+    # Pad the grid to include as many of the peaks as possible.
+    npts = (nomega-1)*oversample + 1
+    pad_lo = pad_hi = 0
+    if len(poles):
+        pad_lo = int(math.ceil((minval - poles.min()) / h))
+        pad_hi = int(math.ceil((poles.max() - omega[-1]) / h))
+    spare = max(max_grid - npts, 0) // 2
+    pad_lo = min(max(pad_lo, 0), spare)
+    pad_hi = min(max(pad_hi, 0), spare)
+    ngrid = pad_lo + npts + pad_hi
+    x0 = minval - pad_lo*h
+
+    # Bin the weights.
+    u = (poles - x0) / h
+    inside = (u >= 0) & (u <= ngrid-1)
+    ind = numpy.minimum(numpy.floor(u[inside]).astype(int), max(ngrid-2, 0))
+    frac = u[inside] - ind
+    w = weights[inside]
+    binned = numpy.bincount(ind, w*(1-frac), minlength=ngrid)[:ngrid]
+    if ngrid > 1:
+        binned[1:] += numpy.bincount(ind+1, w*frac, minlength=ngrid)[1:ngrid]
+
+    # Convolve with the kernel, sampled at all of the grid separations.
+    kern = broadening_kernel(h*numpy.arange(-(ngrid-1), ngrid), broadening,
+                             kernel)
+    nfft = 1 << int(math.ceil(math.log(3*ngrid-2, 2)))
+    conv = numpy.fft.irfft(numpy.fft.rfft(binned, nfft) *
+                           numpy.fft.rfft(kern, nfft), nfft)
+    spectrum = conv[ngrid-1+pad_lo:ngrid-1+pad_lo+npts:oversample]
+
+    # Add the peaks which did not fit on the grid.
+    if not inside.all():
+        spectrum += sum_kernels(omega, poles[~inside], weights[~inside],
+                                broadening, kernel)
+
+    # Check against the exact result at a sample of the frequencies.
+    sample = numpy.unique(numpy.linspace(0, nomega-1, min(nsample, nomega)
+                                         ).astype(int))
+    exact = sum_kernels(omega[sample], poles, weights, broadening, kernel)
+    scale = max(abs(exact).max(), 1e-300) if len(exact) else 1.0
+    err_sample = abs(spectrum[sample] - exact).max() / scale if len(exact) \
+                     else 0.0
+
+    return omega, spectrum, err_bound, err_sample
+
+def is_spectral_data(data_file):
+    '''Is this a SPECTRAL_DATA file (rather than a Lowdin file)?'''
+
+    f = open(data_file)
+    first_line = f.readline()
+    f.close()
+    # If 'Eigenvalues' is in the first line of the file then it is a
+    # SPECTRAL_DATA file.
+    return 'Eigenvalues' in first_line
+
+def read_data(data_file, cutoff, data=None):
+    '''Extract the eigenvalues and transition amplitudes from either a
+       SPECTRAL_DATA or a Lowdin file.'''
+
+    if data is None and is_spectral_data(data_file):
+        return extract_data_std(data_file)
     else:
-        min_eigv = 1
+        return extract_data_lowdin(data_file, cutoff, data)
+
+def file_spectra(job):
+    '''Read a data file (unless the contents of a Lowdin file are given),
+       and calculate the spectra for each of the broadenings and reference
+       energies in options (in a worker process).
+
+       Returns the frequencies, the spectra in an array of shape
+       (nbroadening, nref, nomega) and, for binned spectra, the largest
+       error bound and sampled error.'''
+
+    (data_file, data, options) = job
+    triples, norm = read_data(data_file, options.cutoff, data)
+
+    if options.binned:
+        spectra = []
+        errors = []
+        for broadening in options.broadening:
+            for ref_energy in options.ref_energy:
+                (omega, spectrum, err_bound, err_sample) = \
+                        calculate_spectral_function_binned(triples, norm,
+                                         options.minval, options.maxval,
+                                         options.delta, broadening,
+                                         ref_energy, options.inc_ground,
+                                         options.kernel, options.tolerance)
+                spectra.append(spectrum)
+                errors.append((err_bound, err_sample))
+        spectra = numpy.array(spectra).reshape(len(options.broadening),
+                                               len(options.ref_energy), -1)
+        errors = tuple(numpy.max(errors, axis=0))
+    else:
+        omega, spectra = calculate_spectral_function(triples, norm,
+                                         options.minval, options.maxval,
+                                         options.delta,
+                                         options.broadening,
+                                         options.ref_energy,
+                                         options.inc_ground, options.kernel)
+        errors = None
 
-    omega_list = []
-    spectral_list = []
-    for i in range(nomega):
-        omega = minval + i*delta
-        spec = 0.0
-        for [eigv, left_unnormalised_amp, right_unnormalised_amp] in triples[min_eigv:]:
-            left_amp = left_unnormalised_amp/norm
-            right_amp = right_unnormalised_amp/norm
-            spec += (broadening*left_amp*right_amp)/(math.pi*(broadening**2 + (omega+ref_energy-eigv)**2))
-        omega_list.append(omega)
-        spectral_list.append(spec)
+    return omega, spectra, errors
 
-    return omega_list, spectral_list
+def parse_list(option, opt_str, value, parser):
+    '''Store a comma-separated list of floats for an option.'''
+
+    setattr(parser.values, option.dest, [float(v) for v in value.split(',')])
 
 def parse_options(args):
 
@@ -113,14 +291,39 @@ def parse_options(args):
                       'for.')
     parser.add_option('-d', '--delta-omega', dest='delta', type='float',
                       default=0.01, help='The resolution in omega to plot.')
-    parser.add_option('-b', '--broadening', dest='broadening', type= 'float',
-                      default=0.1, help='The broadening factor to be used.')
+    parser.add_option('-b', '--broadening', dest='broadening', type='string',
+                      action='callback', callback=parse_list, default=[0.1],
+                      help='The broadening factor to be used. A '
+                      'comma-separated list may be given, to calculate the '
+                      'spectrum for each of them.')
+    parser.add_option('-k', '--kernel', dest='kernel', type='choice',
+                      choices=['lorentzian', 'gaussian'], default='lorentzian',
+                      help='The broadening function to use: lorentzian '
+                      '(default), or gaussian, in which case the broadening '
+                      'is the standard deviation.')
+    parser.add_option('--binned', action='store_true', dest='binned',
+                      default=False, help='Bin the spectral weights onto a '
+                      'fine grid and broaden them using FFTs, rather than '
+                      'summing over every eigenvalue at each frequency. This '
+                      'is much faster for large numbers of eigenvalues.')
+    parser.add_option('--tolerance', dest='tolerance', type='float',
+                      default=1e-4, help='The relative error allowed in '
+                      'the binned spectrum.')
     parser.add_option('-l', '--lowdin-cutoff', dest='cutoff', type='int',
                       default=5, help='The number of eigenvectors which were '
                       'kept in the Lowdin orthogonalisation procedure.')
-    parser.add_option('-r', '--ref-energy', dest='ref_energy', type='float', 
-                      default=0.0, help='The ground-state energy of the '
-                      'unperturbed system.')
+    parser.add_option('-r', '--ref-energy', dest='ref_energy', type='string',
+                      action='callback', callback=parse_list, default=[0.0],
+                      help='The ground-state energy of the unperturbed '
+                      'system. A comma-separated list may be given, to '
+                      'calculate the spectrum for each of them.')
+    parser.add_option('-o', '--output', dest='output', default=None,
+                      help='Write all of the spectra, for each file, '
+                      'broadening and reference energy, to this file as '
+                      'numpy arrays (.npz), rather than printing them.')
+    parser.add_option('-j', '--jobs', dest='jobs', type='int', default=None,
+                      help='The number of files to process concurrently '
+                      '(default: the number of CPUs).')
     parser.add_option('--flip', action='store_true', dest='flip', default=False,
                       help='Flip the spectrum about zero on the x-axis.')
     (options, filenames) = parser.parse_args(args)
@@ -134,25 +337,47 @@ def parse_options(args):
 if __name__ == '__main__':
     (options, data_files) = parse_options(sys.argv[1:])
 
-    for data_file in data_files:
-        f = open(data_file)
-        first_line = f.readline()
-        f.close()
-        # If 'Eigenvalues' is in the first line of the file then it is a
-        # SPECTRAL_DATA file, so call the appropriate function.
-        if 'Eigenvalues' in first_line:
-            triples, norm = extract_data_std(data_file)
-        else:
-            triples, norm = extract_data_lowdin(data_file, options.cutoff)
+    # Lowdin files are read (or obtained from the cache) together, as all of
+    # the files in a directory share the same cache.
+    lowdin_files = [f for f in data_files if not is_spectral_data(f)]
+    lowdin_data = dict(zip(lowdin_files,
+                           lowdin.read_lowdin_files(lowdin_files, options.jobs)))
+
+    jobs = [(data_file, lowdin_data.get(data_file, None), options)
+            for data_file in data_files]
+    if len(jobs) > 1:
+        nproc = min(options.jobs or multiprocessing.cpu_count(), len(jobs))
+        pool = multiprocessing.Pool(nproc)
+        results = pool.map(file_spectra, jobs)
+        pool.close()
+        pool.join()
+    else:
+        results = map(file_spectra, jobs)
 
-    omega, spectrum = calculate_spectral_function(triples, norm, options.minval,
-                                         options.maxval, options.delta,
-                                         options.broadening, options.ref_energy,
-                                         options.inc_ground)
+    omega = results[0][0]
+    spectra = numpy.array([spectra for (omega_f, spectra, errors) in results])
+
+    for (data_file, (omega_f, spectra_f, errors)) in zip(data_files, results):
+        if errors is not None:
+            sys.stderr.write('%s: binned spectrum: relative error bound '
+                             '%.3g, largest relative error found %.3g\n' %
+                             ((data_file,) + errors))
 
     if (options.flip):
         omega *= -1
 
-    print 'Omega    Spectrum'
-    for (freq, spec) in zip(omega, spectrum):
-        print freq, spec
+    if options.output:
+        # spectra has shape (nfiles, nbroadening, nref, nomega)
+        numpy.savez(options.output, omega=omega, spectra=spectra,
+                    files=data_files, broadening=options.broadening,
+                    ref_energy=options.ref_energy)
+    else:
+        columns = [(f, b, r) for f in data_files for b in options.broadening
+                             for r in options.ref_energy]
+        if len(columns) == 1:
+            print 'Omega    Spectrum'
+        else:
+            print 'Omega    ' + '    '.join('%s:b=%s:E=%s' % c for c in columns)
+        spectra = spectra.reshape(len(columns), -1)
+        for (freq, spec) in zip(omega, spectra.T):
+            print freq, ' '.join(str(v) for v in spec)
@@ -0,0 +1,197 @@
+#!/usr/bin/python
+'''benchmark_tools.py [options] [benchmark ...]
+
+Time the analysis scripts in utils/ and tools/ on synthetic data of various
+sizes (written by synthetic_data.py). The benchmarks are:
+
+    split_pops     - split_pops.py split 4, on a binary POPSFILE.
+    pops_count     - pops_count.py, on a binary POPSFILE.
+    pops_largest   - pops_largest.py, on a text POPSFILE.
+    blocking       - blocking.py on the shift in an FCIMCStats file.
+    plot3_read     - The FCIMCStats reader of plot3.py (read_cols).
+    plot3_replicas - As plot3_read, for a file with four replicas.
+    spectral_data  - spectral_analysis.py on a SPECTRAL_DATA file.
+    spectral_lowdin - spectral_analysis.py on a Lowdin file.
+
+By default, all of the benchmarks are run. The size is the number of
+determinants, iterations, eigenvalues or lines in the data file. The largest
+sizes (10^8 rows) need tens of GB of disk space, and some of the scripts take
+hours on them, so only modest sizes are used by default.
+
+The timings can be saved (--save) and compared against a previous set of
+timings (--compare), to check whether a change has made the scripts faster
+or slower.'''
+
+import json
+import optparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import synthetic_data
+
+utils_dir = os.path.dirname(os.path.abspath(__file__))
+tools_dir = os.path.join(utils_dir, '..', 'tools')
+
+# The code run by plot3_read: plot3 selects a non-interactive backend when
+# given --batch.
+plot3_read = ("import sys; sys.argv = ['plot3.py', '--batch']; "
+              "sys.path.insert(0, %r); import plot3; "
+              "plot3.read_cols(open('FCIMCStats'))" % utils_dir)
+
+# Each benchmark gives the kind of data used (and the number of replicas),
+# the command run (in the data directory, with 'python' replaced by the
+# interpreter used) and any files it writes, which are removed after each
+# run.
+benchmarks = [
+    ('split_pops', 'popsfile_bin', 1,
+     ['python', os.path.join(utils_dir, 'split_pops.py'), 'split', '4'],
+     ['POPSFILEBIN-%i' % i for i in range(4)]),
+    ('pops_count', 'popsfile_bin', 1,
+     ['python', os.path.join(utils_dir, 'pops_count.py')], []),
+    ('pops_largest', 'popsfile', 1,
+     ['python', os.path.join(utils_dir, 'pops_largest.py'), 'POPSFILE'], []),
+    ('blocking', 'fcimcstats', 1,
+     ['python', os.path.join(utils_dir, 'blocking.py'), '-t', '-i', '0',
+      '-d', '4', 'FCIMCStats'], []),
+    ('plot3_read', 'fcimcstats', 1, ['python', '-c', plot3_read], []),
+    ('plot3_replicas', 'fcimcstats', 4, ['python', '-c', plot3_read], []),
+    ('spectral_data', 'spectral_data', 1,
+     ['python', os.path.join(tools_dir, 'spectral_analysis.py'),
+      'SPECTRAL_DATA', '-b', '0.05'], []),
+    ('spectral_lowdin', 'lowdin', 1,
+     ['python', os.path.join(tools_dir, 'spectral_analysis.py'), 'lowdin.1',
+      '-b', '0.05', '-l', '10'], ['.lowdin_cache.npz']),
+]
+
+
+class data_options:
+    '''The options passed to the data generators.'''
+
+    def __init__ (self, replicas, seed=7):
+        self.replicas = replicas
+        self.pert = False
+        self.seed = seed
+
+
+def data_dir (top, kind, replicas, size):
+    '''The directory containing the data of a given kind and size.'''
+
+    name = '%s_%i' % (kind, size)
+    if replicas > 1:
+        name += '_r%i' % replicas
+    return os.path.join(top, name)
+
+
+def run_benchmark (benchmark, size, top, python, repeat):
+    '''Run a benchmark on data of the given size, generating the data if
+       needed. Returns the fastest of repeat timings, or None if the command
+       failed.'''
+
+    (name, kind, replicas, cmd, outputs) = benchmark
+    dirname = data_dir(top, kind, replicas, size)
+    synthetic_data.generate(kind, size, dirname, data_options(replicas))
+
+    cmd = [python if c == 'python' else c for c in cmd]
+    best = None
+    devnull = open(os.devnull, 'w')
+    for i in range(repeat):
+        start = time.time()
+        status = subprocess.call(cmd, cwd=dirname, stdout=devnull,
+                                 stderr=devnull)
+        elapsed = time.time() - start
+        for fn in outputs:
+            if os.path.exists(os.path.join(dirname, fn)):
+                os.remove(os.path.join(dirname, fn))
+        if status != 0:
+            best = None
+            break
+        best = elapsed if best is None else min(best, elapsed)
+    devnull.close()
+
+    return best
+
+
+def parse_sizes (option, opt_str, value, parser):
+    '''Parse a comma-separated list of sizes (e.g. 1e5,1e6).'''
+
+    setattr(parser.values, option.dest,
+            [int(float(v)) for v in value.split(',')])
+
+
+def parse_options (args):
+    '''Read and return the benchmarks to run and any options present.'''
+
+    parser = optparse.OptionParser(usage = __doc__)
+    parser.add_option('-s', '--sizes', type='string', action='callback',
+                      callback=parse_sizes, default=[10**5, 10**6],
+                      help='Comma-separated list of data sizes '
+                      '(default: 1e5,1e6).')
+    parser.add_option('-r', '--repeat', type='int', default=3,
+                      help='Report the fastest of this many runs '
+                      '(default: %default).')
+    parser.add_option('-d', '--data-dir', default=None,
+                      help='Keep the generated data in this directory, and '
+                      'reuse any already there (default: a temporary '
+                      'directory, removed afterwards).')
+    parser.add_option('-p', '--python', default=sys.executable,
+                      help='The python interpreter used to run the scripts '
+                      '(default: %default).')
+    parser.add_option('--save', default=None,
+                      help='Save the timings to this (JSON) file.')
+    parser.add_option('--compare', default=None,
+                      help='Compare the timings against those saved in this '
+                      'file.')
+    (options, names) = parser.parse_args(args)
+
+    known = [b[0] for b in benchmarks]
+    for name in names:
+        if name not in known:
+            parser.error('unknown benchmark: %s' % name)
+
+    return (options, names)
+
+
+if __name__ == '__main__':
+    (options, names) = parse_options(sys.argv[1:])
+
+    previous = dict()
+    if options.compare:
+        with open(options.compare) as f:
+            previous = json.load(f)
+
+    top = options.data_dir or tempfile.mkdtemp(prefix='neci_bench_')
+    results = dict()
+    try:
+        fmt = '%-16s %10s %10s %12s %10s\n'
+        sys.stdout.write(fmt % ('Benchmark', 'Size', 'Time (s)', 'Rows/s',
+                                'Change'))
+        for benchmark in benchmarks:
+            if names and benchmark[0] not in names:
+                continue
+            for size in options.sizes:
+                key = '%s:%i' % (benchmark[0], size)
+                elapsed = run_benchmark(benchmark, size, top, options.python,
+                                        options.repeat)
+                results[key] = elapsed
+                change = ''
+                if previous.get(key) and elapsed is not None:
+                    change = '%+.1f%%' % (100*(elapsed/previous[key] - 1))
+                if elapsed is None:
+                    sys.stdout.write(fmt % (benchmark[0], size, 'FAILED', '',
+                                            ''))
+                else:
+                    sys.stdout.write(fmt % (benchmark[0], size,
+                                            '%.3f' % elapsed,
+                                            '%.4g' % (size/elapsed), change))
+                sys.stdout.flush()
+    finally:
+        if not options.data_dir:
+            shutil.rmtree(top)
+
+    if options.save:
+        with open(options.save, 'w') as f:
+            json.dump(results, f, indent=0, sort_keys=True)
@@ -0,0 +1,108 @@
+'''Reduce long data series to the number of points that can actually be
+displayed, for use by the plotting scripts (plot.py, plot3.py).
+
+The data in each of a number of buckets (one per horizontal pixel of the
+axes) is replaced by its minimum and maximum values, in the order in which
+they occur. This retains the visible envelope of the data, so that spikes in
+the walker number or shift are still shown, while matplotlib only has to
+draw a few thousand points per line.
+
+The full-resolution data is retained, so that the lines can be decimated
+again for the visible region when zooming in.
+'''
+
+from numpy import *
+
+
+def min_max_decimate (x, y, nbins, xlim=None):
+    '''Reduce the series (x, y) to approximately 2*nbins points, retaining
+       the minimum and maximum of y in each of nbins buckets of consecutive
+       points.
+
+       If xlim is given (and x is sorted), only points within these limits
+       are considered, together with one point either side of them so that
+       lines continue to the edges of the axes.'''
+
+    x = asarray(x)
+    y = asarray(y)
+    lo, hi = 0, len(x)
+
+    # Restrict to the visible region.
+    if xlim is not None and hi > 1 and (diff(x) >= 0).all():
+        lo = max(searchsorted(x, min(xlim)) - 1, 0)
+        hi = min(searchsorted(x, max(xlim), side='right') + 1, hi)
+
+    # Nothing to be gained from decimating
+    nbins = max(int(nbins), 1)
+    n = hi - lo
+    if n <= 4 * nbins:
+        return x[lo:hi], y[lo:hi]
+
+    # Split the points into buckets of k consecutive points. The remainder
+    # forms a final, smaller, bucket.
+    k = n // nbins
+    m = n // k
+    buckets = y[lo:lo+m*k].reshape(m, k)
+    base = lo + arange(m) * k
+    imin = base + buckets.argmin(axis=1)
+    imax = base + buckets.argmax(axis=1)
+
+    ind = [[lo], minimum(imin, imax), maximum(imin, imax)]
+    if lo + m*k < hi:
+        tail = y[lo+m*k:hi]
+        ind.append([lo + m*k + tail.argmin(), lo + m*k + tail.argmax()])
+    ind.append([hi-1])
+
+    ind = unique(concatenate(ind))
+    return x[ind], y[ind]
+
+
+class decimated_lines:
+    '''
+    Plot lines using decimated data, retaining the full-resolution data so
+    that they can be decimated again when the visible region of the axes
+    (or the size of the figure) changes.
+    '''
+
+    def __init__ (self, enabled=True):
+        self.enabled = enabled
+        self.data = dict()
+
+    def reduce (self, ax, x, y, xlim=None):
+        '''Decimate (x, y) to one bucket per pixel of the axes ax'''
+
+        if not self.enabled:
+            return x, y
+        nbins = ax.get_window_extent().width
+        return min_max_decimate(x, y, nbins, xlim)
+
+    def plot (self, ax, x, y, *args, **kwargs):
+        '''As ax.plot, for a single line. Returns the line.'''
+
+        xd, yd = self.reduce(ax, x, y)
+        line = ax.plot(xd, yd, *args, **kwargs)[0]
+        self.data[line] = (x, y)
+        return line
+
+    def set_data (self, line, x, y):
+        '''Replace the data of an existing line'''
+
+        self.data[line] = (x, y)
+        line.set_data(*self.reduce(line.axes, x, y))
+
+    def update (self, xlim=None):
+        '''Decimate all of the lines again for the current axis limits. As
+           the limits of shared axes are only updated after the xlim_changed
+           callbacks are processed, the new limits may be given explicitly.'''
+
+        if not self.enabled:
+            return
+        for line in self.data:
+            x, y = self.data[line]
+            lim = xlim if xlim is not None else line.axes.get_xlim()
+            line.set_data(*self.reduce(line.axes, x, y, lim))
+
+    def clear (self):
+        '''Forget about all of the lines (e.g. after the axes are cleared)'''
+
+        self.data = dict()
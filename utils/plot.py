@@ -36,6 +36,8 @@ Arguments:
 	--no-shift, -S      Don't plot the shift
 	--time, -t          Plot using cumulative time rather than iteration on x-axis
 	--no-walkers, -W    Don't plot walker numbers
+	--no-decimate       Plot every data point, rather than the minimum and maximum
+	                    values for each pixel of the plot.
 '''
 
 from pylab import *
@@ -46,6 +48,7 @@ import matplotlib.axes
 import getopt
 import re
 import time
+from decimation import decimated_lines
 
 class plotter:
 	def __init__ (self):
@@ -75,13 +78,14 @@ class plotter:
 		self.plot_shift = True
 		self.plot_projE = True
 		self.eps_out = None
+		self.lines = decimated_lines()
 
 	def proc_args (self, args):
 		'''Read in the command line options. For default arguments see __init__'''
 
 		# Use getopt to process the arguments
 		try:
-			opts, self.files = getopt.getopt(args, "htalE:efFWsI:O:cro:R:L:SPp:", ["help", "time", "average", "linear", "total-energy", "energy-limits=", "atom-first", "final", "no-walkers", "split", "iterations=", "output-file=", "reset-colours", "reset-colors", "print-ref-E", "E-other=", "repeat", "legend-pos", "no-shift", "no-projE", "eps="])
+			opts, self.files = getopt.getopt(args, "htalE:efFWsI:O:cro:R:L:SPp:", ["help", "time", "average", "linear", "total-energy", "energy-limits=", "atom-first", "final", "no-walkers", "split", "iterations=", "output-file=", "reset-colours", "reset-colors", "print-ref-E", "E-other=", "repeat", "legend-pos", "no-shift", "no-projE", "eps=", "no-decimate"])
 		except getopt.GetoptError, err:
 			print str(err)
 			usage()
@@ -170,6 +174,8 @@ class plotter:
 				self.plot_projE = False
 			elif o in ("-p", "--eps"):
 				self.eps_out = a
+			elif o == "--no-decimate":
+				self.lines.enabled = False
 			else:
 				assert False, "Unhandled Option"	
 
@@ -328,6 +334,11 @@ class plotter:
 				self.ax2 = self.fig.add_subplot('111', sharex=self.ax1, frameon=False)
 			new_plot = True
 
+			# Re-decimate the data when zooming, or resizing the window
+			self.ax1.callbacks.connect('xlim_changed', xlim_callback)
+			self.ax2.callbacks.connect('xlim_changed', xlim_callback)
+			self.fig.canvas.mpl_connect('resize_event', resize_callback)
+
 		# Create aliases to the stored objects for ease.
 		ax1 = self.ax1
 		ax2 = self.ax2
@@ -339,6 +350,7 @@ class plotter:
 			savecoords = (ax1.get_xlim(), ax1.get_ylim(), ax2.get_xlim(), ax2.get_ylim())
 			ax1.cla()
 			ax2.cla()
+			self.lines.clear()
 
 			ax1.set_xlim(savecoords[0])
 			ax1.set_ylim(savecoords[1])
@@ -385,8 +397,8 @@ class plotter:
 
 				# Plot the walker counts
 				if self.plot_walkers:
-					ax1.plot(x, wlk, self.get_colour(), label='No. Walkers')
-					ax1.plot(x, atRef, self.get_colour(), label='No. at Ref')
+					self.lines.plot(ax1, x, wlk, self.get_colour(), label='No. Walkers')
+					self.lines.plot(ax1, x, atRef, self.get_colour(), label='No. at Ref')
 
 				# Do we want the colours of each of the files to match between the
 				# walker and energy plots?
@@ -396,9 +408,9 @@ class plotter:
 
 				# Plot the energies
 				if self.plot_projE:
-					ax2.plot(x, proj, self.get_colour(), label='Proj. E')
+					self.lines.plot(ax2, x, proj, self.get_colour(), label='Proj. E')
 				if self.plot_shift:
-					ax2.plot(x, sft, self.get_colour(), label='Inst. Shift')
+					self.lines.plot(ax2, x, sft, self.get_colour(), label='Inst. Shift')
 
 				# Plot the final energy
 				if self.plot_E_final:
@@ -406,9 +418,9 @@ class plotter:
 
 				# Plot the averages
 				if self.disp_avg and self.plot_projE:
-					ax2.plot(x, avProj, self.get_colour(), label='Av. Proj. E')
+					self.lines.plot(ax2, x, avProj, self.get_colour(), label='Av. Proj. E')
 				if self.disp_avg and self.plot_shift:
-					ax2.plot(x, avSft, self.get_colour(), label='Av. Shift')
+					self.lines.plot(ax2, x, avSft, self.get_colour(), label='Av. Shift')
 
 				self.num_lines = max(self.num_lines, file_top_col)
 
@@ -500,6 +512,18 @@ def keypress_callback (event):
 	if event.key == 'r':
 		plot.do_plot()
 
+def resize_callback (event):
+	'''Decimate the plotted data again for the new size of the axes'''
+
+	plot.lines.update()
+	plot.fig.canvas.draw_idle()
+
+def xlim_callback (ax):
+	'''Decimate the plotted data again for the new (shared) x-axis limits'''
+
+	plot.lines.update(ax.get_xlim())
+	plot.fig.canvas.draw_idle()
+
 
 
 # If we are running this directly, execute main.
@@ -7,12 +7,19 @@ See "plot.py -h" for more details
 g_ver_str = '0.2'
 
 # Required modules
+import sys
+
+# Batch rendering is headless, so the backend must be selected before pylab
+# is imported.
+if [a for a in sys.argv[1:] if a.split('=')[0] == '--batch']:
+    import matplotlib
+    matplotlib.use('Agg')
+
 from pylab import *
 from numpy import *
 from matplotlib import rc, rcParams
 from os import path
 import os
-import sys
 import matplotlib.axes
 try:
     from argparse import ArgumentParser
@@ -22,7 +29,12 @@ import re
 import time
 import subprocess
 import tempfile
-from scipy import optimize
+import mmap
+import zlib
+import cPickle as pickle
+import multiprocessing
+from scipy import optimize, signal
+from decimation import decimated_lines
 
 def _general_function(params, xdata, ydata, function):
     return function(xdata, *params) - ydata
@@ -31,7 +43,7 @@ def _weighted_general_function(params, xdata, ydata, function, weights):
     return weights * (function(xdata, *params) - ydata)
 
 # Would be nice if this was here...#
-def curve_fit(f, xdata, ydata, p0=None, sigma=None, **kw):
+def curve_fit(f, xdata, ydata, p0=None, sigma=None, jac=None, **kw):
     """
     Use non-linear least squares to fit a function, f, to data.
 
@@ -57,6 +69,10 @@ def curve_fit(f, xdata, ydata, p0=None, sigma=None, **kw):
         If not None, it represents the standard-deviation of ydata.
         This vector, if given, will be used as weights in the
         least-squares problem.
+    jac : None or callable
+        The Jacobian of the model function with respect to the parameters,
+        jac(x, ...), taking the same arguments as f and returning an
+        (N,M)-shaped array. If None, it is estimated by finite differences.
 
 
     Returns
@@ -106,6 +122,10 @@ def curve_fit(f, xdata, ydata, p0=None, sigma=None, **kw):
         func = _weighted_general_function
         args += (1.0/asarray(sigma),)
 
+    if jac is not None:
+        weights = ones(1) if sigma is None else 1.0/asarray(sigma)
+        kw['Dfun'] = lambda params, *a: weights[:,newaxis] * jac(xdata, *params)
+
     res = optimize.leastsq(func, p0, args=args, full_output=1, **kw)
     (popt, pcov, infodict, errmsg, ier) = res
 
@@ -161,26 +181,34 @@ class colour_manager:
 # Load a file, and read the columns (up to a specified limit)
 def read_cols (f, last_iter=None, last_im_time=None):
 
+    reader = stats_reader(last_iter, last_im_time)
+    reader.read(f)
+    reader.finish()
+    return reader.columns()
+
+
+class stats_reader:
+    '''
+    Read the columns from an FCIMCStats file. The position reached in the
+    file is retained, so that a running calculation can be followed by
+    calling update() repeatedly, which only parses newly appended lines.
+    '''
+
     # The list of available column titles. Some are duplicates to
     # deal with where the labelling has adjusted, or to cope with
     # both FCIQMCStats and fciqmc_stats conventions.
-    max_runs = 20
     re_label = re.compile('^#\s*((\d+\.\s*.*?)\s*)+$')
     re_label_split = re.compile('#?\s*\d+\.')
     col_labels = {
         'iter': ('Step', 'Iter.'),
-        'shift': (('Shift. (cyc)', 'Shift') +
-                    tuple(('Shift ({0})'.format(run+1) for run in range(max_runs)))),
+        'shift': ('Shift. (cyc)', 'Shift'),
         'growth': ('GrowRate', 'Growth fac.'),
-        'parts': (('TotWalkers', 'Tot. parts') +
-                    tuple(('Parts ({0})'.format(run+1) for run in range(max_runs)))),
-        'ref_parts': (('NoatHF', 'Tot. ref') +
-                        tuple(('Ref ({0})'.format(run+1) for run in range(max_runs)))),
+        'parts': ('TotWalkers', 'Tot. parts'),
+        'ref_parts': ('NoatHF', 'Tot. ref'),
         'im_time': ('TotImagTime', 'Im. time'),
         'it_time': ('Iter. time', "IterTime"),
         'proje_corr': ('Proj.E.ThisCyc', 'Proj. E (cyc)'),
-        'proje_tot': (('Tot-Proj.E.ThisCyc', 'Tot. Proj. E') +
-                    tuple(('Tot ProjE ({0})'.format(run+1) for run in range(max_runs)))),
+        'proje_tot': ('Tot-Proj.E.ThisCyc', 'Tot. Proj. E'),
         'exp_av_proje': (),
         'av_proje': ('Proj.E',),
         'av_shift': ('Av.Shift',),
@@ -200,105 +228,435 @@ def read_cols (f, last_iter=None, last_im_time=None):
         'proje_tot'
     ]
 
+    # Columns for multiple run calculations are labelled with the run, e.g.
+    # 'Shift (3)'. These are matched by pattern, so any number of runs is
+    # supported.
+    re_run_label = re.compile('^(.*?)\s*\((\d+)\)$')
+    run_labels = {
+        'Shift': 'shift',
+        'Parts': 'parts',
+        'Ref': 'ref_parts',
+        'Tot ProjE': 'proje_tot',
+    }
+
     # Invert the label dictionary for easy lookup
     label_lookup = dict([(hdr, title) for title in col_labels
                                 for hdr in col_labels[title]])
 
-    rows = []
-    iter_col = None
-    im_time_col = None
-    found_hdr = False
-    for line in f:
-
-        # Ignore comment lines
-        if (line[0] == '#'):
-
-            # The first line contains the column header. Split this up
-            # into sections
-            if not found_hdr and re_label.match(line):
-                found_hdr = True
-                col_hdrs =  [s.strip() for s in re_label_split.split(line)
-                                       if s != '']
-                col_titles = [label_lookup.get(hdr, None) for hdr in col_hdrs]
-                try:
-                    iter_col = col_titles.index('iter')
-                except:
-                    pass
-                try:
-                    im_time_col = col_titles.index('im_time')
-                except:
-                    pass
-
-                try:
-                    s2_col = col_titles.index('S2')
-                    if col_titles[s2_col+1] == 'S2':
-                        col_titles[s2_col+1] = 'S2_init'
-                except:
-                    pass
+    # The file is read in blocks of this many bytes. The data lines in each
+    # block are converted to floats together, and accumulated into a growable
+    # (ncols x niter) array, rather than as lists of python floats.
+    block_size = 1 << 22
+
+    def __init__ (self, last_iter=None, last_im_time=None):
+        self.last_iter = last_iter
+        self.last_im_time = last_im_time
+        self.store = None
+        self.col_titles = []
+        self.col_runs = []
+        self.iter_col = None
+        self.im_time_col = None
+        self.found_hdr = False
+        self.done = False
+        self.offset = 0
+        self.partial = ''
+
+    def update (self, fn):
+        '''Read any lines which have been appended to the file fn since the
+           last call. Returns True if any new data has been read.'''
+
+        # If the file has shrunk, it has been replaced. Start again.
+        size = path.getsize(fn)
+        if size < self.offset:
+            self.__init__(self.last_iter, self.last_im_time)
+        if self.done or size == self.offset:
+            return False
+
+        nprev = self.niter()
+        with open(fn, 'r') as f:
+            f.seek(self.offset)
+            self.read(f)
+            self.offset = f.tell()
+
+        return self.niter() != nprev
+
+    def read (self, f):
+        '''Parse the lines from the current position in the file object f
+           until it is exhausted. A trailing incomplete line is held back
+           until it is completed (or finish() is called).'''
+
+        while not self.done:
+            block = f.read(self.block_size)
+            if not block:
+                break
+            lines = (self.partial + block).split('\n')
+            self.partial = lines.pop()
+            self.parse_lines(lines)
+
+    def finish (self):
+        '''Parse any trailing line without a terminating newline'''
+
+        if self.partial and not self.done:
+            self.parse_lines([self.partial])
+        self.partial = ''
+
+    def parse_lines (self, lines):
+        '''Parse a list of complete lines from the file'''
+
+        data_lines = []
+        for line in lines:
+
+            if not line.strip():
+                continue
+
+            # Ignore comment lines
+            if (line[0] == '#'):
+
+                # The first line contains the column header. Split this up
+                # into sections
+                if not self.found_hdr and self.re_label.match(line):
+                    self.parse_header(line)
+                continue
+
+            # The number of columns is fixed by the first line of data
+            if self.store is None:
+                self.store = column_store(len(line.split()))
+
+            data_lines.append(line)
+
+        if data_lines:
+            self.done = self.store.append(
+                                _parse_rows(data_lines, self.store.ncols),
+                                self.iter_col, self.last_iter,
+                                self.im_time_col, self.last_im_time)
+
+    def parse_header (self, line):
+        '''Determine the column titles from the header line'''
+
+        self.found_hdr = True
+        col_hdrs =  [s.strip() for s in self.re_label_split.split(line)
+                               if s != '']
+        col_titles = []
+        col_runs = []
+        for hdr in col_hdrs:
+            title, run = self.label_lookup.get(hdr, None), 0
+            m = self.re_run_label.match(hdr)
+            if title is None and m:
+                title, run = self.run_labels.get(m.group(1), None), int(m.group(2))
+            col_titles.append(title)
+            col_runs.append(run)
+        try:
+            self.iter_col = col_titles.index('iter')
+        except:
+            pass
+        try:
+            self.im_time_col = col_titles.index('im_time')
+        except:
+            pass
+
+        try:
+            s2_col = col_titles.index('S2')
+            if col_titles[s2_col+1] == 'S2':
+                col_titles[s2_col+1] = 'S2_init'
+        except:
+            pass
 
-            continue
+        self.col_titles = col_titles
+        self.col_runs = col_runs
 
-        bits = [float(s) for s in line.split()]
+    def niter (self):
+        '''The number of rows of data read so far'''
+        return self.store.n if self.store is not None else 0
 
-        # Have we specified an iteration/time not to read after?
-        if last_iter and iter_col and bits[iter_col] > last_iter:
-            break
-        if last_im_time and im_time_col and bits[im_time_col] > last_im_time:
-            break
+    def columns (self):
+        '''Return the data read so far, as a column_data object'''
 
-        # Add the row to the store
-        rows.append(bits)
+        if self.store is None:
+            ncols = len(self.col_titles)
+            cols = zeros((ncols, 0))
+        else:
+            ncols = self.store.ncols
+            cols = self.store.columns()
+
+        # And push the data into our custom object. Columns are views into
+        # the store. Multiple-run columns are gathered into (nruns x niter)
+        # arrays, ordered by run. Where there are columns for the individual
+        # replicas, the aggregate over all of them (run 0, e.g. 'Tot. parts')
+        # is kept separately, as title + '_agg', rather than as another row.
+        data = column_data()
+        multi_inds = dict()
+        for i, (title, run) in enumerate(zip(self.col_titles, self.col_runs)):
+            if title is not None and i < ncols:
+                if title in self.multi_run_cols:
+                    multi_inds.setdefault(title, []).append((run, i))
+                else:
+                    data[title] = cols[i]
+        for title in multi_inds:
+            runs = sorted(multi_inds[title])
+            if len(runs) > 1 and runs[0][0] == 0:
+                data[title + '_agg'] = cols[runs[0][1]]
+                runs = runs[1:]
+            data[title] = _select_rows(cols, [i for (run, i) in runs])
 
-    # Flip this around so we have a list of columns to return
-    cols = zip(*rows)
+        return data
 
-    # And push the data into our custom object
-    data = column_data()
-    for i, title in enumerate(col_titles):
-        if title is not None:
-            if title in multi_run_cols:
-                if title not in data:
-                    data[title] = []
-                data[title].append(cols[i])
-            else:
-                data[title] = cols[i]
 
-    return data
+def _parse_rows (lines, ncols):
+    '''Convert a list of data lines into an (nrows x ncols) array. Lines which
+       do not contain ncols values (e.g. a partially written final line) are
+       dropped.'''
+
+    vals = fromstring(' '.join(lines), sep=' ')
+    if len(vals) == len(lines) * ncols:
+        return vals.reshape(len(lines), ncols)
+
+    rows = [l.split() for l in lines]
+    rows = [[float(s) for s in r] for r in rows if len(r) == ncols]
+    return array(rows, dtype=float).reshape(len(rows), ncols)
+
+
+def _select_rows (cols, inds):
+    '''Select the rows inds from the 2-D array cols. If the rows are evenly
+       spaced this is a view, rather than a copy, of the data'''
+
+    if len(inds) == 1:
+        return cols[inds[0]:inds[0]+1]
+    step = inds[1] - inds[0]
+    if step > 0 and (diff(inds) == step).all():
+        return cols[inds[0]:inds[-1]+1:step]
+    return cols[inds]
+
+
+class column_store:
+    '''
+    A growable store for the numerical data in a stats file. The data is
+    held as a (ncols x niter) array, so that each column (and each evenly
+    spaced block of columns) can be returned as a view without copying.
+    '''
+
+    def __init__ (self, ncols, capacity=4096):
+        self.ncols = ncols
+        self.n = 0
+        self.buf = empty((ncols, capacity))
+
+    def append (self, rows, iter_col=None, last_iter=None, im_time_col=None,
+                last_im_time=None):
+        '''Append an (nrows x ncols) block of data. If a last iteration (or
+           imaginary time) is specified, then only rows up to this point
+           are stored, and True is returned once it has been passed.'''
+
+        done = False
+        for col, last in ((iter_col, last_iter), (im_time_col, last_im_time)):
+            if last and col is not None:
+                past = nonzero(rows[:, col] > last)[0]
+                if len(past):
+                    rows = rows[:past[0]]
+                    done = True
+
+        nrows = rows.shape[0]
+        if self.n + nrows > self.buf.shape[1]:
+            capacity = max(2 * self.buf.shape[1], self.n + nrows)
+            buf = empty((self.ncols, capacity))
+            buf[:, :self.n] = self.buf[:, :self.n]
+            self.buf = buf
+        self.buf[:, self.n:self.n+nrows] = rows.T
+        self.n += nrows
+
+        return done
+
+    def columns (self):
+        '''Return a (ncols x niter) view of the stored data'''
+        return self.buf[:, :self.n]
 
 
 
 def output_file (fin):
     '''Given an FCIMCStats file, determine the output file'''
 
-    # Process the filename
-    stem = path.dirname(fin)
-    stem = stem + '/' if stem != '' else stem
-    if 'FCIMCStats' in fin:
-        parts = [x.strip('.') for x in path.basename(fin).partition('FCIMCStats')]
-    elif 'FCIQMCStats_' in fin:
-        parts = [x.strip('.') for x in path.basename(fin).partition('FCIQMCStats_')]
-    elif 'fciqmc_stats' in fin:
-        parts = [x.strip('.') for x in path.basename(fin).partition('fciqmc_stats')]
-    else:
-        parts = [x.strip('.') for x in path.basename(fin).partition('FCIQMCStats')]
+    return run_catalog.get(path.dirname(fin)).output_file(fin)
+
+
+
+class run_catalog:
+    '''
+    A catalog of the calculations in a directory.
+
+    The directory is listed (at most) once, and stats files are matched to
+    their output files in memory rather than by testing for the existence
+    of each possible filename. The metadata for each run (the number of
+    replicas, the first and last iterations and the history of tau) is also
+    recorded. All of this is stored in an index file in the directory, and
+    reused for as long as the directory (or stats file) is unchanged.
+    '''
+
+    index_name = '.plot3index'
+    index_version = 2
 
     # File bases for output files
     out_base_in = ['OUT', 'OUTPUT', 'OUT.FCIMC', 'OUTPUT.FCIMC', 'out', 'output.FCIMC', 'output', 'out_', 'neci.out', 'neci.out_']
-    out_base = []
-    map(out_base.extend, [(a, '.'+a, a+'.', '.'+a+'.') for a in out_base_in])
+    out_base = list(b for a in out_base_in for b in (a, '.'+a, a+'.', '.'+a+'.'))
+
+    # Each directory is only catalogued once per invocation
+    catalogs = dict()
+
+    @classmethod
+    def get (cls, dirname):
+        '''Return the catalog for the specified directory'''
+
+        if dirname not in cls.catalogs:
+            cls.catalogs[dirname] = run_catalog(dirname)
+        return cls.catalogs[dirname]
+
+    def __init__ (self, dirname):
+        self.dirname = dirname
+        self.index_file = path.join(dirname, self.index_name)
+        self.entries = None
+        self.dir_mtime = None
+        self.runs = dict()
+
+        # Restore any previous index. If the directory has changed since then,
+        # the previously matched output files may no longer be correct.
+        try:
+            with open(self.index_file, 'rb') as f:
+                index = pickle.load(f)
+            if index['version'] == self.index_version:
+                self.dir_mtime = index['dir_mtime']
+                self.runs = index['runs']
+        except Exception:
+            pass
+
+        mtime = os.stat(dirname or os.curdir).st_mtime
+        if mtime != self.dir_mtime:
+            self.dir_mtime = mtime
+            for run in self.runs.values():
+                run.pop('output', None)
+
+    def save (self):
+        '''Write the index file. Failure to do so is not an error.'''
+
+        # Creating the index (or a cache file) changes the modification time
+        # of the directory, so the index must be written again if that happens
+        try:
+            for attempt in range(2):
+                with open(self.index_file, 'wb') as f:
+                    pickle.dump({'version': self.index_version,
+                                 'dir_mtime': self.dir_mtime,
+                                 'runs': self.runs}, f, -1)
+                mtime = os.stat(self.dirname or os.curdir).st_mtime
+                if mtime == self.dir_mtime:
+                    break
+                self.dir_mtime = mtime
+        except (IOError, OSError):
+            pass
+
+    def exists (self, fn):
+        '''Is there a file fn in the directory? The directory is listed the
+           first time that this is needed.'''
+
+        if self.entries is None:
+            self.entries = set(os.listdir(self.dirname or os.curdir))
+        return fn in self.entries and path.isfile(path.join(self.dirname, fn))
+
+    def output_file (self, fin):
+        '''Given an FCIMCStats file in this directory, determine the output
+           file'''
+
+        name = path.basename(fin)
+        run = self.runs.setdefault(name, dict())
+        if 'output' not in run:
+
+            # Process the filename
+            if 'FCIMCStats' in name:
+                parts = [x.strip('.') for x in name.partition('FCIMCStats')]
+            elif 'FCIQMCStats_' in name:
+                parts = [x.strip('.') for x in name.partition('FCIQMCStats_')]
+            elif 'fciqmc_stats' in name:
+                parts = [x.strip('.') for x in name.partition('fciqmc_stats')]
+            else:
+                parts = [x.strip('.') for x in name.partition('FCIQMCStats')]
+
+            # Generate list of files to try
+            out_names = []
+            for f in self.out_base:
+                out_names.append(parts[0] + f + parts[2])
+                out_names.append(parts[2] + f + parts[0])
+
+            # Does any of these possible filenames exist?
+            run['output'] = None
+            for f in out_names:
+                if self.exists(f):
+                    run['output'] = f
+                    break
+            self.save()
+
+        if run['output'] is not None:
+            return path.join(self.dirname, run['output'])
+
+        # Fall back to the output files in the current directory
+        cwd = run_catalog.get('')
+        for f in self.out_base_in:
+            if cwd.exists(f):
+                return f
+        return None
+
+    def run_info (self, fin):
+        '''Return the metadata for the run which produced the FCIMCStats file
+           fin. This is a dict containing the number of replicas (nruns), the
+           first and last iterations (first_iter, last_iter) and a list of
+           changes of tau and the iteration they apply from (tau_changes).'''
+
+        name = path.basename(fin)
+        run = self.runs.setdefault(name, dict())
+        changed = False
+
+        st = os.stat(fin)
+        if run.get('stat') != (st.st_size, st.st_mtime):
+            run.update(stats_file_info(fin))
+            run['stat'] = (st.st_size, st.st_mtime)
+            changed = True
+
+        ofile = self.output_file(fin)
+        tau_changes = output_scanner(ofile).update()[2] if ofile else []
+        if run.get('tau_changes') != tau_changes:
+            run['tau_changes'] = tau_changes
+            changed = True
+
+        if changed:
+            self.save()
+
+        return dict([(k, run.get(k)) for k in
+                    ('nruns', 'first_iter', 'last_iter', 'tau_changes')])
+
+
+
+def stats_file_info (fn):
+    '''Determine the number of replicas, and the first and last iterations,
+       in an FCIMCStats file. Only the start and end of the file are read.'''
+
+    reader = stats_reader()
+    with open(fn, 'r') as f:
+        # The header, and the first line of data
+        for line in f:
+            reader.parse_lines([line])
+            if reader.niter():
+                break
 
-    # Generate list of files to try
-    out_names = []
-    for f in out_base:
-        out_names.append(stem + parts[0] + f + parts[2])
-        out_names.append(stem + parts[2] + f + parts[0])
-    out_names.extend(out_base_in)
+        # The last complete line of data
+        f.seek(0, os.SEEK_END)
+        f.seek(max(f.tell() - 4096, 0))
+        last = [l for l in f.read().split('\n')[:-1]
+                  if l.strip() and l[0] != '#']
 
-    # Does any of these possible filenames exist?
-    for f in out_names:
-        if path.isfile(f):
-            return f
-    return None
+    # The replica columns are labelled with their run, from 1. The aggregate
+    # columns (run 0) are not counted.
+    cols = reader.columns()
+    nruns = max([1] + reader.col_runs)
+    info = {'nruns': nruns, 'first_iter': None, 'last_iter': None}
+    if reader.iter_col is not None and reader.niter():
+        info['first_iter'] = int(cols['iter'][0])
+        info['last_iter'] = int(float(last[-1].split()[reader.iter_col])) \
+                                if last else info['first_iter']
+    return info
 
 
 
@@ -326,6 +684,8 @@ class column_data(dict):
             # If we haven't defined 'iter' then this will throw again.
             iters = super(column_data, self).__getitem__('iter')
             val = zeros_like(iters)
+            if key in stats_reader.multi_run_cols:
+                val = val[newaxis, :]
 
         return val
 
@@ -372,6 +732,28 @@ class plotter:
             self.fn = fn
             self.ofile = output_file(fn)
 
+            # Retained state, so that data can be re-read incrementally
+            self.reader = None
+            self.oscanner = None
+
+
+        def read (self, last_iter=None, last_im_time=None):
+            '''Read any data appended to the stats file since the last call.
+               Returns True if new data has been read'''
+
+            if self.reader is None:
+                self.reader = stats_reader(last_iter, last_im_time)
+            return self.reader.update(self.fn)
+
+
+        def output_data (self):
+            '''Process the output file. Only output which has been appended
+               since the last call is scanned'''
+
+            if self.oscanner is None:
+                self.oscanner = output_scanner(self.ofile)
+            return self.oscanner.update()
+
 
         def __del__ (self):
             '''Clean up any temporary filesystem objects created'''
@@ -462,10 +844,24 @@ class plotter:
         self.x_itime = False
         self.x_walkers = False
         self.fit_walkers_E = False
+        self.mean_replicas = False
+        self.fit_table = False
         self.fix_colours = False
         self.plot_legend = True
         self.legend_strs = None
         self.verbose = False
+        self.refresh = None
+        self.decimate = True
+        self.batch_dir = None
+        self.batch_format = 'png'
+        self.jobs = None
+
+        # The plotted lines, in the order they are created, so that they can
+        # be updated in place as new data arrives. The lines are plotted with
+        # data decimated to the resolution of the axes.
+        self.lines = []
+        self.line_ind = 0
+        self.decimator = None
 
         # Storage to keep track of temporary directories which
         # need removal.
@@ -532,6 +928,13 @@ class plotter:
                             help="Fit a stretched exponential to the energy "\
                                  "and walker data.")
 
+        parser.add_argument("--fit-table", action='store_true',
+                            default=self.fit_table,
+                            help="Fit the walker growth and stretched "\
+                                 "exponential energy models to every run "\
+                                 "of each file in parallel (see -j), print "\
+                                 "a table of the fits and exit")
+
         parser.add_argument("-c", "--correlation-E", action='store_true',
                             default=not self.E.total_energies,
                             help="Use the correlation energy directly. Don't"\
@@ -603,6 +1006,38 @@ class plotter:
                             help="What labels should we use in the legend?",
                             type=str, nargs=1)
 
+        parser.add_argument("-M", "--mean-replicas", action='store_true',
+                            default=self.mean_replicas,
+                            help="For multiple run calculations, plot the "\
+                                 "mean over the replicas rather than a line "\
+                                 "for each replica")
+
+        parser.add_argument("-R", "--refresh", default=self.refresh,
+                            help="Follow running calculations. Every (arg, "\
+                                 "default=10) seconds, read any newly "\
+                                 "appended data and update the plot",
+                            type=float, nargs='?', const=10.0)
+
+        parser.add_argument("--no-decimate", action='store_true',
+                            default=not self.decimate,
+                            help="Plot every data point, rather than the "\
+                                 "minimum and maximum values for each pixel")
+
+        parser.add_argument("--batch", default=self.batch_dir,
+                            metavar='outdir',
+                            help="Render the plot for each of the files "\
+                                 "into outdir, without displaying them, "\
+                                 "using a pool of processes")
+
+        parser.add_argument("--format", default=self.batch_format,
+                            help="The image format to use for --batch "\
+                                 "(e.g. png or pdf)")
+
+        parser.add_argument("-j", "--jobs", default=self.jobs, type=int,
+                            help="The number of processes to use for "\
+                                 "--batch and --fit-table (default: the "\
+                                 "number of CPUs)")
+
         args = parser.parse_args()
 
         # Store obtained data
@@ -615,6 +1050,8 @@ class plotter:
         self.plot_legend = not args.no_legends
         self.last_iter = args.last_iter
         self.fit_walkers_E = args.fit_walkers_E
+        self.mean_replicas = args.mean_replicas
+        self.fit_table = args.fit_table
         self.E.total_energies = not args.correlation_E
         self.share_walkers_spin = not args.separate_spin
         self.fix_colours = args.fix_colours
@@ -632,6 +1069,11 @@ class plotter:
         self.E.plot_lines = args.plot_energy_lines
         self.E.plot_exp_average = args.plot_exp_average
         self.verbose = args.verbose
+        self.refresh = args.refresh
+        self.decimate = not args.no_decimate
+        self.batch_dir = args.batch
+        self.batch_format = args.format
+        self.jobs = args.jobs
 
         if args.legend_strs:
             self.legend_strs = args.legend_strs[0].split(',')
@@ -698,6 +1140,7 @@ class plotter:
 
         # New figure
         self.fig = figure()
+        self.decimator = decimated_lines(self.decimate)
         self.fig.subplots_adjust(hspace=0)
 
         # Keep track of what we have achieved
@@ -722,6 +1165,8 @@ class plotter:
             for x in reversed(self.axes):
                 if x.plot:
                     x.ax.cla()
+            self.lines = []
+            self.decimator.clear()
 
             
     def axis_labels (self):
@@ -803,6 +1248,48 @@ class plotter:
         self.plot_data ()
         self.axis_labels ()
 
+    def do_update (self):
+        '''Read any data appended to the input files, and update the existing
+           lines in place. Returns True if the plot has changed'''
+
+        if not any([fl.read() for fl in self.in_files]):
+            return False
+
+        self.plot_data ()
+        for x in self.axes:
+            if x.plot:
+                x.ax.relim()
+                x.ax.autoscale_view()
+        self.decimator.update()
+        return True
+
+    def do_redecimate (self, xlim=None):
+        '''Re-decimate the plotted lines from the full resolution data, for
+           the current (or specified) x-axis limits and size'''
+
+        self.decimator.update(xlim)
+
+
+    def plot_line (self, ax, x, y, fmt, **kwargs):
+        '''Plot a line. If a line has already been plotted at this point in
+           an earlier pass, then just update its data'''
+
+        if self.line_ind < len(self.lines):
+            self.decimator.set_data(self.lines[self.line_ind], x, y)
+        else:
+            self.lines.append(self.decimator.plot(ax, x, y, fmt, **kwargs))
+        self.line_ind += 1
+
+
+    def plot_hline (self, ax, y, **kwargs):
+        '''Plot a horizontal line, or update an existing one as plot_line'''
+
+        if self.line_ind < len(self.lines):
+            self.lines[self.line_ind].set_ydata([y, y])
+        else:
+            self.lines.append(ax.axhline(y, **kwargs))
+        self.line_ind += 1
+
 
 
     def plot_data (self):
@@ -811,12 +1298,18 @@ class plotter:
         # Colour management object
         col = colour_manager()
 
+        # Start a new pass over the plotted lines
+        self.line_ind = 0
+
         # Plot data from the plot files.
         for i, fl in enumerate(self.in_files):
 
             # Give ourselves some output
             if self.verbose:
                 print 'Plotting "%s" with output file "%s"' % (fl.fn, fl.ofile)
+                info = run_catalog.get(path.dirname(fl.fn)).run_info(fl.fn)
+                print '    %(nruns)d run(s), iterations %(first_iter)s to ' \
+                      '%(last_iter)s, tau changes: %(tau_changes)s' % info
 
             # Do we want to use the same colour for all lines in the file?
             if self.fix_colours:
@@ -827,142 +1320,158 @@ class plotter:
             # Store the colour used for this file, so we can repeat it.
             col.reset_point()
 
-            with open(fl.fn, 'r') as f:
-
-                # Read data from file, stopping at the correct point
-                if self.x_itime:
-                    cols = read_cols(f, last_im_time=self.last_iter)
-                else:
-                    cols = read_cols(f, last_iter=self.last_iter)
-
-                # Is there an output file to process?
-                tau_changes = None
-                if fl.ofile is not None and self.E.total_energies:
-                    ref_E, E_final, tau_changes = process_output (fl.ofile)
-
-                    # Adjust certain columns if they are there.
-                    if 'shift' in cols:
-                        for i in range(len(cols['shift'])):
-                            # This is a bit of a hack...
-                            if abs(cols['shift'][i][-1]) < 10:
-                                cols['shift'][i] = apply_ref_Es(cols['shift'][i],
-                                                                 cols['iter'], ref_E)
-
-                    if self.E.plot_exp_average and 'exp_av_projE' in cols:
-                        cols['exp_av_projE'] = \
-                                apply_ref_Es(cols['exp_av_projE'],
-                                             cols['iter'], ref_E)
-
-                    if self.E.plot_averages and 'av_projE' in cols:
-                        cols['av_projE'] = apply_ref_Es(cols['av_projE'],
-                                                        cols['iter'], ref_E)
-
-                    if self.E.plot_averages and 'av_shift' in cols:
-                        cols['av_projE'] = apply_ref_Es(cols['av_shift'],
-                                                        cols['iter'], ref_E)
-
-                # Are we using iteration, time or walker number as x-coord?
-                if self.x_time:
-                    x = cumulative_time(cols['iter'], cols['it_time'])
-                elif self.x_walkers:
-                    x = cols['parts'][0]
-                elif self.x_itime:
-                    x = cols['im_time']
-                else:
-                    x = cols['iter']
+            # Read any new data from file, stopping at the correct point
+            if self.x_itime:
+                fl.read(last_im_time=self.last_iter)
+            else:
+                fl.read(last_iter=self.last_iter)
+            cols = fl.reader.columns()
+
+            # Is there an output file to process?
+            tau_changes = None
+            if fl.ofile is not None and self.E.total_energies:
+                ref_E, E_final, tau_changes = fl.output_data()
+
+                # Adjust certain columns if they are there. New arrays are
+                # created, as the columns are views of the retained data.
+                if 'shift' in cols and cols['shift'].shape[1]:
+                    # This is a bit of a hack... Only adjust the replicas
+                    # which look like correlation energies.
+                    shift = cols['shift']
+                    corr = abs(shift[:, -1]) < 10
+                    cols['shift'] = where(corr[:, newaxis],
+                                          apply_ref_Es(shift, cols['iter'], ref_E),
+                                          shift)
+
+                if self.E.plot_exp_average and 'exp_av_projE' in cols:
+                    cols['exp_av_projE'] = \
+                            apply_ref_Es(cols['exp_av_projE'],
+                                         cols['iter'], ref_E)
+
+                if self.E.plot_averages and 'av_projE' in cols:
+                    cols['av_projE'] = apply_ref_Es(cols['av_projE'],
+                                                    cols['iter'], ref_E)
+
+                if self.E.plot_averages and 'av_shift' in cols:
+                    cols['av_projE'] = apply_ref_Es(cols['av_shift'],
+                                                    cols['iter'], ref_E)
+
+            # The total number of walkers, over all of the replicas
+            tot_parts = cols['parts_agg'] if 'parts_agg' in cols \
+                                          else cols['parts'].sum(axis=0)
+
+            # Average over the replicas, if requested. The multiple run
+            # columns are (nruns x niter) arrays, so this keeps them 2-D. They
+            # only contain the replicas, not the aggregate over them.
+            if self.mean_replicas:
+                for title in stats_reader.multi_run_cols:
+                    if title in cols:
+                        cols[title] = cols[title].mean(axis=0)[newaxis, :]
+
+            # Are we using iteration, time or walker number as x-coord?
+            if self.x_time:
+                x = cumulative_time(cols['iter'], cols['it_time'])
+            elif self.x_walkers:
+                x = tot_parts
+            elif self.x_itime:
+                x = cols['im_time']
+            else:
+                x = cols['iter']
 
-                # Do we have a legend prefix?
-                if self.legend_strs:
-                    leg_pre = self.legend_strs[i]
+            # Do we have a legend prefix?
+            if self.legend_strs:
+                leg_pre = self.legend_strs[i]
+            else:
+                leg_pre = ''
+
+            # Plot items on the energy plot.
+            if self.E.plot:
+                ax = self.E.ax
+                fmt = '' if self.E.plot_lines else ','
+                for s in cols['shift']:
+                    self.plot_line (ax, x, s, col()+fmt, label=' '.join([leg_pre,'Inst. Shift']))
+                if self.E.total_energies:
+                    for p in cols['proje_tot']:
+                        self.plot_line (ax, x, p, col()+fmt, label=' '.join([leg_pre,'Proj. E']))
                 else:
-                    leg_pre = ''
-
-                # Plot items on the energy plot.
-                if self.E.plot:
-                    ax = self.E.ax
-                    fmt = '' if self.E.plot_lines else ','
-                    for s in cols['shift']:
-                        ax.plot (x, s, col()+fmt, label=' '.join([leg_pre,'Inst. Shift']))
-                    if self.E.total_energies:
-                        for p in cols['proje_tot']:
-                            ax.plot (x, p, col()+fmt, label=' '.join([leg_pre,'Proj. E']))
-                    else:
-                        ax.plot (x, cols['proje_corr'], col()+fmt, label=' '.join([leg_pre,'Proj. E']))
-                    if self.fit_walkers_E:
-                        fit, efit, err = stretched_exp_fit(cols['parts'], cols['proje_corr'])
-                        ax.plot (x, fit, col(), label=' '.join([leg_pre,'FIT']))
-                        ax.axhline(efit, color=col(), label=' '.join([leg_pre,"E-fit"]))
-                    if self.E.plot_averages:
-                        ax.plot (x, cols['av_proje'], col()+fmt, label=' '.join([leg_pre,'Av. Proj. E']))
-                        ax.plot (x, cols['av_shift'], col()+fmt, label=' '.join([leg_pre,'Av. Shift']))
-                    if self.E.plot_exp_average:
-                        ax.plot (x, cols['exp_av_proje'], col()+fmt, label=' '.join([leg_pre,'Exp. Average']))
-
-                # Plot items on the walker plot
-                if self.W.plot:
-                    if not self.share_walkers_E:
-                        col.reset()
-                    ax = self.W.ax
-                    for p in cols['parts']:
-                        ax.plot (x, p, col(), label=' '.join([leg_pre,'No. Walkers']))
-                    for r in cols['ref_parts']:
-                        ax.plot (x, r, col(), label=' '.join([leg_pre,'No. at Ref']))
-
-                    if self.W.plot_growth_cpts:
-                        ax.plot (x, cols['born'], col(), label=' '.join([leg_pre,'No. Born']))
-                        ax.plot (x, cols['died'], col(), label=' '.join([leg_pre,'No. Died']))
-                        ax.plot (x, cols['annihil'], col(), label=' '.join([leg_pre,'No. Annihil']))
-
-                # Plot items on the spin plot
-                if self.S.plot:
-                    if not self.share_walkers_spin:
-                        col.reset()
-                    ax = self.S.ax
-                    if self.S.log_scale:
-                        X, S = zip(*[(i, s) for i, s in zip(x, cols['S2']) if s > 0])
-                    else:
-                        X, S = x, S2
-                    ax.plot (X, S, col(), label=' '.join([leg_pre,'Inst. $S^2$']))
-                    
-                    if self.S.log_scale:
-                        X, S_init = zip(*[(i, s) for i, s in zip(x, cols['S2_init']) if s > 0])
-                    else:
-                        X, S_init = x, S2_init
-                    ax.plot (X, S_init, col(), label=' '.join([leg_pre,'Inst. $S^2$ init']))
-
-                # Plot time related details
-                if self.T.plot:
-                    ax = self.T.ax
+                    self.plot_line (ax, x, cols['proje_corr'], col()+fmt, label=' '.join([leg_pre,'Proj. E']))
+                if self.fit_walkers_E:
+                    fit, efit, err, popt = stretched_exp_fit(tot_parts, cols['proje_corr'])
+                    self.plot_line (ax, x, fit, col(), label=' '.join([leg_pre,'FIT']))
+                    self.plot_hline (ax, efit, color=col(), label=' '.join([leg_pre,"E-fit"]))
+                if self.E.plot_averages:
+                    self.plot_line (ax, x, cols['av_proje'], col()+fmt, label=' '.join([leg_pre,'Av. Proj. E']))
+                    self.plot_line (ax, x, cols['av_shift'], col()+fmt, label=' '.join([leg_pre,'Av. Shift']))
+                if self.E.plot_exp_average:
+                    self.plot_line (ax, x, cols['exp_av_proje'], col()+fmt, label=' '.join([leg_pre,'Exp. Average']))
+
+            # Plot items on the walker plot
+            if self.W.plot:
+                if not self.share_walkers_E:
                     col.reset()
-                    if self.T.plot_tau:
-                        timestep = get_timestep(cols['iter'], cols['im_time'], tau_changes)
-                        ax.plot (x, timestep, col(), label=' '.join([leg_pre,'Timestep (a.u.)']))
-                    if self.T.plot_iter_time:
-                        ax.plot (x, cols['it_time'], col(), label=' '.join([leg_pre,'Iteration Time']))
-
-                # Plot survival/acceptance related details
-                if self.U.plot:
-                    ax = self.U.ax
+                ax = self.W.ax
+                for p in cols['parts']:
+                    self.plot_line (ax, x, p, col(), label=' '.join([leg_pre,'No. Walkers']))
+                for r in cols['ref_parts']:
+                    self.plot_line (ax, x, r, col(), label=' '.join([leg_pre,'No. at Ref']))
+
+                if self.W.plot_growth_cpts:
+                    self.plot_line (ax, x, cols['born'], col(), label=' '.join([leg_pre,'No. Born']))
+                    self.plot_line (ax, x, cols['died'], col(), label=' '.join([leg_pre,'No. Died']))
+                    self.plot_line (ax, x, cols['annihil'], col(), label=' '.join([leg_pre,'No. Annihil']))
+
+            # Plot items on the spin plot
+            if self.S.plot:
+                if not self.share_walkers_spin:
                     col.reset()
-                    ax.plot (x, cols['accept'], col(), label=' '.join([leg_pre,'Acceptance rate']))
-
-                if self.G.plot:
-                    # Get the growth rate for the reference
-                    grow_ref = [1.0] + [r2 / r1 for (r1, r2) in zip(cols['ref_parts'],
-                                                                    cols['ref_parts'][1:])]
-                    growth_ratio = array(cols['growth']) / array(grow_ref)
-
-                    alpha = 0.08
-                    growth_ratio_smoothed = [growth_ratio[0]]
-                    elem = growth_ratio[0]
-                    for g in growth_ratio[1:]:
-                        elem = (1 - alpha) * elem + alpha * g
-                        growth_ratio_smoothed.append(elem)
-
-                    ax = self.G.ax
-                    col.reset()
-                    #ax.plot (x, growth_ratio, col(), label=' '.join([leg_pre,'Growth ratio']))
-                    ax.plot (x, growth_ratio_smoothed, col(), label=' '.join([leg_pre,'Growth ratio']))
+                ax = self.S.ax
+                if self.S.log_scale:
+                    X, S = zip(*[(i, s) for i, s in zip(x, cols['S2']) if s > 0])
+                else:
+                    X, S = x, S2
+                self.plot_line (ax, X, S, col(), label=' '.join([leg_pre,'Inst. $S^2$']))
+                
+                if self.S.log_scale:
+                    X, S_init = zip(*[(i, s) for i, s in zip(x, cols['S2_init']) if s > 0])
+                else:
+                    X, S_init = x, S2_init
+                self.plot_line (ax, X, S_init, col(), label=' '.join([leg_pre,'Inst. $S^2$ init']))
+
+            # Plot time related details
+            if self.T.plot:
+                ax = self.T.ax
+                col.reset()
+                if self.T.plot_tau:
+                    timestep = get_timestep(cols['iter'], cols['im_time'], tau_changes)
+                    self.plot_line (ax, x, timestep, col(), label=' '.join([leg_pre,'Timestep (a.u.)']))
+                if self.T.plot_iter_time:
+                    self.plot_line (ax, x, cols['it_time'], col(), label=' '.join([leg_pre,'Iteration Time']))
+
+            # Plot survival/acceptance related details
+            if self.U.plot:
+                ax = self.U.ax
+                col.reset()
+                self.plot_line (ax, x, cols['accept'], col(), label=' '.join([leg_pre,'Acceptance rate']))
+
+            if self.G.plot:
+                # Get the growth rate for the reference
+                ref = cols['ref_parts'].sum(axis=0)
+                grow_ref = ones(len(ref))
+                grow_ref[1:] = ref[1:] / ref[:-1]
+                growth_ratio = cols['growth'] / grow_ref
+
+                # Exponentially weighted moving average
+                alpha = 0.08
+                growth_ratio_smoothed = growth_ratio
+                if len(growth_ratio):
+                    growth_ratio_smoothed = signal.lfilter(
+                            [alpha], [1, alpha - 1], growth_ratio,
+                            zi=[(1 - alpha) * growth_ratio[0]])[0]
+
+                ax = self.G.ax
+                col.reset()
+                #ax.plot (x, growth_ratio, col(), label=' '.join([leg_pre,'Growth ratio']))
+                self.plot_line (ax, x, growth_ratio_smoothed, col(), label=' '.join([leg_pre,'Growth ratio']))
 
             # Jump to the highest colour used.
             col.jump_max()
@@ -972,11 +1481,11 @@ class plotter:
             for f in self.E.tgt_E:
                 vals = file_E_list(f)
                 for v in vals:
-                    self.E.ax.axhline(v, color=col())
+                    self.plot_hline(self.E.ax, v, color=col())
 
         # Plot a horizontal line for the growth ratios
         if self.G.plot:
-            self.G.ax.axhline(1.0, color=col())
+            self.plot_hline(self.G.ax, 1.0, color=col())
 
 
 
@@ -1000,15 +1509,11 @@ def cumulative_time (it, itime):
     '''Calculate a cumulative time field from the iteration number and
        iteration time fields'''
 
-    # Initialise output list
-    cum_time = list()
-    cum_time.append(0.0)
-
-    # Loop over all iterations/times and sum.
-    for i in range(1, len(it)):
-        elem = (it[i] - it[i-1]) * itime[i]
-        elem += cum_time[i-1]
-        cum_time.append(elem)
+    # Sum the time for each block of iterations between output steps.
+    it = asarray(it)
+    cum_time = zeros(len(it))
+    if len(it) > 1:
+        cumsum(diff(it) * asarray(itime)[1:], out=cum_time[1:])
 
     return cum_time
 
@@ -1049,131 +1554,212 @@ def get_timestep (it, im_time, tau_changes):
 def process_output (fout):
     '''Process a specified output files
        --> A list of reference energies (and the iterations they apply from)
-       --> The final (averaged) energy if it has been reached and printed'''
+       --> The final (averaged) energy if it has been reached and printed
+       --> A list of changes to tau (and the iterations they apply from)'''
 
     # Return a zero reference energy, and no final energy if no output file
     if not fout:
         return [(0, 0)], None
 
-    # Useful regular expressions
-    # re_startiter = re.compile('^\s*St(ep)*\s+Shift')
-    re_startiter = re.compile('^\s*Initial memory allocation sucessful...')
-    re_HF_D0 = re.compile('^\s*\<D0\|H\|D0\>\s*=\s*(.+)\s*$')
-    re_iter = re.compile('^\s*(\d+) ')
-    re_ref_E = re.compile('^\s*Reference [Ee]nergy (now )*set to:\s*(.+)$')
-    re_final_E = re.compile('^\s*Summed approx E\(Beta\)=\s*(.+)$')
-    re_new_tau = re.compile('^\s*(New (tau|timestep):|Updating time-step\. New time-step =)\s+(.+)$')
-    re_init_tau = re.compile('^\s*(From analysis of reference determinant '\
-                             'and connections, an upper bound for the '\
-                             'timestep is|Using initial time-step):\s*(.+)$')
-    re_start_fciqmc = re.compile('^\s*Performing Parallel FCIQMC....')
-
-    # Initial values and 
-    HF_energies = []
-    tau_changes = []
-    E_final = None
-    it = None
-    E_HF = None
-    new_tau = None
-    with open(fout, 'r') as f:
-        for line in f:
-            if it is not None:
-                # Have we restarted everything?
-                m = re_start_fciqmc.match(line)
-                if m:
-                    HF_energies = []
-                    tau_changes = []
-                    E_final = None
-                    it = None
-                    E_HF = None
-                    new_tau = None
-                    continue
-
-                # If we have hit an iteration line, update the counter. If the
-                # reference energy has changed since the last occasion, we need
-                # to append it to the list
-                m = re_iter.match(line)
-                if m:
-                    # Extract iteration. Catch for output bug.
-                    it = int(m.group(1))
-                    it = 0 if it == 1 else it
-
-                    if E_HF is not None:
-                        HF_energies.append((it, E_HF))
-                        E_HF = None
-
-                    if new_tau is not None:
-                        tau_changes.append((it, new_tau))
-                        new_tau = None
-
-                # Have we changed reference det?
-                m = re_ref_E.match(line)
-                if m:
-                    E_HF = float(m.group(2))
-                    continue
-
-                # The final energy as calculated in the simulation
-                m = re_final_E.match(line)
-                if m:
-                    E_final = float(m.group(1))
-                    continue
-
-                # Change of tau?
-                m = re_new_tau.match(line)
-                if m:
-                    new_tau = float(m.group(3))
-                    continue
+    return output_scanner(fout).update()
 
-            else:
-                # Do we need to start counting iterations?
-                if re_startiter.match(line):
-                    it = 0
-                    continue
 
-                # Have we hit the initial setting of the HF energy?
-                m = re_HF_D0.match(line)
-                if m:
-                    E_HF = float(m.group(1))
-                    continue
+class output_scanner:
+    '''
+    Extract the reference energies, changes of tau and final energy from a
+    NECI output file.
+
+    The file is memory-mapped, and scanned once with a single combined regular
+    expression. The results, and the state of the scan, are cached in a file
+    next to the output file (keyed on its size and modification time), so
+    that the file is only rescanned if it changes. If it has grown (e.g. a
+    running calculation) then the scan continues from where it left off.
+    '''
+
+    cache_version = 1
+
+    # Each of the lines of interest. All of these must consume the remainder
+    # of the line.
+    re_events = re.compile(
+        '^[ \t]*(?:'
+        '(?P<startiter>Initial memory allocation sucessful....*)|'
+        '(?P<start_fciqmc>Performing Parallel FCIQMC.....*)|'
+        '<D0\|H\|D0>[ \t]*=[ \t]*(?P<HF_D0>.+)|'
+        'Reference [Ee]nergy (?:now )*set to:[ \t]*(?P<ref_E>.+)|'
+        'Summed approx E\(Beta\)=[ \t]*(?P<final_E>.+)|'
+        '(?:New (?:tau|timestep):|Updating time-step\. New time-step =)'
+            '[ \t]+(?P<new_tau>.+)|'
+        '(?:From analysis of reference determinant and connections, an '
+            'upper bound for the timestep is|Using initial time-step):'
+            '[ \t]*(?P<init_tau>.+)'
+        ')$', re.M)
+
+    # The iteration lines. These are only examined when a new reference
+    # energy or tau is waiting to be applied.
+    re_iter = re.compile('^[ \t]*(\d+) ', re.M)
+
+    def __init__ (self, fout):
+        self.fout = fout
+        self.cache_file = path.join(path.dirname(fout),
+                                    '.%s.plot3cache' % path.basename(fout))
+        self.reset()
+        self.load_cache()
+
+    def reset (self):
+        '''Start the scan from the beginning of the file'''
+
+        self.stat = None
+        self.offset = 0
+        self.check = None
+        self.HF_energies = []
+        self.tau_changes = []
+        self.E_final = None
+        self.started = False
+        self.E_HF = None
+        self.new_tau = None
+
+    def state (self):
+        return dict([(k, getattr(self, k)) for k in
+                     ('stat', 'offset', 'check', 'HF_energies', 'tau_changes',
+                      'E_final', 'started', 'E_HF', 'new_tau')])
+
+    def load_cache (self):
+        '''Restore the scan state from the cache file, if possible'''
+
+        try:
+            with open(self.cache_file, 'rb') as f:
+                cache = pickle.load(f)
+            if cache['version'] == self.cache_version:
+                for k, v in cache['state'].items():
+                    setattr(self, k, v)
+        except Exception:
+            self.reset()
+
+    def save_cache (self):
+        '''Store the scan state. Failure to do so is not an error.'''
 
-                # Change of reference?
-                m = re_ref_E.match(line)
-                if m:
-                    E_HF = float(m.group(2))
-                    continue
+        try:
+            with open(self.cache_file, 'wb') as f:
+                pickle.dump({'version': self.cache_version,
+                             'state': self.state()}, f, -1)
+        except (IOError, OSError):
+            pass
+
+    def update (self):
+        '''Scan any new output, and return the reference energies, the final
+           energy and the changes of tau.'''
+
+        st = os.stat(self.fout)
+        stat = (st.st_size, st.st_mtime)
+        if stat != self.stat:
+            with open(self.fout, 'rb') as f:
+                buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) \
+                        if st.st_size else ''
+
+                # We can only continue a previous scan if the file has grown,
+                # and the data already scanned is unchanged.
+                if st.st_size < self.offset or \
+                        self.check != self.checksum(buf, self.offset):
+                    self.reset()
+
+                self.scan(buf)
+                self.stat = stat
+                if st.st_size:
+                    buf.close()
+
+            self.save_cache()
+
+        return list(self.HF_energies), self.E_final, list(self.tau_changes)
+
+    @staticmethod
+    def checksum (buf, offset):
+        '''A checksum of the data immediately before offset'''
+        return zlib.crc32(buf[max(offset - 4096, 0):offset])
+
+    def apply_pending (self, buf, start, end):
+        '''If the reference energy or tau have been changed, they apply from
+           the first iteration which is output after the change'''
+
+        if not self.started or (self.E_HF is None and self.new_tau is None):
+            return
+        m = self.re_iter.search(buf, start, end)
+        if m:
+            # Extract iteration. Catch for output bug.
+            it = int(m.group(1))
+            it = 0 if it == 1 else it
+
+            if self.E_HF is not None:
+                self.HF_energies.append((it, self.E_HF))
+                self.E_HF = None
+
+            if self.new_tau is not None:
+                self.tau_changes.append((it, self.new_tau))
+                self.new_tau = None
+
+    def scan (self, buf):
+        '''Scan the complete lines from the current offset onwards'''
+
+        end = buf.rfind('\n', self.offset) + 1
+        if end <= self.offset:
+            return
+
+        pos = self.offset
+        for m in self.re_events.finditer(buf, pos, end):
+            self.apply_pending(buf, pos, m.start())
+            pos = m.end()
+            event = m.lastgroup
+            val = m.group(event)
+
+            if self.started:
+                # Have we restarted everything?
+                if event == 'start_fciqmc':
+                    self.reset()
+                elif event == 'ref_E':
+                    # Have we changed reference det?
+                    self.E_HF = float(val)
+                elif event == 'final_E':
+                    # The final energy as calculated in the simulation
+                    self.E_final = float(val)
+                elif event == 'new_tau':
+                    # Change of tau?
+                    self.new_tau = float(val)
 
-                # Change of tau?
-                m = re_init_tau.match(line)
-                if m:
-                    new_tau = float(m.group(2))
-                    continue
+            else:
+                # Do we need to start counting iterations?
+                if event == 'startiter':
+                    self.started = True
+                elif event in ('HF_D0', 'ref_E'):
+                    # Initial setting of the HF energy, or change of reference
+                    self.E_HF = float(val)
+                elif event == 'init_tau':
+                    self.new_tau = float(val)
 
+        self.apply_pending(buf, pos, end)
+        self.offset = end
+        self.check = self.checksum(buf, end)
 
-    return HF_energies, E_final, tau_changes
 
 def apply_ref_Es (E, it, ref_Es):
     '''Calculate the plottable (total) energies from the correlation energies
        in the FCIMCStats files, the reference energies from the output files
        and the list eof iteration numbers.'''
 
-    # Main loop
-    E_out = []
-    ref_it, E_next = -1, ref_Es[0][1]
-    ref_curr = -1
-    for i, ecurr in zip(it, E):
-
-        # Update reference energy in the list
-        if (ref_it and i >= ref_it) or ref_curr == -1:
-            ref_curr += 1
-            ref_E = E_next
-            if len(ref_Es) > ref_curr + 1:
-                ref_it, E_next = ref_Es[ref_curr+1]
-            else:
-                ref_it = None
+    if not ref_Es:
+        return asarray(E)
+
+    # The first reference energy applies from the start, and each subsequent
+    # one from the iteration at which it was set.
+    ref_its = array([r[0] for r in ref_Es[1:]])
+    ref_vals = array([r[1] for r in ref_Es])
+    ind = searchsorted(ref_its, it, side='right')
+    return asarray(E) + ref_vals[ind]
+
 
-        # Add to the list.
-        E_out.append(ecurr + ref_E)
-    return E_out
+def refresh_callback ():
+    '''Update the plot with any newly available data'''
+
+    if plot.do_update():
+        plot.fig.canvas.draw_idle()
 
 
 def keypress_callback (event):
@@ -1192,20 +1778,31 @@ def keypress_callback (event):
 
 def resize_callback (event):
     '''Respond to a resize event'''
-    
-    print 'Resize event'
-    print 'name', event.name
-    print 'canvas', event.canvas
-    print 'guiEvent', event.guiEvent
-    
-        
+
+    # The number of pixels available has changed
+    plot.do_redecimate()
+    plot.fig.canvas.draw_idle()
+
+
 def scroll_callback (event):
     '''Respond to a scroll event'''
-    
-    print 'Scroll event'
-    print 'name', event.name
-    print 'canvas', event.canvas
-    print 'guiEvent', event.guiEvent
+
+    # Zoom the x-axis in (or out) about the cursor position
+    if event.inaxes is None:
+        return
+    scale = 0.8 if event.button == 'up' else 1.25
+    lim = event.inaxes.get_xlim()
+    event.inaxes.set_xlim(event.xdata + (lim[0] - event.xdata) * scale,
+                          event.xdata + (lim[1] - event.xdata) * scale)
+    plot.fig.canvas.draw_idle()
+
+
+def xlim_callback (ax):
+    '''Respond to a change in the x-axis limits (e.g. zooming)'''
+
+    # Show the full resolution data for the visible region. All of the axes
+    # share the x-axis.
+    plot.do_redecimate(ax.get_xlim())
 
 
 def to_float_if_float(s):
@@ -1232,7 +1829,30 @@ def file_E_list(f):
                     ret.append(float(line.split()[0]))
         return ret
 
-def stretched_exp_fit (wlk, proj):
+def stretched_exp (N, E, c, al):
+    '''E_p(Nw) = E_0 * (1 - exp(-(Nw/c)**beta))'''
+    return E * (1 - exp(-((N/c)**al)))
+
+
+def stretched_exp_jac (N, E, c, al):
+    '''The Jacobian of stretched_exp with respect to (E_0, c, beta)'''
+    u = (N/c)**al
+    e = exp(-u)
+    return column_stack((1 - e, -E * e * u * al / c, E * e * u * log(N/c)))
+
+
+def exp_growth (t, N0, g):
+    '''N(t) = N_0 * exp(g * t)'''
+    return N0 * exp(g * t)
+
+
+def exp_growth_jac (t, N0, g):
+    '''The Jacobian of exp_growth with respect to (N_0, g)'''
+    e = exp(g * t)
+    return column_stack((e, N0 * t * e))
+
+
+def stretched_exp_fit (wlk, proj, p0=None, verbose=True):
     '''Fit the number of walkers/projected energy to a stretched exponential
     function of the form:
 
@@ -1242,40 +1862,225 @@ def stretched_exp_fit (wlk, proj):
 
     d(delta E)/dN = -c(delta E) / N**alpha
 
-    Possibly try with another constant before the exp?'''
+    Possibly try with another constant before the exp?
 
-    # Fitting function, and derived error function
-    fitfunc = lambda N, E, c, al: E * (1 - exp(-((N/c)**al)))
+    Returns the fitted curve, E_0 and its error, and the fitted parameters
+    (which may be used as the initial guess, p0, for another fit).'''
 
     # Initial guesses for parameters
     # E_0, c, alpha
-    p0 = [-20.8, 10000.0, 0.141]
+    if p0 is None:
+        p0 = [-20.8, 10000.0, 0.141]
 
     # Fitting data. We don't want to include early iterations with far too
     # few walkers (need some stability)
-    zipped_data = zip(wlk, proj)
-    W, P = zip(*[z for z in zipped_data if z[0] > 10000])
+    wlk = asarray(wlk, dtype=float)
+    proj = asarray(proj, dtype=float)
+    sel = wlk > 10000
+    W, P = wlk[sel], proj[sel]
 
     # Fit the data!
-    popt, pcov = curve_fit (fitfunc, W, P, p0=p0, maxfev=500000)
-#    print 'popt', popt
-#    print 'pcov', pcov
+    popt, pcov = curve_fit (stretched_exp, W, P, p0=p0, jac=stretched_exp_jac,
+                            maxfev=500000)
 
     # Obtain the fitted curve to plot.
-    #popt = [-20.88292143, 10000, 0.141398]
-    fit_data = map(lambda N: fitfunc(N, popt[0], popt[1], popt[2]), wlk)
-    
-     # Output the fitting in a human readable form
+    fit_data = stretched_exp(wlk, *popt)
+
+    # Output the fitting in a human readable form
     # n.b. diagonals of the covariance matrix provide the variance of the
     #      parameter estimates.
     err = sqrt(pcov[0,0]) if pcov is not inf else -1
-    print 'Fit data; E_0 = %f (+-%f), c = %f, alpha = %f' % \
-                                       (popt[0], err, popt[1], popt[2])
-    if pcov is inf:
-        print 'Poor fit obtained (covariance matrix == inf)'
+    if verbose:
+        print 'Fit data; E_0 = %f (+-%f), c = %f, alpha = %f' % \
+                                           (popt[0], err, popt[1], popt[2])
+        if pcov is inf:
+            print 'Poor fit obtained (covariance matrix == inf)'
+
+    return fit_data, popt[0], err, popt
+
+
+def growth_fit (t, wlk, shift, p0=None):
+    '''Fit the walker number during the initial growth phase (while the
+    shift is still held at its initial value) to an exponential growth
+    N(t) = N_0 * exp(g * t), with t the imaginary time since the start of
+    the calculation.
+
+    Returns the parameters (N_0, g) and the error in the growth rate.'''
+
+    t = asarray(t, dtype=float)
+    wlk = asarray(wlk, dtype=float)
+    shift = asarray(shift)
+    if not len(t):
+        raise RuntimeError('No data to fit')
+
+    # The growth phase ends when the shift starts to vary.
+    varying = nonzero(shift != shift[0])[0]
+    n = varying[0] if len(varying) else len(shift)
+    T, W = t[:n] - t[0], wlk[:n]
+    sel = W > 0
+    T, W = T[sel], W[sel]
+    if len(T) < 3:
+        raise RuntimeError('Too few points in the growth phase')
+
+    # If there is no previous fit, start from a linear fit to log(N)
+    if p0 is None:
+        g, lnN0 = polyfit(T, log(W), 1)
+        p0 = [exp(lnN0), g]
+
+    popt, pcov = curve_fit (exp_growth, T, W, p0=p0, jac=exp_growth_jac,
+                            maxfev=10000)
+    err = sqrt(pcov[1,1]) if pcov is not inf else -1
+    return popt, err
+
+
+def fit_chain (series):
+    '''Fit the energy and growth models to each of a sequence of runs in
+    turn (in a worker process). Each fit starts from the parameters obtained
+    for the previous run, falling back to the default initial guess if that
+    fails.'''
+
+    results = []
+    E_p0, G_p0 = None, None
+    for (fn, run, t, wlk, proj, shift) in series:
+
+        E_res, G_res = None, None
+        for p0 in ([E_p0, None] if E_p0 is not None else [None]):
+            try:
+                fit, E0, err, E_p0 = stretched_exp_fit(wlk, proj, p0=p0,
+                                                       verbose=False)
+                E_res = (E0, err, E_p0[1], E_p0[2])
+                break
+            except (RuntimeError, ValueError, TypeError):
+                pass
+
+        for p0 in ([G_p0, None] if G_p0 is not None else [None]):
+            try:
+                G_p0, err = growth_fit(t, wlk, shift, p0=p0)
+                G_res = (G_p0[0], G_p0[1], err)
+                break
+            except (RuntimeError, ValueError, TypeError):
+                pass
+
+        results.append((fn, run, E_res, G_res))
+
+    return results
+
+
+def fit_table ():
+    '''Fit the stretched exponential energy model and the exponential
+    growth model to every replica of every input file, and print the
+    results as a table. The runs are split into contiguous chains, which are
+    fitted in parallel.'''
+
+    series = []
+    for fl in plot.in_files:
+        fl.read(last_iter=plot.last_iter)
+
+        # A calculation which has only just started may not have written any
+        # data yet.
+        if not fl.reader.niter():
+            continue
+        cols = fl.reader.columns()
+
+        # Only the aggregate over the replicas has an explicit correlation
+        # energy. The replicas' are obtained using the same reference energy.
+        # The multiple run columns only contain the replicas, so each of
+        # these is fitted, labelled from 1.
+        proj = cols['proje_corr'][newaxis,:]
+        if 'proje_tot_agg' in cols:
+            proj = cols['proje_tot'] - (cols['proje_tot_agg'] - cols['proje_corr'])
+
+        for run in range(len(cols['parts'])):
+            series.append((fl.fn, run + 1, cols['im_time'], cols['parts'][run],
+                           proj[min(run, len(proj)-1)],
+                           cols['shift'][min(run, len(cols['shift'])-1)]))
+
+    if not series:
+        print 'No data to fit.'
+        return 0
+
+    njobs = max(min(plot.jobs or multiprocessing.cpu_count(), len(series)), 1)
+    chains = [c for c in array_split(arange(len(series)), njobs) if len(c)]
+    chains = [[series[i] for i in c] for c in chains]
+    pool = multiprocessing.Pool(njobs)
+    results = [r for chain in pool.map(fit_chain, chains) for r in chain]
+    pool.close()
+    pool.join()
+
+    fmt = '%-30s %4s %14s %12s %12s %8s %12s %10s %10s'
+    print fmt % ('File', 'Run', 'E_0', '+-', 'c', 'beta', 'N_0', 'g', '+-')
+    nfail = 0
+    for fn, run, E_res, G_res in results:
+        E_str = ['-'] * 4 if E_res is None else \
+                ['%.8f' % E_res[0], '%.2e' % E_res[1],
+                 '%.4g' % E_res[2], '%.5f' % E_res[3]]
+        G_str = ['-'] * 3 if G_res is None else \
+                ['%.4g' % G_res[0], '%.6f' % G_res[1], '%.2e' % G_res[2]]
+        print fmt % tuple([fn[-30:], run] + E_str + G_str)
+        if E_res is None or G_res is None:
+            nfail += 1
+
+    return nfail
+
+
+def batch_init ():
+    '''Prepare a batch worker process. The figure and axes are created once,
+       and reused for each of the files rendered by this worker.'''
+
+    rc('text', usetex=False)
+    plot.legend_all = plot.legend_strs
+    plot.init_axes()
+
+
+def batch_render (job):
+    '''Render the plot for one input file (in a batch worker process)'''
+
+    ind, outfile = job
+    fl = plot.in_files[ind]
+    try:
+        plot.in_files = [fl]
+        if plot.legend_all:
+            plot.legend_strs = [plot.legend_all[ind]]
+        plot.clear_axes()
+        plot.plot_data()
+        plot.axis_labels()
+        plot.fig.suptitle(fl.fn)
+        plot.fig.savefig(outfile)
+        return fl.fn, outfile, None
+    except Exception, e:
+        return fl.fn, outfile, str(e)
+    finally:
+        plot.in_files = plot.all_files
+
+
+def batch_plot ():
+    '''Render the plots for all of the input files into image files in the
+       batch directory, using a pool of worker processes'''
+
+    if not path.isdir(plot.batch_dir):
+        os.makedirs(plot.batch_dir)
+
+    # Name the images after the (path of the) stats files
+    jobs = []
+    for i, fl in enumerate(plot.in_files):
+        name = path.normpath(fl.fn).strip(os.sep).replace(os.sep, '_')
+        jobs.append((i, path.join(plot.batch_dir,
+                                  '%s.%s' % (name, plot.batch_format))))
+
+    # The workers are forked, and so inherit the configured plotter.
+    plot.all_files = plot.in_files
+    pool = multiprocessing.Pool(plot.jobs, initializer=batch_init)
+    nfail = 0
+    for fn, outfile, err in pool.imap_unordered(batch_render, jobs):
+        if err is None:
+            print 'Rendered "%s" to "%s"' % (fn, outfile)
+        else:
+            print 'Failed to render "%s": %s' % (fn, err)
+            nfail += 1
+    pool.close()
+    pool.join()
 
-    return fit_data, popt[0], err
-                
+    return nfail
 
 
 # If we are running this directly, execute main.
@@ -1283,10 +2088,23 @@ if __name__ == "__main__":
 
     plot.proc_args()
 
+    if plot.fit_table:
+        sys.exit(1 if fit_table() else 0)
+
+    if plot.batch_dir:
+        sys.exit(1 if batch_plot() else 0)
+
     plot.do_plot()
 
     # Enter plotting main loop
     plot.fig.canvas.mpl_connect('key_release_event', keypress_callback)
-#    plot.fig.canvas.mpl_connect('resize_event', resize_callback)
-#    plot.fig.canvas.mpl_connect('scroll_event', scroll_callback)
+    if plot.refresh:
+        timer = plot.fig.canvas.new_timer(interval=int(1000 * plot.refresh))
+        timer.add_callback(refresh_callback)
+        timer.start()
+    plot.fig.canvas.mpl_connect('resize_event', resize_callback)
+    plot.fig.canvas.mpl_connect('scroll_event', scroll_callback)
+    for x in plot.axes:
+        if x.plot:
+            x.ax.callbacks.connect('xlim_changed', xlim_callback)
     show()
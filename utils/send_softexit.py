@@ -25,14 +25,46 @@
 # kill -2 $send_softexit_ps
 # 
 # The latter should be used if multiple calculations are run on one computer.
+#
+# With --adaptive, rather than sending SOFTEXIT a fixed time before the
+# walltime expires, send_softexit follows the FCIMCStats file (and, if given,
+# the NECI output) and sends SOFTEXIT when the time left is only just enough
+# for the calculation to finish.  On reading SOFTEXIT (at the end of an update
+# cycle), NECI runs one more full update cycle before writing a POPSFILE, so
+# this is up to two update cycles and the time taken to write a POPSFILE.
+# The time taken to write a POPSFILE is estimated from the number of occupied
+# determinants, at the rate measured when POPSFILEs were written earlier in
+# the calculation (which requires the NECI output, and POPSFILETIMER to be
+# set) or else at a rate given by --pops-rate.  Until the timings of an update
+# cycle have been read, SOFTEXIT is sent --fallback-grace before the walltime.
 
 __author__ = 'James Spencer'
 
 from optparse import OptionParser, OptionValueError
+import os
+import re
 import signal
 import sys
 import time
 
+# The column labels in the FCIMCStats header, which is of the form
+# '#     1.Step   2.Shift ...' or, in the FCIMCStats-2 format (used by mneci),
+# '# 1. Iter.  2. Tot. parts ...'.
+re_label_split = re.compile(r'#?\s*\d+\.\s*')
+
+# The labels of the iteration number, the time per iteration and the number of
+# occupied determinants in each format.
+iter_labels = ('Step', 'Iter.')
+iter_time_labels = ('IterTime', 'Iter. time')
+dets_labels = ('UniqueDets', 'Dets occ.')
+
+# The lines printed by NECI when writing a POPSFILE.
+re_pops_dets = re.compile(r'Writing a total of\s+(\d+)\s+determinants')
+re_pops_time = re.compile(r'Time taken to write out POPSFILE:\s*(\S+)\s+seconds')
+
+# Number of recent update cycles (and POPSFILE writes) whose timings are used.
+nrecent = 10
+
 def signal_handler(signal, frame):
     '''Capture signal and leave quietly.'''
     print 'Signal has been caught.  Bye!'
@@ -57,17 +89,151 @@ t is a string eiher containing the number of seconds or in the format hh:mm:ss.'
         # already in seconds: just need to convert to integer.
         return int(t)
 
+class file_tail:
+    '''Read the lines added to the end of a file which is being written to.'''
+    def __init__(self, filename):
+        self.filename = filename
+        self.offset = 0
+        self.partial = ''
+
+    def read(self):
+        '''Return the (complete) lines added to the file since the last call.'''
+        try:
+            f = open(self.filename)
+        except IOError:
+            return []
+        if os.fstat(f.fileno()).st_size < self.offset:
+            # The file has been replaced (e.g. by a restarted calculation).
+            self.offset = 0
+            self.partial = ''
+        f.seek(self.offset)
+        lines = (self.partial + f.read()).split('\n')
+        self.offset = f.tell()
+        f.close()
+        self.partial = lines.pop()
+        return lines
+
+class run_monitor:
+    '''Estimate how long a calculation needs to finish once SOFTEXIT is sent, from the timings in the FCIMCStats file and the NECI output.
+
+NECI only reads CHANGEVARS at the end of each update cycle, and on finding SOFTEXIT runs one more full update cycle (NMCyc=Iter+StepsSft) before writing a POPSFILE.  In the worst case (SOFTEXIT being sent just after CHANGEVARS is read), this is the time taken by two update cycles (the longest of the recent ones) and the estimated time taken to write the POPSFILE.'''
+    def __init__(self, stats_file='FCIMCStats', output_file=None, pops_rate=2.5e5):
+        self.stats = file_tail(stats_file)
+        self.output = file_tail(output_file) if output_file else None
+        self.pops_rate = pops_rate
+        self.cols = None
+        self.last_iter = None
+        self.cycle_times = []
+        self.dets = 0
+        self.pops_writes = []
+        self.pops_dets = None
+
+    def update(self):
+        '''Read any new data written by the calculation.'''
+        for line in self.stats.read():
+            if line.startswith('#') and any(l in line for l in iter_time_labels):
+                labels = [l.strip() for l in re_label_split.split(line) if l.strip()]
+                cols = [[labels.index(l) for l in choices if l in labels] for choices in (iter_labels, iter_time_labels, dets_labels)]
+                if cols[0] and cols[1]:
+                    self.cols = (cols[0][0], cols[1][0], cols[2][0] if cols[2] else None)
+                    self.last_iter = None
+                continue
+            # Some rows of data may be commented out.
+            row = line.lstrip('#').split()
+            if not self.cols or len(row) <= max(c for c in self.cols if c is not None):
+                continue
+            try:
+                iteration = int(float(row[self.cols[0]]))
+                iter_time = float(row[self.cols[1]])
+                if self.cols[2] is not None:
+                    self.dets = float(row[self.cols[2]])
+            except ValueError:
+                continue
+            # The iteration time is the average over the update cycle.
+            if self.last_iter is not None and iteration > self.last_iter:
+                self.cycle_times = (self.cycle_times + [(iteration-self.last_iter)*iter_time])[-nrecent:]
+            self.last_iter = iteration
+        if self.output:
+            for line in self.output.read():
+                m = re_pops_dets.search(line)
+                if m:
+                    self.pops_dets = int(m.group(1))
+                m = re_pops_time.search(line)
+                if m and self.pops_dets:
+                    try:
+                        self.pops_writes = (self.pops_writes + [(self.pops_dets, float(m.group(1)))])[-nrecent:]
+                    except ValueError:
+                        # Times too long for the output format are printed as ***.
+                        pass
+                    self.pops_dets = None
+
+    def has_timings(self):
+        '''True if the time taken by an update cycle has been measured.'''
+        return bool(self.cycle_times)
+
+    def cycle_time(self):
+        '''The time taken by an update cycle.'''
+        return max(self.cycle_times) if self.cycle_times else 0.0
+
+    def pops_time(self):
+        '''The time needed to write a POPSFILE containing the current number of occupied determinants.'''
+        if self.pops_writes:
+            seconds_per_det = max(t/max(n, 1) for (n, t) in self.pops_writes)
+            return max(self.dets*seconds_per_det, self.pops_writes[-1][1])
+        else:
+            return self.dets/self.pops_rate
+
+    def time_needed(self):
+        '''The time needed to finish the calculation once SOFTEXIT is sent.'''
+        return 2*self.cycle_time() + self.pops_time()
+
+def adaptive_wait(walltime, monitor, safety=1.5, min_grace=60, poll=30, start_time=None, fallback_grace=900):
+    '''Wait until the time left before the walltime (measured from start_time, by default now) is only just enough for the calculation to finish, as estimated by monitor (a run_monitor object), multiplied by safety and at least min_grace seconds.  If no timings have been read by monitor, fallback_grace seconds are left instead.  Return the time left.'''
+    if start_time is None:
+        start_time = time.time()
+    warned = False
+    while True:
+        monitor.update()
+        if monitor.has_timings():
+            needed = max(safety*monitor.time_needed(), min_grace)
+        else:
+            if not warned:
+                print 'WARNING: no update cycle timings read from %s; using a grace period of %is until they are.' % (monitor.stats.filename, fallback_grace)
+                warned = True
+            needed = max(fallback_grace, min_grace)
+        left = walltime - (time.time() - start_time)
+        if left <= needed:
+            if monitor.has_timings():
+                print 'Sending SOFTEXIT with %is left (update cycle: %.1fs, POPSFILE: %.1fs).' % (left, monitor.cycle_time(), monitor.pops_time())
+            else:
+                print 'WARNING: sending SOFTEXIT with %is left, without any update cycle timings from %s.' % (left, monitor.stats.filename)
+            return left
+        time.sleep(min(poll, left - needed))
+
+def add_adaptive_options(parser):
+    '''Add the options for the adaptive mode to an OptionParser.'''
+    parser.add_option('-a','--adaptive',action='store_true',default=False,help='Send SOFTEXIT when the time left is just enough for the calculation to finish (up to two update cycles and writing a POPSFILE), as measured from the FCIMCStats file (and NECI output), rather than at a fixed time.')
+    parser.add_option('--stats',default='FCIMCStats',help='FCIMCStats file used in the adaptive mode.  Default: %default.')
+    parser.add_option('-o','--output',default=None,help='NECI output file, from which the times taken to write POPSFILEs are read in the adaptive mode.')
+    parser.add_option('--pops-rate',type='float',default=2.5e5,help='Number of determinants written to a POPSFILE per second, used in the adaptive mode if no POPSFILE writes have been timed.  Default: %default.')
+    parser.add_option('--safety',type='float',default=1.5,help='Factor by which the time needed to finish is multiplied in the adaptive mode.  Default: %default.')
+    parser.add_option('--min-grace',type='float',default=60,help='Minimum time (in seconds) before the walltime expires at which SOFTEXIT is sent in the adaptive mode.  Default: %default.')
+    parser.add_option('--fallback-grace',type='float',default=900,help='Time (in seconds) before the walltime expires at which SOFTEXIT is sent in the adaptive mode if no update cycle timings have been read from the FCIMCStats file.  Default: %default.')
+    parser.add_option('--poll',type='float',default=30,help='Interval (in seconds) at which the calculation is checked in the adaptive mode.  Default: %default.')
+
 def parse_options(my_args):
-    '''Parse command line options.  Return the amount of sleep time.'''
+    '''Parse command line options.  Return the options and the walltime.'''
     parser = OptionParser(usage='''send_softexit.py [options] walltime
 
 Monitor a running job and write SOFTEXIT to CHANGEVARS in the current directory
 when the elapsed time gets to within a specified amount of the walltime allowed
-for the job.
+for the job, or (with --adaptive) to within the time the job needs to finish
+(up to two update cycles and writing a POPSFILE).
 
 The walltime and grace period can be given either in seconds or in the format
 hh:mm:ss.''')
     parser.add_option('-g','--grace',default='0',help='Amount of time before the walltime expires that SOFTEXIT is sent.  Default: %default.')
+    add_adaptive_options(parser)
     (options,args) = parser.parse_args(my_args)
     if len(args) != 1:
         if len(args) == 0:
@@ -78,9 +244,7 @@ hh:mm:ss.''')
         sys.exit(1)
     else:
         walltime = parse_timer(args[0])
-        grace = parse_timer(options.grace)
-        sleep_time = walltime - grace
-    return sleep_time
+    return (options, walltime)
 
 def main(sleep_time):
     print 'send_softexit sleeping for %is.' % (sleep_time)
@@ -88,7 +252,18 @@ def main(sleep_time):
     job_cleanup()
     sys.exit()
 
+def adaptive_main(walltime, options):
+    '''Monitor the calculation and send SOFTEXIT once it has only just enough time left to finish.'''
+    print 'send_softexit monitoring %s for %is.' % (options.stats, walltime)
+    monitor = run_monitor(options.stats, options.output, options.pops_rate)
+    adaptive_wait(walltime, monitor, options.safety, options.min_grace, options.poll, fallback_grace=options.fallback_grace)
+    job_cleanup()
+    sys.exit()
+
 if __name__ == '__main__':
-    sleep_time = parse_options(sys.argv[1:])
+    (options, walltime) = parse_options(sys.argv[1:])
     signal.signal(signal.SIGINT,signal_handler) # Listen out for Ctrl-C.
-    main(sleep_time)
+    if options.adaptive:
+        adaptive_main(walltime, options)
+    else:
+        main(walltime - parse_timer(options.grace))
@@ -0,0 +1,281 @@
+#!/usr/bin/python
+'''synthetic_data.py [options] kind rows [directory]
+
+Write synthetic NECI output files of a given size, for benchmarking the
+analysis scripts (see benchmark_tools.py). The kinds of file are:
+
+    popsfile_bin  - POPSFILEHEAD (version 4, with a PopRandomHash) and
+                    POPSFILEBIN, with rows determinants.
+    popsfile      - A text POPSFILE (version 3), with rows determinants.
+    fcimcstats    - An FCIMCStats file with rows iterations, for one or more
+                    replicas (--replicas).
+    lowdin        - A Lowdin file (lowdin.1) with approximately rows lines
+                    of eigenvalues and overlaps, i.e. for sqrt(2*rows)
+                    Krylov vectors.
+    spectral_data - A SPECTRAL_DATA file with rows eigenvalues.
+
+The files are written in the formats used by NECI, with random (but
+plausible) contents. They are written in blocks, so that files much larger
+than the available memory can be generated.'''
+
+import math
+import optparse
+import os
+import sys
+import numpy
+
+# The number of rows generated and written at once.
+block_rows = 1 << 16
+
+# The titles of the columns of an FCIMCStats file, and for each replica in a
+# multiple run (mneci) calculation.
+stats_titles = ['Iter.', 'Tot. parts', 'Tot. ref', 'Proj. E (cyc)',
+                'Shift. (cyc)', 'No. born', 'No. died', 'No. annihil',
+                'Tot. Proj. E', 'Dets occ.', 'Dets spawned', 'Iter. time',
+                'Im. time']
+replica_titles = ['Parts', 'Ref', 'Shift', 'Tot ProjE', 'ProjE Denom',
+                  'ProjE Num', 'Born', 'Died', 'Annihil', 'Doubs']
+
+
+def blocks (rows):
+    '''Split rows into (start, number) blocks of at most block_rows.'''
+
+    for start in range(0, rows, block_rows):
+        yield start, min(block_rows, rows - start)
+
+
+def random_dets (rng, ndets, nel, norb):
+    '''Random determinants, as (ndets x nwords) arrays of 64-bit integers
+       with nel of the first norb bits set. The determinants are not
+       necessarily distinct.'''
+
+    nwords = (norb + 63) // 64
+    orbs = rng.random_sample((ndets, norb)).argsort(axis=1)[:, :nel]
+    ilut = numpy.zeros((ndets, nwords), dtype=numpy.uint64)
+    for word in range(nwords):
+        bits = numpy.where(orbs // 64 == word,
+                           numpy.left_shift(numpy.uint64(1),
+                                            (orbs % 64).astype(numpy.uint64)),
+                           numpy.uint64(0))
+        ilut[:, word] = numpy.bitwise_or.reduce(bits, axis=1)
+    return ilut
+
+
+def write_popsfile_bin (dirname, ndets, nel=10, norb=40, nsign=1, seed=7):
+    '''Write POPSFILEHEAD and POPSFILEBIN, with ndets determinants, in
+       dirname. Each record contains the determinant, the (real) signs of
+       each of the nsign replicas and a flag.'''
+
+    rng = numpy.random.RandomState(seed)
+    nifd = (norb + 63) // 64 - 1
+    niftot = nifd + nsign + 1
+    random_hash = rng.randint(1, 1 << 15, norb)
+
+    with open(os.path.join(dirname, 'POPSFILEHEAD'), 'w') as f:
+        f.write('# POPSFILE VERSION 4\n')
+        f.write('&POPSHEAD Pop64Bit=T\n')
+        f.write('PopHPHF=F,PopLz=F,PopLensign= %i,PopNEl= %i,\n' % (nsign, nel))
+        f.write('PopTotwalk= %i,PopSft=   0.000000000000,\n' % ndets)
+        f.write(' PopSumNoatHF=   %.8f      ,\n' % (ndets * 10.0))
+        f.write(' PopSumENum=  %.8f      ,\n' % (-ndets * 10.0))
+        f.write('PopCyc= %i,PopNIfD= %i,PopNIfY= 0,PopNIfSgn= %i,\n'
+                % (1000, nifd, nsign))
+        f.write('PopNIfFlag= 1,PopNIfTot= %i,PopTau=    0.010000000000,\n'
+                % niftot)
+        f.write('PopiBlockingIter=               0\n')
+        f.write('PopNNodes=     1\n')
+        f.write('PopWalkersOnNodes= %i,\n' % ndets)
+        f.write('PopRandomHash= ' +
+                ''.join('%12i,' % h for h in random_hash) + '\n')
+        f.write(' &END\n')
+
+    # Each determinant is written as a separate unformatted record, with the
+    # record length before and after it.
+    record = numpy.dtype([('len1', numpy.uint32),
+                          ('ilut', numpy.uint64, (nifd + 1,)),
+                          ('sign', numpy.float64, (nsign,)),
+                          ('flag', numpy.uint64),
+                          ('len2', numpy.uint32)])
+    length = (niftot + 1) * 8
+    with open(os.path.join(dirname, 'POPSFILEBIN'), 'wb') as f:
+        for start, n in blocks(ndets):
+            data = numpy.zeros(n, dtype=record)
+            data['len1'] = length
+            data['len2'] = length
+            data['ilut'] = random_dets(rng, n, nel, norb)
+            data['sign'] = rng.standard_normal((n, nsign)) * \
+                               rng.exponential(10.0, (n, 1))
+            data.tofile(f)
+
+
+def write_popsfile (filename, ndets, nel=10, norb=40, seed=7):
+    '''Write a text (version 3) POPSFILE containing ndets determinants, with
+       integer signs.'''
+
+    rng = numpy.random.RandomState(seed)
+    nifd = (norb + 63) // 64 - 1
+    niftot = nifd + 2
+
+    with open(filename, 'w') as f:
+        f.write('# POPSFILE VERSION 3\n')
+        f.write('Pop64Bit=    T PopHPHF=    F PopLz=    F PopLenof_sign=    1 '
+                'PopNEl=%6i\n' % nel)
+        for val in [ndets, 0.0, ndets * 10.0, -ndets * 10.0, 1000, nifd, 0, 1,
+                    1, niftot]:
+            f.write('%20s\n' % val)
+        for start, n in blocks(ndets):
+            rows = numpy.empty((n, niftot + 1), dtype=numpy.int64)
+            rows[:, :nifd+1] = random_dets(rng, n, nel, norb).view(numpy.int64)
+            sign = numpy.rint(rng.standard_normal(n) *
+                              rng.exponential(10.0, n)).astype(numpy.int64)
+            rows[:, nifd+1] = numpy.where(sign == 0, 1, sign)
+            rows[:, nifd+2] = 0
+            numpy.savetxt(f, rows, fmt='%24i')
+
+
+def write_fcimcstats (filename, niter, nreplicas=1, seed=7):
+    '''Write an FCIMCStats file with niter iterations. For more than one
+       replica, the columns of each replica (as in mneci) are included. The
+       walker number grows exponentially until the shift starts to vary.'''
+
+    rng = numpy.random.RandomState(seed)
+    titles = list(stats_titles)
+    if nreplicas > 1:
+        for run in range(1, nreplicas + 1):
+            titles += ['%s (%i)' % (t, run) for t in replica_titles]
+
+    tau = 0.01
+    E0 = -100.0
+    growth = 0.05
+    nmax = 1e6
+    tstart = math.log(nmax) / growth
+
+    with open(filename, 'w') as f:
+        f.write('#' + ''.join('  %i. %s' % (i + 1, t)
+                              for (i, t) in enumerate(titles)) + '\n')
+        for start, n in blocks(niter):
+            it = numpy.arange(start + 1, start + n + 1, dtype=float)
+            t = it * tau
+            runs = []
+            for run in range(max(nreplicas, 1)):
+                noise = rng.standard_normal((4, n))
+                parts = numpy.exp(numpy.minimum(growth * t, math.log(nmax))) \
+                            * (1 + 0.01 * noise[0])
+                ref = 0.1 * parts * (1 + 0.01 * noise[1])
+                shift = numpy.where(t < tstart, 0.0, E0 + 0.01 * noise[2])
+                proje = E0 + 0.01 * noise[3]
+                born = 0.2 * parts
+                died = 0.1 * parts
+                annihil = 0.05 * parts
+                runs.append([parts, ref, shift, proje, ref, ref * proje, born,
+                             died, annihil, 0.01 * parts])
+            tot = [sum(r[i] for r in runs) for i in range(len(runs[0]))]
+            mean = [c / len(runs) for c in tot]
+            cols = [it, tot[0], tot[1], mean[3], mean[2], tot[6], tot[7],
+                    tot[8], mean[3], 0.3 * tot[0], 0.1 * tot[0],
+                    0.001 * (1 + rng.random_sample(n)), t]
+            if nreplicas > 1:
+                for r in runs:
+                    cols += r
+            numpy.savetxt(f, numpy.array(cols).T, fmt='%22.12G')
+
+
+def write_lowdin (filename, rows, pert=False, seed=7):
+    '''Write a Lowdin file with approximately rows lines of eigenvalues and
+       overlaps, i.e. for nvecs Krylov vectors with nvecs*(nvecs+1)/2 = rows.
+       If pert is true, the overlaps with the perturbed ground state are
+       included.'''
+
+    rng = numpy.random.RandomState(seed)
+    nvecs = max(int((math.sqrt(8 * rows + 1) - 1) / 2), 1)
+    ncols = 3 if pert else 2
+
+    with open(filename, 'w') as f:
+        f.write('----' + 'Norm of unperturbed initial wave function'
+                + '-' * 25 + '\n')
+        f.write(' %19.12E\n\n' % (1 + rng.random_sample()))
+        f.write('----' + 'Overlap matrix eigenvalues' + '-' * 40 + '\n')
+        overlap = numpy.sort(rng.random_sample(nvecs))
+        numpy.savetxt(f, overlap, fmt=' %19.12E')
+        for nkeep in range(1, nvecs + 1):
+            f.write('\n----Eigenvalues and overlaps when keeping %i '
+                    'eigenvectors%s\n' % (nkeep, '-' * 8))
+            vals = numpy.empty((nkeep, ncols))
+            vals[:, 0] = numpy.sort(rng.uniform(-10, 10, nkeep))
+            vals[:, 1:] = rng.standard_normal((nkeep, ncols - 1))
+            numpy.savetxt(f, vals, fmt=' %19.12E')
+
+
+def write_spectral_data (filename, neigv, seed=7):
+    '''Write a SPECTRAL_DATA file with neigv eigenvalues and transition
+       amplitudes.'''
+
+    rng = numpy.random.RandomState(seed)
+
+    with open(filename, 'w') as f:
+        f.write(' Eigenvalues and left and right transition amplitudes:\n')
+        for start, n in blocks(neigv):
+            rows = numpy.empty((n, 4))
+            rows[:, 0] = numpy.arange(start + 1, start + n + 1)
+            rows[:, 1] = numpy.sort(rng.uniform(-10, 10, n))
+            rows[:, 2] = rng.standard_normal(n) / math.sqrt(neigv)
+            rows[:, 3] = rows[:, 2] * (1 + 0.01 * rng.standard_normal(n))
+            numpy.savetxt(f, rows, fmt=' %7i     %15.10f     %15.10f     %15.10f')
+
+
+# The file(s) written for each kind of data, and the function writing them
+# (given the directory, number of rows and options).
+generators = {
+    'popsfile_bin': (['POPSFILEHEAD', 'POPSFILEBIN'],
+                     lambda d, n, o: write_popsfile_bin(d, n, seed=o.seed)),
+    'popsfile': (['POPSFILE'], lambda d, n, o: write_popsfile(
+                     os.path.join(d, 'POPSFILE'), n, seed=o.seed)),
+    'fcimcstats': (['FCIMCStats'], lambda d, n, o: write_fcimcstats(
+                     os.path.join(d, 'FCIMCStats'), n, o.replicas, o.seed)),
+    'lowdin': (['lowdin.1'], lambda d, n, o: write_lowdin(
+                     os.path.join(d, 'lowdin.1'), n, o.pert, o.seed)),
+    'spectral_data': (['SPECTRAL_DATA'], lambda d, n, o: write_spectral_data(
+                     os.path.join(d, 'SPECTRAL_DATA'), n, o.seed)),
+}
+
+
+def generate (kind, rows, dirname, options):
+    '''Write the file(s) of the given kind into dirname, unless they are
+       already present. Returns the paths of the files.'''
+
+    (names, writer) = generators[kind]
+    paths = [os.path.join(dirname, fn) for fn in names]
+    if not all(os.path.isfile(p) for p in paths):
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        writer(dirname, rows, options)
+    return paths
+
+
+def parse_options (args):
+    '''Read and return the kind, size, directory and any options present.'''
+
+    parser = optparse.OptionParser(usage = __doc__)
+    parser.add_option('-r', '--replicas', type='int', default=1,
+                      help='The number of replicas in an FCIMCStats file '
+                      '(default: %default).')
+    parser.add_option('-p', '--pert', action='store_true', default=False,
+                      help='Include the overlaps with the perturbed ground '
+                      'state in a Lowdin file.')
+    parser.add_option('-s', '--seed', type='int', default=7,
+                      help='The random number seed (default: %default).')
+    (options, args) = parser.parse_args(args)
+
+    if len(args) not in (2, 3) or args[0] not in generators:
+        parser.print_help()
+        sys.exit(1)
+
+    dirname = args[2] if len(args) == 3 else '.'
+    return args[0], int(float(args[1])), dirname, options
+
+
+if __name__ == '__main__':
+    (kind, rows, dirname, options) = parse_options(sys.argv[1:])
+    if not os.path.isdir(dirname):
+        os.makedirs(dirname)
+    generators[kind][1](dirname, rows, options)
@@ -13,7 +13,9 @@ watchdog does, however, listen out for the interrupt signal.  Recommended use in
     
 watchdog.py [options] $PBS_JOBID &
 [Job commands]
-killall -2 watchdog.py '''
+killall -2 watchdog.py
+
+With --adaptive, the cleanup function is run when the time left is only just enough for the calculation to finish (up to two update cycles and writing a POPSFILE), as estimated from the FCIMCStats file (and the NECI output), rather than a fixed time before the walltime expires.  See send_softexit.py.'''
 
 __author__='James Spencer'
 
@@ -25,6 +27,7 @@ import signal,sys,time
 from optparse import OptionParser,OptionValueError
 sys.path.extend([PBSQuery_path])
 import PBSQuery
+import send_softexit
 
 exit_time=900
 
@@ -48,6 +51,7 @@ def parse_options(my_args):
     '''Parse command line options.'''
     parser=OptionParser(usage=__doc__)
     parser.add_option('-e','--exit-time',type='float',default=exit_time,help='Amount of time (in seconds) before the walltime runs out at which the job_cleanup function is called to terminate the job. Default=%defaults.')
+    send_softexit.add_adaptive_options(parser)
     (options,args)=parser.parse_args(my_args)
     if len(args)!=1:
         if len(args)==0:
@@ -67,6 +71,16 @@ def main(job_id):
         raise Exception,'invalid job id %s.' % job_id
     job=p.getjob(job_id)
     wall_time=hhmmss_to_seconds(job[job_id]['Resource_List.walltime'])
+    try:
+        adaptive=options.adaptive
+    except NameError:
+        adaptive=False
+    if adaptive:
+        print 'Watchdog monitoring %s for %i' % (options.stats,wall_time)
+        monitor=send_softexit.run_monitor(options.stats,options.output,options.pops_rate)
+        send_softexit.adaptive_wait(wall_time,monitor,options.safety,options.min_grace,options.poll,fallback_grace=options.fallback_grace)
+        job_cleanup()
+        sys.exit()
     try:
         sleep_time=wall_time-options.exit_time
     except NameError: